@@ -1,7 +1,90 @@
+import os
+import tempfile
+
+
+def get_available_cpus():
+    """
+    Number of CPUs this process can use, taking into account the CPU quota
+    of the container (cgroup v2 or v1) if there is one.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            max_quota, period = f.read().split()
+            if max_quota != "max":
+                quota = int(max_quota) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                max_quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if max_quota > 0:
+                quota = max_quota / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
 wsgi_app = "deployment.wsgi.wsgi:app"
 bind = "0.0.0.0:8000"
-workers = 1
+# GUNICORN_WORKERS: number of workers, or "auto" (default) for one worker per
+# available CPU
+workers = os.environ.get("GUNICORN_WORKERS", "auto")
+workers = get_available_cpus() if workers == "auto" else int(workers)
 user = "gen3"
 group = "gen3"
 timeout = 300
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# the workers share `DB_POOL_MIN_SIZE` and `DB_POOL_MAX_SIZE` (see
+# `audit.db.get_pool_sizes`)
+os.environ["AUDIT_WORKERS"] = str(workers)
+
+# the workers write their metrics to files in `PROMETHEUS_MULTIPROC_DIR`, so
+# that `/metrics` returns the metrics of all the workers (see `audit.metrics`)
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="audit-metrics-")
+
+
+def on_starting(server):
+    # remove the metrics of a previous run, which would be added to the
+    # metrics of this run
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for file_name in os.listdir(metrics_dir):
+        if file_name.endswith(".db"):
+            os.remove(os.path.join(metrics_dir, file_name))
+    if os.getuid() == 0:
+        # the workers run as `user`
+        os.chown(metrics_dir, server.cfg.uid, server.cfg.gid)
+
+
+def pre_fork(server, worker):
+    # give each worker a slot number between 0 and `workers - 1`. A worker
+    # that replaces a dead worker gets the dead worker's slot. Only the worker
+    # in slot 0 runs the export workers and the retention policy, and pulls
+    # from the queue unless `QUEUE_CONSUMER_COORDINATION` is enabled
+    used_slots = {getattr(w, "audit_slot", None) for w in server.WORKERS.values()}
+    worker.audit_slot = next(
+        slot for slot in range(len(used_slots) + 1) if slot not in used_slots
+    )
+
+
+def post_fork(server, worker):
+    os.environ["AUDIT_WORKER_SLOT"] = str(worker.audit_slot)
+
+
+def child_exit(server, worker):
+    # the gauges of dead workers are not reported anymore. Their counters and
+    # histograms are still counted
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,111 @@
+"""
+Benchmark the per-request overhead of `ClientDisconnectMiddleware`.
+
+This script sends requests directly to a minimal ASGI app, without a server
+or a database, wrapped in:
+- no middleware (baseline);
+- the previous version of the middleware, which ran every request in a new
+  task and supported close watchers (`LegacyClientDisconnectMiddleware`);
+- the current version of the middleware, which only creates a task for the
+  requests that opt in by calling `scope["add_close_watcher"]()`.
+
+Each of them is measured for requests that do not opt in, such as
+`POST /log/*`, and for requests that opt in, such as queries.
+
+Usage: python docs/disconnect_benchmark.py [number of requests]
+"""
+
+
+import asyncio
+import sys
+import time
+
+# load the configuration
+from audit.app import ClientDisconnectMiddleware
+
+
+n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+class LegacyClientDisconnectMiddleware:
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        rv = loop.create_task(self._app(scope, receive, send))
+        waiter = None
+        cancelled = False
+        if scope["type"] == "http":
+
+            def add_close_watcher():
+                nonlocal waiter
+
+                async def wait_closed():
+                    nonlocal cancelled
+                    while True:
+                        message = await receive()
+                        if message["type"] == "http.disconnect":
+                            if not rv.done():
+                                cancelled = True
+                                rv.cancel()
+                            break
+
+                waiter = loop.create_task(wait_closed())
+
+            scope["add_close_watcher"] = add_close_watcher
+        try:
+            await rv
+        except asyncio.CancelledError:
+            if not cancelled:
+                raise
+        if waiter and not waiter.done():
+            waiter.cancel()
+
+
+def make_app(watch_disconnect):
+    async def app(scope, receive, send):
+        if watch_disconnect:
+            scope["add_close_watcher"]()
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    return app
+
+
+async def receive():
+    # the client never disconnects
+    await asyncio.Event().wait()
+
+
+async def send(message):
+    pass
+
+
+async def measure(app):
+    """
+    Average time spent handling one request, in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        await app({"type": "http"}, receive, send)
+    return (time.perf_counter() - start) / n_requests * 1000000
+
+
+async def run_benchmark():
+    for watch_disconnect in (False, True):
+        app = make_app(watch_disconnect)
+        baseline = await measure(app) if not watch_disconnect else None
+        legacy = await measure(LegacyClientDisconnectMiddleware(app))
+        current = await measure(ClientDisconnectMiddleware(app))
+        print(
+            f"{'Requests watching' if watch_disconnect else 'Requests not watching'} for disconnections ({n_requests} requests):"
+        )
+        if baseline is not None:
+            print(f"  no middleware:     {baseline:.2f} µs/request")
+        print(f"  previous version:  {legacy:.2f} µs/request")
+        print(f"  current version:   {current:.2f} µs/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark())
@@ -0,0 +1,85 @@
+"""
+Benchmark the throughput of the queue ingestion pipeline, without AWS access.
+
+This script fills a queue with audit log messages, then measures how long it
+takes to pull and insert all of them into the database configured in the
+audit-service configuration file (see `docs/how-to/local_installation.md`).
+The queue is the in-memory `local` queue by default, or the `postgres` queue
+the service can pull from without AWS access, which also includes the cost of
+receiving and deleting the messages. Run the migrations first. The inserted
+audit logs are NOT deleted afterwards: use a local, disposable database.
+
+Usage: python docs/queue_benchmark.py [number of messages] [local|postgres]
+"""
+
+
+import asyncio
+from random import randint
+import sys
+import time
+
+from sqlalchemy import text
+
+# load the configuration
+from audit import app
+from audit import logger
+from audit.db import get_data_access_layer, initiate_db
+from audit.pull_from_queue import pull_from_queue
+from audit.queues import LocalQueue, PostgresQueue
+
+
+n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+queue_type = sys.argv[2] if len(sys.argv) > 2 else "local"
+
+
+async def fill_queue(queue):
+    guid_base = "dg.fake/b01ebf46-3832-4a75-8736-b09e8d9fd"
+    for _ in range(n_messages):
+        guid = f"{guid_base}{randint(0, 999):03d}"
+        message = {
+            "category": "presigned_url",
+            "request_url": f"/data/download/{guid}",
+            "status_code": 200,
+            "username": f"user_{randint(0, 99):02d}",
+            "sub": 10,
+            "guid": guid,
+            "resource_paths": ["/my/resource/path1", "/path2"],
+            "action": "download",
+            "protocol": "s3",
+        }
+        if isinstance(queue, LocalQueue):
+            queue.send(message)
+        else:
+            await queue.send(message)
+
+
+async def count_messages(queue):
+    if isinstance(queue, LocalQueue):
+        return len(queue)
+    async for data_access_layer in get_data_access_layer():
+        result = await data_access_layer.db_session.execute(
+            text("SELECT count(*) FROM queue_message")
+        )
+    return result.scalar()
+
+
+async def run_benchmark():
+    await initiate_db()
+    queue = LocalQueue() if queue_type == "local" else PostgresQueue()
+    await fill_queue(queue)
+
+    start = time.time()
+    # `pull_from_queue` asks to sleep once the queue is empty, or on errors
+    while not await pull_from_queue(queue):
+        pass
+    duration = time.time() - start
+    if await count_messages(queue):
+        raise Exception("Failed to process audit logs, see logs above")
+
+    logger.info(
+        f"Processed {n_messages} messages in {round(duration, 2)}s ({round(n_messages / duration)} messages/s)"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark())
@@ -0,0 +1,43 @@
+"""create queue_message table
+
+Revision ID: 3c81f5a9d2b6
+Revises: f2b9c4d81e07
+Create Date: 2026-10-19 11:02:17.648203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3c81f5a9d2b6"
+down_revision = "f2b9c4d81e07"
+branch_labels = None
+depends_on = None
+
+
+table_name = "queue_message"
+
+
+def upgrade():
+    op.create_table(
+        table_name,
+        sa.Column("id", sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column("body", sa.Text(), nullable=False),
+        sa.Column(
+            "sent_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+        sa.Column(
+            "visible_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+        sa.Column("receive_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_table(table_name)
@@ -0,0 +1,56 @@
+"""create export_job table
+
+Revision ID: a4c6e2f19d37
+Revises: e85b3c0d6a71
+Create Date: 2026-10-19 15:02:17.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = "a4c6e2f19d37"
+down_revision = "e85b3c0d6a71"
+branch_labels = None
+depends_on = None
+
+
+table_name = "export_job"
+
+
+def upgrade():
+    op.create_table(
+        table_name,
+        sa.Column("id", sa.String(), primary_key=True),
+        sa.Column("requested_by", sa.String(), nullable=False),
+        sa.Column("category", sa.String(), nullable=False),
+        sa.Column("parameters", JSONB(), nullable=False),
+        sa.Column("start_timestamp", sa.DateTime, nullable=True),
+        sa.Column("stop_timestamp", sa.DateTime, nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("cursor_timestamp", sa.DateTime, nullable=True),
+        sa.Column("cursor_id", sa.Integer(), nullable=True),
+        sa.Column(
+            "exported_count", sa.BigInteger(), nullable=False, server_default="0"
+        ),
+        sa.Column("file_size", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("file_path", sa.String(), nullable=True),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column(
+            "created_at", sa.DateTime, nullable=False, server_default=sa.func.now()
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime, nullable=False, server_default=sa.func.now()
+        ),
+        sa.Column("completed_at", sa.DateTime, nullable=True),
+    )
+    # workers look for the oldest pending or abandoned job
+    op.create_index(
+        "export_job_status_created_at_idx", table_name, ["status", "created_at"]
+    )
+
+
+def downgrade():
+    op.drop_table(table_name)
@@ -0,0 +1,40 @@
+"""create quarantined_message table
+
+Revision ID: b3e1f07c92d4
+Revises: 42692e47f254
+Create Date: 2026-10-19 09:12:41.205318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b3e1f07c92d4"
+down_revision = "42692e47f254"
+branch_labels = None
+depends_on = None
+
+
+table_name = "quarantined_message"
+
+
+def upgrade():
+    op.create_table(
+        table_name,
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("message_id", sa.String(), nullable=True),
+        sa.Column("body", sa.Text(), nullable=False),
+        sa.Column("sent_timestamp", sa.DateTime, nullable=True),
+        sa.Column("receive_count", sa.Integer(), nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column(
+            "quarantined_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table(table_name)
@@ -0,0 +1,187 @@
+"""Add 'dedup_key' to presigned_url and login
+
+Revision ID: c7d2a94e18b5
+Revises: b3e1f07c92d4
+Create Date: 2026-10-19 11:02:17.836502
+
+Audit logs can be given a `dedup_key` so that duplicates (queue messages
+delivered more than once, retried API requests) are dropped. Each partition
+gets a unique index on `dedup_key`, and the trigger function ignores inserts
+that conflict with it. Rows without a `dedup_key` never conflict.
+
+The indexes of the existing partitions are built with `CREATE INDEX
+CONCURRENTLY`, outside of the migration transaction, so that audit logs can
+still be inserted while they are built.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+from audit import logger
+
+# revision identifiers, used by Alembic.
+revision = "c7d2a94e18b5"
+down_revision = "b3e1f07c92d4"
+branch_labels = None
+depends_on = None
+
+
+PARENT_TABLES = ["presigned_url", "login"]
+
+
+def _child_partitions(conn, parent: str) -> list[str]:
+    """Return names of tables that inherit from parent"""
+    res = conn.execute(
+        text(
+            """
+            SELECT c.relname
+            FROM pg_inherits
+            JOIN pg_class   c ON c.oid = inhrelid
+            JOIN pg_class   p ON p.oid = inhparent
+            WHERE p.relname = :parent
+            """
+        ),
+        {"parent": parent},
+    )
+    return [row[0] for row in res]
+
+
+def _create_dedup_key_indexes(conn, concurrently: bool) -> None:
+    create_index = (
+        "CREATE UNIQUE INDEX CONCURRENTLY" if concurrently else "CREATE UNIQUE INDEX"
+    )
+    for parent_table in PARENT_TABLES:
+        for child in _child_partitions(conn, parent_table):
+            logger.info(f"Creating dedup_key unique index on {child}")
+            op.execute(
+                f'{create_index} IF NOT EXISTS "{child}_dedup_key_idx" ON "{child}" (dedup_key);'
+            )
+
+
+def upgrade():
+    conn = op.get_bind()
+    for parent_table in PARENT_TABLES:
+        # the new column is also added to the existing partitions
+        op.add_column(parent_table, sa.Column("dedup_key", sa.String(), nullable=True))
+
+    # the indexes must exist before the trigger relies on them for
+    # `ON CONFLICT`. Concurrent index builds cannot run in a transaction
+    with op.get_context().autocommit_block():
+        _create_dedup_key_indexes(conn, concurrently=True)
+
+    # partitions created by the previous trigger during the concurrent builds
+    # are still small: index them in the same transaction as the trigger
+    # replacement
+    _create_dedup_key_indexes(conn, concurrently=False)
+
+    # replace trigger so future partitions get the unique index, and
+    # duplicate inserts are ignored
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION create_partition_and_insert() RETURNS trigger AS
+    $$
+    DECLARE
+        partition_timestamp TEXT;
+        partition TEXT;
+    BEGIN
+        partition_timestamp := to_char(NEW.timestamp,'YYYY_MM');
+        partition := TG_TABLE_NAME || '_' || partition_timestamp;
+
+        IF NOT EXISTS(SELECT relname FROM pg_class WHERE relname = partition) THEN
+            EXECUTE format('CREATE TABLE %I () INHERITS (%I);', partition, TG_TABLE_NAME);
+            EXECUTE format('CREATE UNIQUE INDEX %I ON %I (dedup_key);', partition || '_dedup_key_idx', partition);
+        END IF;
+
+        IF TG_TABLE_NAME = 'presigned_url' THEN
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, guid, resource_paths, action, protocol, additional_data,
+                                 dedup_key)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.guid,
+                  NEW.resource_paths, NEW.action, NEW.protocol, NEW.additional_data,
+                  NEW.dedup_key;
+
+        ELSIF TG_TABLE_NAME = 'login' THEN
+            IF NEW.id IS NULL THEN
+                NEW.id := nextval('global_login_id_seq');
+            END IF;
+
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, idp, fence_idp, shib_idp, client_id, ip, additional_data,
+                                 dedup_key)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.idp, NEW.fence_idp,
+                  NEW.shib_idp, NEW.client_id, NEW.ip, NEW.additional_data,
+                  NEW.dedup_key;
+        ELSE
+            RAISE EXCEPTION 'Unsupported table for partitioning: %', TG_TABLE_NAME;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql VOLATILE;
+    """
+    )
+
+
+def downgrade():
+    # dropping the column also drops it from the partitions, along with the
+    # unique indexes
+    for parent_table in PARENT_TABLES:
+        op.execute(f"ALTER TABLE {parent_table} DROP COLUMN dedup_key CASCADE;")
+
+    # revert trigger function
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION create_partition_and_insert() RETURNS trigger AS
+    $$
+    DECLARE
+        partition_timestamp TEXT;
+        partition TEXT;
+    BEGIN
+        partition_timestamp := to_char(NEW.timestamp,'YYYY_MM');
+        partition := TG_TABLE_NAME || '_' || partition_timestamp;
+
+        IF NOT EXISTS(SELECT relname FROM pg_class WHERE relname = partition) THEN
+            EXECUTE format('CREATE TABLE %I () INHERITS (%I);', partition, TG_TABLE_NAME);
+        END IF;
+
+        IF TG_TABLE_NAME = 'presigned_url' THEN
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, guid, resource_paths, action, protocol, additional_data)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11)',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.guid,
+                  NEW.resource_paths, NEW.action, NEW.protocol, NEW.additional_data;
+
+        ELSIF TG_TABLE_NAME = 'login' THEN
+            IF NEW.id IS NULL THEN
+                NEW.id := nextval('global_login_id_seq');
+            END IF;
+
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, idp, fence_idp, shib_idp, client_id, ip, additional_data)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12)',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.idp, NEW.fence_idp,
+                  NEW.shib_idp, NEW.client_id, NEW.ip, NEW.additional_data;
+        ELSE
+            RAISE EXCEPTION 'Unsupported table for partitioning: %', TG_TABLE_NAME;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql VOLATILE;
+    """
+    )
@@ -0,0 +1,185 @@
+"""Add 'resource_path_prefixes' to presigned_url
+
+Revision ID: e85b3c0d6a71
+Revises: c7d2a94e18b5
+Create Date: 2026-10-19 14:26:53.417092
+
+`resource_path_prefixes` contains all the prefixes of the `resource_paths`, so
+that queries can be restricted to the logs of the resources a user has access
+to, with an indexed array overlap instead of a prefix match on every row.
+Each partition gets a GIN index on the new column, built concurrently so that
+ingestion is not blocked in the meantime.
+
+The new column is not populated for the existing logs here: rewriting every
+log in the migration transaction would lock the whole table for as long as it
+takes. Run `python -m audit.backfill` once the migration is applied.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+from audit import logger
+
+# revision identifiers, used by Alembic.
+revision = "e85b3c0d6a71"
+down_revision = "c7d2a94e18b5"
+branch_labels = None
+depends_on = None
+
+
+table_name = "presigned_url"
+
+
+def _child_partitions(conn, parent: str) -> list[str]:
+    """Return names of tables that inherit from parent"""
+    res = conn.execute(
+        text(
+            """
+            SELECT c.relname
+            FROM pg_inherits
+            JOIN pg_class   c ON c.oid = inhrelid
+            JOIN pg_class   p ON p.oid = inhparent
+            WHERE p.relname = :parent
+            """
+        ),
+        {"parent": parent},
+    )
+    return [row[0] for row in res]
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    # the new column is also added to the existing partitions
+    op.add_column(
+        table_name,
+        sa.Column("resource_path_prefixes", sa.ARRAY(sa.String()), nullable=True),
+    )
+
+    # replace trigger so future partitions get the new column and index
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION create_partition_and_insert() RETURNS trigger AS
+    $$
+    DECLARE
+        partition_timestamp TEXT;
+        partition TEXT;
+    BEGIN
+        partition_timestamp := to_char(NEW.timestamp,'YYYY_MM');
+        partition := TG_TABLE_NAME || '_' || partition_timestamp;
+
+        IF NOT EXISTS(SELECT relname FROM pg_class WHERE relname = partition) THEN
+            EXECUTE format('CREATE TABLE %I () INHERITS (%I);', partition, TG_TABLE_NAME);
+            EXECUTE format('CREATE UNIQUE INDEX %I ON %I (dedup_key);', partition || '_dedup_key_idx', partition);
+            IF TG_TABLE_NAME = 'presigned_url' THEN
+                EXECUTE format('CREATE INDEX %I ON %I USING GIN (resource_path_prefixes);', partition || '_resource_path_prefixes_idx', partition);
+            END IF;
+        END IF;
+
+        IF TG_TABLE_NAME = 'presigned_url' THEN
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, guid, resource_paths, action, protocol, additional_data,
+                                 dedup_key, resource_path_prefixes)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.guid,
+                  NEW.resource_paths, NEW.action, NEW.protocol, NEW.additional_data,
+                  NEW.dedup_key, NEW.resource_path_prefixes;
+
+        ELSIF TG_TABLE_NAME = 'login' THEN
+            IF NEW.id IS NULL THEN
+                NEW.id := nextval('global_login_id_seq');
+            END IF;
+
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, idp, fence_idp, shib_idp, client_id, ip, additional_data,
+                                 dedup_key)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.idp, NEW.fence_idp,
+                  NEW.shib_idp, NEW.client_id, NEW.ip, NEW.additional_data,
+                  NEW.dedup_key;
+        ELSE
+            RAISE EXCEPTION 'Unsupported table for partitioning: %', TG_TABLE_NAME;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql VOLATILE;
+    """
+    )
+
+    # partitions created from now on are indexed by the trigger
+    with op.get_context().autocommit_block():
+        for child in _child_partitions(conn, table_name):
+            logger.info(f"Creating resource_path_prefixes index on {child}")
+            op.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{child}_resource_path_prefixes_idx" ON "{child}" USING GIN (resource_path_prefixes);'
+            )
+
+
+def downgrade():
+    # dropping the column also drops it from the partitions, along with the
+    # indexes
+    op.execute(f"ALTER TABLE {table_name} DROP COLUMN resource_path_prefixes CASCADE;")
+
+    # revert trigger function
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION create_partition_and_insert() RETURNS trigger AS
+    $$
+    DECLARE
+        partition_timestamp TEXT;
+        partition TEXT;
+    BEGIN
+        partition_timestamp := to_char(NEW.timestamp,'YYYY_MM');
+        partition := TG_TABLE_NAME || '_' || partition_timestamp;
+
+        IF NOT EXISTS(SELECT relname FROM pg_class WHERE relname = partition) THEN
+            EXECUTE format('CREATE TABLE %I () INHERITS (%I);', partition, TG_TABLE_NAME);
+            EXECUTE format('CREATE UNIQUE INDEX %I ON %I (dedup_key);', partition || '_dedup_key_idx', partition);
+        END IF;
+
+        IF TG_TABLE_NAME = 'presigned_url' THEN
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, guid, resource_paths, action, protocol, additional_data,
+                                 dedup_key)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.guid,
+                  NEW.resource_paths, NEW.action, NEW.protocol, NEW.additional_data,
+                  NEW.dedup_key;
+
+        ELSIF TG_TABLE_NAME = 'login' THEN
+            IF NEW.id IS NULL THEN
+                NEW.id := nextval('global_login_id_seq');
+            END IF;
+
+            EXECUTE format(
+                'INSERT INTO %I (id, request_url, status_code, timestamp, username,
+                                 sub, idp, fence_idp, shib_idp, client_id, ip, additional_data,
+                                 dedup_key)
+                 VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                 ON CONFLICT (dedup_key) DO NOTHING',
+                partition)
+            USING NEW.id, NEW.request_url, NEW.status_code, NEW.timestamp,
+                  NEW.username, NEW.sub, NEW.idp, NEW.fence_idp,
+                  NEW.shib_idp, NEW.client_id, NEW.ip, NEW.additional_data,
+                  NEW.dedup_key;
+        ELSE
+            RAISE EXCEPTION 'Unsupported table for partitioning: %', TG_TABLE_NAME;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql VOLATILE;
+    """
+    )
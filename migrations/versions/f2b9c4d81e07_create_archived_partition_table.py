@@ -0,0 +1,45 @@
+"""create archived_partition table
+
+Revision ID: f2b9c4d81e07
+Revises: a4c6e2f19d37
+Create Date: 2026-10-19 18:41:05.112834
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "f2b9c4d81e07"
+down_revision = "a4c6e2f19d37"
+branch_labels = None
+depends_on = None
+
+
+table_name = "archived_partition"
+
+
+def upgrade():
+    op.create_table(
+        table_name,
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("category", sa.String(), nullable=False),
+        sa.Column("partition", sa.String(), nullable=False),
+        sa.Column("month_start", sa.DateTime, nullable=False),
+        sa.Column("month_end", sa.DateTime, nullable=False),
+        sa.Column("file_path", sa.String(), nullable=False),
+        sa.Column("row_count", sa.BigInteger(), nullable=False),
+        sa.Column("file_size", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "archived_at", sa.DateTime, nullable=False, server_default=sa.func.now()
+        ),
+    )
+    # queries look for the archived months of a category in their time range
+    op.create_index(
+        "archived_partition_category_month_start_idx",
+        table_name,
+        ["category", "month_start"],
+    )
+
+
+def downgrade():
+    op.drop_table(table_name)
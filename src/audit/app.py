@@ -1,14 +1,14 @@
 import asyncio
-import httpx
 import os
+import time
 from fastapi import FastAPI
+from starlette.datastructures import MutableHeaders
 from contextlib import asynccontextmanager
 from typing import AsyncIterable
 
 from importlib.metadata import entry_points, version
 
 from cdislogging import get_logger
-from gen3authz.client.arborist.async_client import ArboristClient
 
 from . import logger
 from .config import config, DEFAULT_CFG_PATH
@@ -27,8 +27,17 @@ except Exception:
     logger.warning("Unable to load config, using default config...", exc_info=True)
     config.load(config_path=DEFAULT_CFG_PATH)
 
+from .auth.arborist import ArboristClient
+from .auth.keys import refresh_public_keys_loop
 from .pull_from_queue import pull_from_queue_loop
+from .retention import retention_loop
 from .db import initiate_db, DataAccessLayer, get_data_access_layer
+from .export import export_jobs_loop
+from .metrics import REQUEST_DURATION, is_multiprocess, refresh_gauges_loop
+from .models import CATEGORY_TO_MODEL_CLASS
+from .utils.compression import CompressionMiddleware
+from .utils.http import get_async_client, get_http_timeout
+from .utils.timing import start_timings, stop_timings
 
 
 def load_modules(app: FastAPI = None) -> None:
@@ -53,8 +62,12 @@ def app_init() -> FastAPI:
         lifespan=lifespan,
         # root_path=config["DOCS_URL_PREFIX"],
     )
+    app.add_middleware(CompressionMiddleware)
     app.add_middleware(ClientDisconnectMiddleware)
-    app.async_client = httpx.AsyncClient()
+    app.add_middleware(ServerTimingMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    # created at startup, so that it is bound to the event loop that uses it
+    app.async_client = None
 
     # Following will update logger level, propagate, and handlers
     get_logger("audit-service", log_level="debug" if debug == True else "info")
@@ -64,9 +77,10 @@ def app_init() -> FastAPI:
         app.arborist_client = ArboristClient(
             arborist_base_url=os.environ["ARBORIST_URL"],
             logger=logger,
+            timeout=get_http_timeout(),
         )
     else:
-        app.arborist_client = ArboristClient(logger=logger)
+        app.arborist_client = ArboristClient(logger=logger, timeout=get_http_timeout())
 
     load_modules(app)
 
@@ -88,17 +102,62 @@ async def lifespan(app: FastAPI):
     """
     # startup
 
+    # Arborist and token issuer requests share one pool of connections
+    app.async_client = get_async_client()
+    app.arborist_client.async_client = app.async_client
+
     await initiate_db()
     await check_db_connection()
 
-    if config["PULL_FROM_QUEUE"] and config["QUEUE_CONFIG"].get("type") == "aws_sqs":
-        logger.info("Initiating SQS pull.")
-        await initiate_sqs_pull()
+    # when running several workers, only the worker in slot 0 (see the
+    # gunicorn configuration) runs the background jobs, so that they do not
+    # multiply with the number of workers. Queue consumers can instead be
+    # coordinated through the database
+    first_worker = os.environ.get("AUDIT_WORKER_SLOT", "0") == "0"
+    if config["PULL_FROM_QUEUE"] and (
+        config["QUEUE_CONSUMER_COORDINATION"] or first_worker
+    ):
+        logger.info(f"Initiating {config['QUEUE_CONFIG']['type']} queue pull.")
+        await initiate_queue_pull()
+
+    keys_refresh = None
+    if config["JWT_KEYS_REFRESH_SECONDS"]:
+        keys_refresh = asyncio.create_task(refresh_public_keys_loop(app.async_client))
+
+    # in multiprocess mode, `/metrics` only refreshes the gauges of the
+    # worker that handles it, so each worker refreshes its own
+    gauges_refresh = None
+    if is_multiprocess():
+        gauges_refresh = asyncio.create_task(refresh_gauges_loop())
+
+    retention = None
+    if (
+        first_worker
+        and config["RETENTION_POLICY"]
+        and config["RETENTION_INTERVAL_SECONDS"]
+    ):
+        retention = asyncio.create_task(retention_loop())
+
+    export_workers = []
+    if first_worker:
+        export_workers = [
+            asyncio.create_task(export_jobs_loop())
+            for _ in range(config["EXPORT_WORKERS"])
+        ]
 
     yield
 
     # teardown
+    if keys_refresh:
+        keys_refresh.cancel()
+    if gauges_refresh:
+        gauges_refresh.cancel()
+    if retention:
+        retention.cancel()
+    for export_worker in export_workers:
+        export_worker.cancel()
     logger.info("Closing async client.")
+    app.arborist_client.async_client = None
     await app.async_client.aclose()
     logger.info("[Completed] Closing async client.")
 
@@ -123,9 +182,9 @@ async def check_db_connection():
         raise
 
 
-async def initiate_sqs_pull():
+async def initiate_queue_pull():
     """
-    Start the SQS pull loop in the background."""
+    Start the queue pull loop in the background."""
 
     def handle_exception(loop, context):
         """
@@ -144,36 +203,125 @@ async def initiate_sqs_pull():
 
 
 class ClientDisconnectMiddleware:
+    """
+    Allow routes that run long operations, such as audit log queries, to
+    stop when the client disconnects: after the route calls
+    `scope["add_close_watcher"]()`, the request is cancelled when the client
+    disconnects. The route must not read the request body after that.
+
+    Requests that do not opt in, such as audit log creations, do not pay for
+    it: no task is created for them.
+    """
+
     def __init__(self, app):
         self._app = app
 
     async def __call__(self, scope, receive, send):
-        loop = asyncio.get_running_loop()
-        rv = loop.create_task(self._app(scope, receive, send))
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        request_task = None
         waiter = None
         cancelled = False
-        if scope["type"] == "http":
 
-            def add_close_watcher():
-                nonlocal waiter
+        def add_close_watcher():
+            nonlocal request_task, waiter
+            if waiter:
+                return
+            request_task = asyncio.current_task()
 
-                async def wait_closed():
-                    nonlocal cancelled
-                    while True:
-                        message = await receive()
-                        if message["type"] == "http.disconnect":
-                            if not rv.done():
-                                cancelled = True
-                                rv.cancel()
-                            break
+            async def wait_closed():
+                nonlocal cancelled
+                while True:
+                    message = await receive()
+                    if message["type"] == "http.disconnect":
+                        cancelled = True
+                        request_task.cancel()
+                        break
 
-                waiter = loop.create_task(wait_closed())
+            waiter = asyncio.get_running_loop().create_task(wait_closed())
 
-            scope["add_close_watcher"] = add_close_watcher
+        scope["add_close_watcher"] = add_close_watcher
         try:
-            await rv
+            await self._app(scope, receive, send)
         except asyncio.CancelledError:
             if not cancelled:
                 raise
-        if waiter and not waiter.done():
-            waiter.cancel()
+        finally:
+            if waiter and not waiter.done():
+                waiter.cancel()
+            if cancelled:
+                # the cancellation was requested by this middleware, and may
+                # not have been delivered if the request was already done
+                request_task.uncancel()
+
+
+class MetricsMiddleware:
+    """
+    Record the duration of HTTP requests, by route and log category.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self._app(scope, receive, send_wrapper)
+        finally:
+            # the route is set in the scope by the router, once matched. Use
+            # the route's path template instead of the actual path so the
+            # number of label values stays small. For the same reason, unknown
+            # categories in the path are reported as "other".
+            route = scope.get("route")
+            category = scope.get("path_params", {}).get("category", "")
+            if category and category not in CATEGORY_TO_MODEL_CLASS:
+                category = "other"
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                category=category,
+                status_code=status_code,
+            )
+
+
+class ServerTimingMiddleware:
+    """
+    When `SERVER_TIMING` is enabled, report the time spent in each phase of
+    request handling in the `Server-Timing` response header.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not config["SERVER_TIMING"]:
+            await self._app(scope, receive, send)
+            return
+
+        timings = start_timings()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.header_value())
+            await send(message)
+
+        try:
+            await self._app(scope, receive, send_wrapper)
+        finally:
+            stop_timings()
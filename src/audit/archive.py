@@ -0,0 +1,532 @@
+"""
+Archival of cold audit logs. Partitions removed with the `archive` retention
+action (see `audit.retention`) are written to a Parquet file, recorded in the
+`archived_partition` table, and dropped from the database.
+
+Archive files contain all the columns of the partition, ordered by timestamp,
+in row groups of `ARCHIVE_ROW_GROUP_SIZE` logs compressed with zstd. They are
+stored in `ARCHIVE_DIRECTORY`, or uploaded to the `ARCHIVE_S3` bucket if one
+is configured. Logs inserted for a month after it was archived go to a new
+partition, which is archived to another file the next time the retention
+policy is applied.
+
+If `QUERY_ARCHIVES` is enabled, audit log queries whose time range includes
+archived months also read the archive files of these months, and merge their
+logs with the logs from the database. Parquet files store the minimum and
+maximum values of each column in each row group: the time range and the
+filters on scalar fields such as `guid` or `username` are pushed down to the
+Parquet reader, which skips the row groups that cannot match them. Filters on
+array fields, such as `resource_paths` and the authorized resource paths, are
+applied once the row groups are read. Paginated queries read the files in
+timestamp order, one batch at a time, and stop once they have enough logs
+for the page. The files are read while holding one of the query slots, so
+that archive reads count towards `DB_QUERY_POOL_MAX_SIZE`.
+
+Exports (see `audit.export`) only read the logs that are in the database.
+"""
+import asyncio
+import itertools
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import JSON
+
+from . import logger
+from .config import config
+from .db import (
+    cast_field_value,
+    get_data_access_layer,
+    get_next_month,
+    get_partition_month,
+    query_data_access_layer,
+    query_slot,
+)
+from .models import CATEGORY_TO_MODEL_CLASS, ArchivedPartition
+from .utils.columnar import ArrowEncoder, pyarrow
+from .utils.s3 import get_aws_creds, get_s3_client, split_s3_url, upload_file
+
+
+class PartitionChangedError(Exception):
+    """
+    Raised when logs were inserted into a partition while it was being
+    archived.
+    """
+
+
+def _remove_archive_file(file_path: str) -> None:
+    if file_path.startswith("s3://"):
+        bucket, key = split_s3_url(file_path)
+        get_s3_client(config["ARCHIVE_S3"]).delete_object(Bucket=bucket, Key=key)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+
+
+async def archive_partition(category: str, partition: str) -> ArchivedPartition:
+    """
+    Write the logs of a partition to an archive file, and replace the
+    partition with an entry in the `archived_partition` table.
+
+    Raises PartitionChangedError if logs were inserted into the partition
+    while it was being written to the file: it can be archived again later.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[category]
+    month_start = get_partition_month(partition)
+    encoder = ArrowEncoder(model)
+
+    os.makedirs(config["ARCHIVE_DIRECTORY"], exist_ok=True)
+    # the same month may be archived more than once
+    file_path = os.path.join(
+        config["ARCHIVE_DIRECTORY"],
+        f"{partition}_{datetime.now().strftime('%Y%m%d%H%M%S')}.parquet",
+    )
+    try:
+        # one row group per chunk of logs. The partition is read by a single
+        # query, which is not subject to the query statement timeout
+        row_count = 0
+        writer = pyarrow.parquet.ParquetWriter(
+            file_path, encoder.schema, compression="zstd"
+        )
+        try:
+            async with query_data_access_layer(
+                get_next_month(month_start), statement_timeout=0
+            ) as data_access_layer:
+                async for logs in data_access_layer.stream_partition_logs(
+                    model,
+                    partition,
+                    None,
+                    None,
+                    {},
+                    chunk_size=config["ARCHIVE_ROW_GROUP_SIZE"],
+                ):
+                    batch = await asyncio.to_thread(encoder.encode, logs)
+                    await asyncio.to_thread(writer.write_batch, batch)
+                    row_count += len(logs)
+        finally:
+            await asyncio.to_thread(writer.close)
+        file_size = os.path.getsize(file_path)
+        if config["ARCHIVE_S3"].get("bucket"):
+            file_path = await asyncio.to_thread(
+                upload_file, file_path, config["ARCHIVE_S3"]
+            )
+
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.set_lock_timeout(
+                config["RETENTION_LOCK_TIMEOUT_SECONDS"]
+            )
+            # logs can no longer be inserted into the partition. Make sure
+            # none were inserted since it was read
+            if (
+                await data_access_layer.count_partition_logs(partition, lock=True)
+                != row_count
+            ):
+                raise PartitionChangedError(
+                    f"Audit logs were inserted into partition {partition} while it was being archived"
+                )
+            archived_partition = await data_access_layer.create_archived_partition(
+                {
+                    "category": category,
+                    "partition": partition,
+                    "month_start": month_start,
+                    "month_end": get_next_month(month_start),
+                    "file_path": file_path,
+                    "row_count": row_count,
+                    "file_size": file_size,
+                }
+            )
+            await data_access_layer.drop_partition(partition)
+    except BaseException:
+        await asyncio.to_thread(_remove_archive_file, file_path)
+        raise
+
+    logger.info(
+        f"Archived {row_count} audit logs from partition {partition} to {file_path}"
+    )
+    return archived_partition
+
+
+def _get_archive_filesystem(file_path: str) -> Tuple[Any, str]:
+    """
+    Get the filesystem an archive file is stored in (None: the local
+    filesystem), and the path of the file in that filesystem.
+    """
+    if not file_path.startswith("s3://"):
+        return None, file_path
+    aws_creds = get_aws_creds(config["ARCHIVE_S3"])
+    filesystem = pyarrow.fs.S3FileSystem(
+        region=config["ARCHIVE_S3"].get("region"),
+        access_key=aws_creds.get("aws_access_key_id"),
+        secret_key=aws_creds.get("aws_secret_access_key"),
+    )
+    bucket, key = split_s3_url(file_path)
+    return filesystem, f"{bucket}/{key}"
+
+
+def _overlaps(column: "pyarrow.ChunkedArray", values: List[str]) -> "pyarrow.Array":
+    """
+    Same as the Postgres `&&` operator: which rows of a list column contain at
+    least one of the values.
+    """
+    lists = column.combine_chunks()
+    items = pyarrow.compute.list_flatten(lists)
+    matching_rows = pyarrow.compute.filter(
+        pyarrow.compute.list_parent_indices(lists),
+        pyarrow.compute.is_in(items, value_set=pyarrow.array(values, items.type)),
+    )
+    row_indices = pyarrow.compute.subtract(
+        pyarrow.compute.cumulative_sum(pyarrow.repeat(1, len(lists))), 1
+    )
+    return pyarrow.compute.is_in(row_indices, value_set=matching_rows)
+
+
+def _get_archive_filters(
+    model,
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+) -> Tuple[Optional["pyarrow.compute.Expression"], Dict[str, List[str]]]:
+    """
+    Convert the filters (same as `DataAccessLayer._apply_query_filters`) to
+    the expression checked against the row group statistics, and the values
+    of the filters on array fields, which are applied after reading.
+    """
+    field = pyarrow.compute.field
+    conditions = []
+    if start_date:
+        conditions.append(field("timestamp") >= start_date)
+    if stop_date:
+        conditions.append(field("timestamp") < stop_date)
+    overlaps = {}
+    if resource_path_prefixes is not None:
+        overlaps["resource_path_prefixes"] = list(resource_path_prefixes)
+    for name, values in query_params.items():
+        if hasattr(getattr(model, name).type, "item_type"):  # ARRAY
+            overlaps[name] = list(values)
+        else:
+            typed_values = [cast_field_value(model, name, v) for v in values]
+            conditions.append(field(name).isin(typed_values))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression, overlaps
+
+
+def _read_archive_file(
+    archived_partition: ArchivedPartition,
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    columns: Optional[List[str]] = None,
+) -> "pyarrow.Table":
+    """
+    Read the logs of an archive file that match the filters. Only reads the
+    `columns` if provided, and the columns of the filters on array fields.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[archived_partition.category]
+    expression, overlaps = _get_archive_filters(
+        model, start_date, stop_date, query_params, resource_path_prefixes
+    )
+    if columns is not None:
+        columns = list(dict.fromkeys(columns + list(overlaps)))
+    filesystem, path = _get_archive_filesystem(archived_partition.file_path)
+    table = pyarrow.parquet.read_table(
+        path, columns=columns, filters=expression, filesystem=filesystem
+    )
+    for name, values in overlaps.items():
+        table = table.filter(_overlaps(table.column(name), values))
+    return table
+
+
+def _iter_archive_file(
+    archived_partition: ArchivedPartition,
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    batch_size: int,
+) -> Iterator["pyarrow.Table"]:
+    """
+    Same as `_read_archive_file`, one batch of up to `batch_size` logs at a
+    time, in timestamp order, so that the file can be read only until there
+    are enough logs.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[archived_partition.category]
+    expression, overlaps = _get_archive_filters(
+        model, start_date, stop_date, query_params, resource_path_prefixes
+    )
+    filesystem, path = _get_archive_filesystem(archived_partition.file_path)
+    dataset = pyarrow.dataset.dataset(path, format="parquet", filesystem=filesystem)
+    # the batches are returned in the order of the file, which is ordered by
+    # timestamp
+    for batch in dataset.to_batches(filter=expression, batch_size=batch_size):
+        table = pyarrow.Table.from_batches([batch])
+        for name, values in overlaps.items():
+            table = table.filter(_overlaps(table.column(name), values))
+        if table.num_rows:
+            yield table
+
+
+def _decode_json_columns(model, rows: List[dict]) -> List[dict]:
+    for column in model.__table__.columns:
+        if isinstance(column.type, JSON):
+            for row in rows:
+                if row.get(column.name) is not None:
+                    row[column.name] = json.loads(row[column.name])
+    return rows
+
+
+def _read_archived_logs(
+    archived_partition: ArchivedPartition,
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    limit: int,
+) -> Tuple[List[Dict[str, Any]], Optional[datetime]]:
+    """
+    Read the first `limit` logs of an archive file that match the filters,
+    plus the logs with the same timestamp as the last one, in the same format
+    as `AuditLog.to_dict`.
+
+    Returns:
+        (list, datetime): the logs, and the timestamp of the next matching
+        log, or None if all the matching logs were read
+    """
+    model = CATEGORY_TO_MODEL_CLASS[archived_partition.category]
+    logs = []
+    # the timestamp of the `limit`th log, once it is read
+    last_timestamp = None
+    next_timestamp = None
+    for table in _iter_archive_file(
+        archived_partition,
+        start_date,
+        stop_date,
+        query_params,
+        resource_path_prefixes,
+        limit,
+    ):
+        timestamps = table.column("timestamp")
+        if last_timestamp is None and len(logs) + table.num_rows >= limit:
+            last_timestamp = timestamps[limit - len(logs) - 1]
+        if last_timestamp is not None:
+            end = pyarrow.compute.index(
+                pyarrow.compute.greater(timestamps, last_timestamp), True
+            ).as_py()
+            if end != -1:
+                next_timestamp = timestamps[end].as_py()
+                table = table.slice(0, end)
+        table = table.drop_columns(
+            [name for name in model.INTERNAL_COLUMNS if name in table.column_names]
+        )
+        logs.extend(_decode_json_columns(model, table.to_pylist()))
+        if next_timestamp is not None:
+            break
+    return logs, next_timestamp
+
+
+async def merge_archived_logs(
+    archived_partitions: List[ArchivedPartition],
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    logs: List[Dict[str, Any]],
+    next_timestamp: Optional[int],
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Merge a page of logs from the database (see `DataAccessLayer.query_logs`)
+    with the matching logs of the archived partitions. Returns the first
+    `QUERY_PAGE_SIZE` logs, plus the logs with the same timestamp as the last
+    one, and the timestamp of the next log.
+
+    Archived months are read in order, and each file only until there are
+    enough logs for the page. The files are read while holding a query slot
+    (see `audit.db.query_slot`).
+    """
+    if next_timestamp is not None:
+        # the logs after the page from the database belong to the next pages
+        next_date = datetime.fromtimestamp(next_timestamp)
+        stop_date = min(stop_date, next_date) if stop_date else next_date
+
+    page_size = config["QUERY_PAGE_SIZE"]
+    archived_logs = []
+    # the earliest logs that were not read: in the files that were not read
+    # until the end, or in the months that were not read
+    unread_dates = []
+    async with query_slot():
+        # `archived_partitions` are ordered by month
+        for month_start, month_partitions in itertools.groupby(
+            archived_partitions, key=lambda partition: partition.month_start
+        ):
+            if stop_date and month_start >= stop_date:
+                break
+            # the logs of the previous months come first
+            limit = page_size - len(archived_logs)
+            if limit <= 0:
+                unread_dates.append(month_start)
+                break
+            for archived_partition in month_partitions:
+                partition_logs, unread_date = await asyncio.to_thread(
+                    _read_archived_logs,
+                    archived_partition,
+                    start_date,
+                    stop_date,
+                    query_params,
+                    resource_path_prefixes,
+                    limit,
+                )
+                archived_logs.extend(partition_logs)
+                if unread_date:
+                    unread_dates.append(unread_date)
+    if not archived_logs:
+        return logs, next_timestamp
+
+    logs = sorted(logs + archived_logs, key=lambda log: log["timestamp"])
+    # same as `DataAccessLayer.query_logs`: also return the logs with the
+    # same timestamp as the last log of the page. The logs that were not read
+    # are after the `page_size` first logs of each file, so they are after
+    # the page
+    end = min(page_size, len(logs))
+    while end < len(logs) and logs[end]["timestamp"] == logs[end - 1]["timestamp"]:
+        end += 1
+    if end < len(logs):
+        unread_dates.append(logs[end]["timestamp"])
+    if unread_dates:
+        next_date = min(unread_dates)
+        if next_timestamp is None or datetime.timestamp(next_date) < next_timestamp:
+            next_timestamp = int(datetime.timestamp(next_date))
+    return logs[:end], next_timestamp
+
+
+async def count_archived_logs(
+    archived_partitions: List[ArchivedPartition],
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+) -> int:
+    """
+    Count the logs of the archived partitions that match the filters. The
+    files are read while holding a query slot (see `audit.db.query_slot`).
+    """
+    count = 0
+    to_read = []
+    for archived_partition in archived_partitions:
+        if (
+            not query_params
+            and resource_path_prefixes is None
+            and (not start_date or archived_partition.month_start >= start_date)
+            and (not stop_date or archived_partition.month_end <= stop_date)
+        ):
+            # all the logs of the partition match
+            count += archived_partition.row_count
+        else:
+            to_read.append(archived_partition)
+    if not to_read:
+        return count
+    async with query_slot():
+        for archived_partition in to_read:
+            table = await asyncio.to_thread(
+                _read_archive_file,
+                archived_partition,
+                start_date,
+                stop_date,
+                query_params,
+                resource_path_prefixes,
+                ["timestamp"],
+            )
+            count += table.num_rows
+    return count
+
+
+def _group_archived_logs(
+    archived_partition: ArchivedPartition,
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    groupby: List[str],
+) -> List[Dict[str, Any]]:
+    """
+    Same as `DataAccessLayer.query_logs_with_grouping`, for an archive file.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[archived_partition.category]
+    columns = list(dict.fromkeys(groupby + ["username"]))
+    table = _read_archive_file(
+        archived_partition,
+        start_date,
+        stop_date,
+        query_params,
+        resource_path_prefixes,
+        columns,
+    ).select(columns)
+    list_columns = [
+        name for name in groupby if pyarrow.types.is_list(table.schema.field(name).type)
+    ]
+    if not list_columns:
+        grouped = table.group_by(groupby).aggregate([("username", "count")])
+        groups = [
+            {**{name: row[name] for name in groupby}, "count": row["username_count"]}
+            for row in grouped.to_pylist()
+        ]
+    else:
+        # Arrow cannot group by list columns
+        groups = {}
+        for row in table.to_pylist():
+            group = groups.setdefault(
+                _get_group_key(row, groupby),
+                {**{name: row[name] for name in groupby}, "count": 0},
+            )
+            if row["username"] is not None:
+                group["count"] += 1
+        groups = list(groups.values())
+    return _decode_json_columns(model, groups)
+
+
+def _get_group_key(group: Dict[str, Any], groupby: List[str]) -> str:
+    return json.dumps([group[name] for name in groupby], default=str, sort_keys=True)
+
+
+async def merge_archived_groups(
+    archived_partitions: List[ArchivedPartition],
+    start_date: Optional[datetime],
+    stop_date: Optional[datetime],
+    query_params: Dict[str, List[str]],
+    resource_path_prefixes: Optional[List[str]],
+    groupby: Set[str],
+    groups: List[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """
+    Add the matching logs of the archived partitions to the groups of logs
+    from the database (see `DataAccessLayer.query_logs_with_grouping`). The
+    files are read while holding a query slot (see `audit.db.query_slot`).
+    """
+    # the same column order for all the groups
+    groupby = sorted(groupby)
+    merged = {}
+    archived_groups = []
+    async with query_slot():
+        for archived_partition in archived_partitions:
+            archived_groups.extend(
+                await asyncio.to_thread(
+                    _group_archived_logs,
+                    archived_partition,
+                    start_date,
+                    stop_date,
+                    query_params,
+                    resource_path_prefixes,
+                    groupby,
+                )
+            )
+    for group in itertools.chain(groups, archived_groups):
+        key = _get_group_key(group, groupby)
+        if key in merged:
+            merged[key]["count"] += group["count"]
+        else:
+            # the groups from the database may be shared with other requests
+            merged[key] = dict(group)
+    return list(merged.values())
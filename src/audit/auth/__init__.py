@@ -1,3 +1,9 @@
+import base64
+import hashlib
+import json
+import time
+from typing import List, Optional
+
 from authutils.token.fastapi import access_token
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -7,6 +13,11 @@ from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 from gen3authz.client.arborist.errors import ArboristError
 
 from .. import logger
+from ..config import config
+from ..metrics import AUTHZ_CACHE_REQUESTS
+from ..utils.cache import TTLCache
+from ..utils.timing import timed
+from .keys import prefetch_public_keys
 
 
 # auto_error=False prevents FastAPI from raising a 403 when the request
@@ -14,6 +25,72 @@ from .. import logger
 # to signify that we did not recieve valid credentials
 bearer = HTTPBearer(auto_error=False)
 
+# positive authorization decisions, by (token hash, method, resources)
+authz_decisions = None
+# validated token claims, by token hash
+token_claims_cache = None
+# arborist auth mappings, by token hash
+auth_mappings = None
+
+
+def _get_authz_decisions() -> TTLCache:
+    global authz_decisions
+    if authz_decisions is None:
+        authz_decisions = TTLCache(
+            config["AUTHZ_CACHE_MAX_SIZE"], config["AUTHZ_CACHE_TTL_SECONDS"]
+        )
+    return authz_decisions
+
+
+def _get_auth_mappings() -> TTLCache:
+    global auth_mappings
+    if auth_mappings is None:
+        auth_mappings = TTLCache(
+            config["AUTHZ_CACHE_MAX_SIZE"], config["AUTHZ_CACHE_TTL_SECONDS"]
+        )
+    return auth_mappings
+
+
+def _get_token_claims_cache() -> TTLCache:
+    global token_claims_cache
+    if token_claims_cache is None:
+        token_claims_cache = TTLCache(
+            config["TOKEN_CACHE_MAX_SIZE"], config["TOKEN_CACHE_TTL_SECONDS"]
+        )
+    return token_claims_cache
+
+
+def clear_auth_caches() -> None:
+    for cache in (authz_decisions, token_claims_cache, auth_mappings):
+        if cache is not None:
+            cache.clear()
+
+
+def _hash_token(token: Optional[str]) -> Optional[str]:
+    """
+    Tokens are not kept in memory as-is, only their hash.
+    """
+    if not token:
+        return None
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _token_expires_in(token: Optional[str]) -> Optional[float]:
+    """
+    Number of seconds before the token expires, or None if unknown. The token
+    is not validated here: this is only used to make sure cached decisions do
+    not outlive the token.
+    """
+    if not token:
+        return None
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return claims["exp"] - time.time()
+    except Exception:
+        return None
+
 
 class Auth:
     def __init__(
@@ -22,7 +99,16 @@ class Auth:
         bearer_token: HTTPAuthorizationCredentials = Security(bearer),
     ):
         self.arborist_client = request.app.arborist_client
+        self.async_client = request.app.async_client
         self.bearer_token = bearer_token
+        self.auth_mapping = None
+
+    def _get_token(self) -> Optional[str]:
+        return (
+            self.bearer_token.credentials
+            if self.bearer_token and hasattr(self.bearer_token, "credentials")
+            else None
+        )
 
     async def get_token_claims(self) -> dict:
         if not self.bearer_token:
@@ -33,12 +119,28 @@ class Auth:
                 err_msg,
             )
 
+        # tokens that were validated recently are not validated again
+        token_hash = _hash_token(self.bearer_token.credentials)
+        use_cache = config["TOKEN_CACHE_TTL_SECONDS"] > 0
+        if use_cache:
+            token_claims = _get_token_claims_cache().get(token_hash)
+            if token_claims:
+                return dict(token_claims)
+
         try:
-            # NOTE: token can be None if no Authorization header was provided, we
-            # expect this to cause a downstream exception since it is invalid
-            token_claims = await access_token("user", "openid", purpose="access")(
-                self.bearer_token
-            )
+            with timed("auth-jwt"):
+                if self.async_client:
+                    await prefetch_public_keys(
+                        self.async_client, self.bearer_token.credentials
+                    )
+                # NOTE: token can be None if no Authorization header was provided,
+                # we expect this to cause a downstream exception since it is invalid
+                token_claims = await access_token(
+                    "user",
+                    "openid",
+                    allowed_issuers=config["ALLOWED_ISSUERS"] or None,
+                    purpose="access",
+                )(self.bearer_token)
         except Exception as e:
             logger.error(
                 f"Could not get token claims:\n{e.detail if hasattr(e, 'detail') else e}",
@@ -49,6 +151,10 @@ class Auth:
                 "Could not verify, parse, and/or validate scope from provided access token.",
             )
 
+        if use_cache and token_claims.get("exp"):
+            _get_token_claims_cache().set(
+                token_hash, dict(token_claims), ttl=token_claims["exp"] - time.time()
+            )
         return token_claims
 
     async def authorize(
@@ -57,20 +163,30 @@ class Auth:
         resources: list,
         throw: bool = True,
     ) -> bool:
-        token = (
-            self.bearer_token.credentials
-            if self.bearer_token and hasattr(self.bearer_token, "credentials")
-            else None
-        )
+        token = self._get_token()
+
+        # only positive decisions are cached, so that users who are granted
+        # access do not have to wait for the cache to expire
+        cache_key = (_hash_token(token), method, tuple(sorted(resources)))
+        use_cache = config["AUTHZ_CACHE_TTL_SECONDS"] > 0
+        if use_cache and _get_authz_decisions().get(cache_key):
+            AUTHZ_CACHE_REQUESTS.inc(result="hit")
+            return True
+        if use_cache:
+            AUTHZ_CACHE_REQUESTS.inc(result="miss")
 
         try:
-            authorized = await self.arborist_client.auth_request(
-                token, "audit", method, resources
-            )
+            with timed("auth-arborist"):
+                authorized = await self.arborist_client.auth_request(
+                    token, "audit", method, resources
+                )
         except ArboristError as e:
             logger.error(f"Error while talking to arborist: {e}")
             authorized = False
 
+        if authorized and use_cache:
+            _get_authz_decisions().set(cache_key, True, ttl=_token_expires_in(token))
+
         if not authorized:
             logger.error(
                 f"Authorization error: user must have '{method}' access on {resources} for service 'audit'."
@@ -82,3 +198,40 @@ class Auth:
                 )
 
         return authorized
+
+    async def get_authorized_resource_paths(self, method: str) -> List[str]:
+        """
+        Get the paths of the resources on which the user has `method` access
+        for service "audit", from the user's Arborist auth mapping. The auth
+        mapping is only fetched once per request. Like authorization
+        decisions, only non-empty mappings are cached.
+        """
+        if self.auth_mapping is None:
+            token = self._get_token()
+            token_hash = _hash_token(token)
+            use_cache = config["AUTHZ_CACHE_TTL_SECONDS"] > 0
+            if use_cache:
+                self.auth_mapping = _get_auth_mappings().get(token_hash)
+            if self.auth_mapping is None:
+                try:
+                    with timed("auth-arborist"):
+                        self.auth_mapping = await self.arborist_client.auth_mapping(
+                            jwt=token or ""
+                        )
+                except ArboristError as e:
+                    logger.error(f"Error while talking to arborist: {e}")
+                    return []
+                if use_cache and self.auth_mapping:
+                    _get_auth_mappings().set(
+                        token_hash, self.auth_mapping, ttl=_token_expires_in(token)
+                    )
+
+        return [
+            resource_path
+            for resource_path, permissions in self.auth_mapping.items()
+            if any(
+                permission.get("service") in ("audit", "*")
+                and permission.get("method") in (method, "*")
+                for permission in permissions
+            )
+        ]
@@ -0,0 +1,41 @@
+"""
+Arborist client that sends its requests through the app's shared HTTP client.
+
+`gen3authz`'s async `ArboristClient` opens a new `httpx.AsyncClient` for each
+request, so each authorization check pays for a new connection to Arborist.
+"""
+from typing import Optional
+
+import httpx
+from gen3authz.client.arborist.async_client import (
+    ArboristClient as BaseArboristClient,
+)
+
+
+class _SharedClient:
+    """
+    Same interface as `httpx.AsyncClient` as a context manager, but does not
+    close the client on exit.
+    """
+
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+
+    async def __aenter__(self) -> httpx.AsyncClient:
+        return self.client
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+
+class ArboristClient(BaseArboristClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # set by the app at startup, and unset at shutdown. When not set, a
+        # new client is used for each request
+        self.async_client: Optional[httpx.AsyncClient] = None
+
+    def client_cls(self):
+        if self.async_client is None:
+            return httpx.AsyncClient()
+        return _SharedClient(self.async_client)
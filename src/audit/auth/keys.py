@@ -0,0 +1,115 @@
+"""
+Public keys used to validate access tokens.
+
+`authutils` fetches the public keys of a token issuer the first time it sees
+a token from this issuer, and then keeps them in memory forever, so new keys
+added by a key rotation are not picked up. Here, the keys of the allowed
+issuers are refreshed in the background, and stored back in `authutils`'
+cache so that token validation never has to wait for a key fetch.
+
+The keys of new issuers are also fetched here, before `authutils` sees the
+token, so that all the requests to the issuers go through the app's shared
+HTTP client instead of a new connection.
+
+Only the issuers in `ALLOWED_ISSUERS` are fetched and refreshed: the issuer
+of a token is read before the token is validated, so it cannot be trusted.
+
+NOTE: `authutils` does not provide a way to populate its key cache, so its
+private `_jwt_public_keys` dict is used. The `authutils` version is pinned
+accordingly in pyproject.toml.
+"""
+import asyncio
+from collections import OrderedDict
+
+import httpx
+from authutils.token import fastapi as authutils_fastapi
+from authutils.token.core import get_iss
+from authutils.token.keys import get_pem_key
+from fastapi import HTTPException
+from starlette.status import HTTP_403_FORBIDDEN
+
+from .. import logger
+from ..config import config
+
+
+async def _get_keys_url(client: httpx.AsyncClient, issuer: str) -> str:
+    """
+    Same as `authutils.token.core.get_keys_url`, without blocking the event
+    loop: prefer the OIDC discovery doc, but fall back on Fence-specific
+    /jwt/keys.
+    """
+    try:
+        resp = await client.get(
+            "/".join([issuer.strip("/"), ".well-known", "openid-configuration"])
+        )
+        jwks_uri = resp.json().get("jwks_uri")
+        if jwks_uri:
+            return jwks_uri
+    except Exception:
+        pass
+    return "/".join([issuer.strip("/"), "jwt", "keys"])
+
+
+async def _fetch_public_keys(client: httpx.AsyncClient, issuer: str) -> OrderedDict:
+    resp = await client.get(await _get_keys_url(client, issuer))
+    resp.raise_for_status()
+    return OrderedDict(get_pem_key(key) for key in resp.json()["keys"])
+
+
+async def prefetch_public_keys(client: httpx.AsyncClient, token: str) -> None:
+    """
+    Fetch the public keys of the issuer of the token if they were never
+    fetched. Errors are ignored: the token is not validated here, and
+    `authutils` reports invalid tokens, unavailable keys and issuers that are
+    not allowed.
+    """
+    try:
+        issuer = get_iss(token)
+    except Exception:
+        return
+    if (
+        issuer not in config["ALLOWED_ISSUERS"]
+        or issuer in authutils_fastapi._jwt_public_keys
+    ):
+        return
+
+    # same as `authutils`: concurrent requests wait for the same fetch
+    pub_keys = asyncio.get_running_loop().create_future()
+    authutils_fastapi._jwt_public_keys[issuer] = pub_keys
+    try:
+        pub_keys.set_result(await _fetch_public_keys(client, issuer))
+    except Exception as e:
+        logger.error(f"Unable to fetch the public keys of issuer {issuer}: {e}")
+        # let `authutils` try again for the next tokens
+        authutils_fastapi._jwt_public_keys.pop(issuer, None)
+        pub_keys.set_exception(
+            HTTPException(
+                HTTP_403_FORBIDDEN,
+                f"Cannot fetch pubkey from issuer {issuer}: {e}",
+            )
+        )
+
+
+async def refresh_public_keys(client: httpx.AsyncClient) -> None:
+    """
+    Fetch the current public keys of the allowed token issuers. If the keys
+    of an issuer cannot be fetched, the previous keys are kept.
+    """
+    loop = asyncio.get_running_loop()
+    for issuer in config["ALLOWED_ISSUERS"]:
+        try:
+            keys = await _fetch_public_keys(client, issuer)
+        except Exception as e:
+            logger.error(f"Unable to refresh the public keys of issuer {issuer}: {e}")
+            continue
+        pub_keys = loop.create_future()
+        pub_keys.set_result(keys)
+        authutils_fastapi._jwt_public_keys[issuer] = pub_keys
+        logger.debug(f"Refreshed the public keys of issuer {issuer}: {list(keys)}")
+
+
+async def refresh_public_keys_loop(client: httpx.AsyncClient) -> None:
+    interval = config["JWT_KEYS_REFRESH_SECONDS"]
+    while True:
+        await asyncio.sleep(interval)
+        await refresh_public_keys(client)
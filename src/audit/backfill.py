@@ -0,0 +1,71 @@
+"""
+The `resource_path_prefixes` column of the `presigned_url` logs (see
+`audit.models.get_resource_path_prefixes`) is set when the logs are created.
+The logs created before the column was added are backfilled separately from
+the migration that added it: one partition at a time, in batches of
+`--batch-blocks` blocks that are each committed right away, so that the logs
+of a whole month are not locked and rewritten in a single transaction while
+the service is running.
+
+Until the backfill is complete, users who can only read the logs of some
+resources (see `audit.routes.query.get_authorized_scope`) do not get the
+older logs. The backfill can be stopped and run again: logs that already
+have their prefixes are skipped.
+
+Usage: python -m audit.backfill [--batch-blocks <number of blocks>]
+"""
+import argparse
+import asyncio
+
+from . import logger
+from .db import get_data_access_layer, initiate_db
+from .models import PresignedUrl
+
+
+async def backfill_resource_path_prefixes(batch_blocks: int = 1000) -> int:
+    """
+    Returns:
+        int: the number of updated logs
+    """
+    async for data_access_layer in get_data_access_layer():
+        partitions = await data_access_layer.get_partitions(PresignedUrl)
+
+    total_updated = 0
+    for partition in partitions:
+        # new logs get their prefixes when they are created, so only the
+        # blocks that exist now need to be backfilled
+        async for data_access_layer in get_data_access_layer():
+            blocks = await data_access_layer.get_partition_blocks(partition)
+        updated = 0
+        for start_block in range(0, blocks, batch_blocks):
+            async for data_access_layer in get_data_access_layer():
+                updated += await data_access_layer.backfill_resource_path_prefixes(
+                    partition, start_block, start_block + batch_blocks
+                )
+        logger.info(
+            f"Backfilled resource_path_prefixes of {updated} logs in {partition}"
+        )
+        total_updated += updated
+    return total_updated
+
+
+async def main(args) -> None:
+    await initiate_db()
+    updated = await backfill_resource_path_prefixes(args.batch_blocks)
+    print(f"Backfilled resource_path_prefixes of {updated} logs")
+
+
+if __name__ == "__main__":
+    # load the configuration
+    from . import app
+
+    parser = argparse.ArgumentParser(
+        description="Backfill the resource_path_prefixes of existing presigned_url logs"
+    )
+    parser.add_argument(
+        "--batch-blocks",
+        type=int,
+        default=1000,
+        help="number of table blocks (8kB by default) updated per transaction",
+    )
+    asyncio.run(main(parser.parse_args()))
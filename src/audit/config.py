@@ -25,6 +25,20 @@ class AuditServiceConfig(Config):
             ),
         )
 
+        # generate DB_READ_URL from DB configs if a read replica is configured:
+        # same database and credentials as the primary, on another host
+        read_host = os.environ.get("DB_READ_HOST", self["DB_READ_HOST"])
+        self["DB_READ_URL"] = (
+            self["DB_URL"].set(
+                host=read_host,
+                port=os.environ.get(
+                    "DB_READ_PORT", self["DB_READ_PORT"] or self["DB_URL"].port
+                ),
+            )
+            if read_host
+            else None
+        )
+
     def validate(self, logger) -> None:
         """
         Perform a series of sanity checks on a loaded config.
@@ -46,10 +60,54 @@ class AuditServiceConfig(Config):
                     assert (
                         aws_sqs_config["aws_cred"] in config["AWS_CREDENTIALS"]
                     ), f"The 'QUEUE_CONFIG.aws_sqs_config.aws_cred' value '{aws_sqs_config['aws_cred']}' is not configured in 'AWS_CREDENTIALS'"
+            elif queue_type == "postgres":
+                # the `queue_message` table of the audit database
+                pass
+            elif queue_type == "local":
+                # nothing outside the service process can send logs to it
+                raise Exception(
+                    "'PULL_FROM_QUEUE' cannot be enabled with 'type' == 'local': the in-memory queue is only meant for tests and benchmarks, use 'type' == 'postgres' to run without AWS"
+                )
             else:
                 raise Exception(
                     f"Config 'QUEUE_CONFIG.type': unknown queue type '{queue_type}'"
                 )
+            if self["QUEUE_VISIBILITY_HEARTBEAT_SECONDS"]:
+                assert (
+                    self["QUEUE_VISIBILITY_HEARTBEAT_SECONDS"]
+                    < self["QUEUE_VISIBILITY_TIMEOUT_SECONDS"]
+                ), f"'QUEUE_VISIBILITY_HEARTBEAT_SECONDS' should be lower than 'QUEUE_VISIBILITY_TIMEOUT_SECONDS'"
+            if self["QUEUE_CONSUMER_COORDINATION"]:
+                assert (
+                    self["QUEUE_MAX_CONSUMERS"] >= 1
+                ), f"'QUEUE_CONSUMER_COORDINATION' is enabled, but 'QUEUE_MAX_CONSUMERS' is lower than 1"
+
+        assert isinstance(
+            self["ALLOWED_ISSUERS"], list
+        ), f"'ALLOWED_ISSUERS' should be a list of token issuers"
+
+        # imported here because the models import the config
+        from .models import CATEGORY_TO_MODEL_CLASS
+
+        for category, policy in self["RETENTION_POLICY"].items():
+            assert (
+                category in CATEGORY_TO_MODEL_CLASS
+            ), f"'RETENTION_POLICY': unknown log category '{category}', should be one of: {', '.join(CATEGORY_TO_MODEL_CLASS)}"
+            assert (
+                policy.get("months", 0) >= 1
+            ), f"'RETENTION_POLICY.{category}.months' should be at least 1"
+            assert policy.get("action") in (
+                "drop",
+                "detach",
+                "archive",
+            ), f"'RETENTION_POLICY.{category}.action' should be one of: drop, detach, archive"
+
+        for s3_setting in ("EXPORT_S3", "ARCHIVE_S3"):
+            aws_cred = self[s3_setting].get("aws_cred")
+            if aws_cred:
+                assert (
+                    aws_cred in config["AWS_CREDENTIALS"]
+                ), f"The '{s3_setting}.aws_cred' value '{aws_cred}' is not configured in 'AWS_CREDENTIALS'"
 
 
 config = AuditServiceConfig(DEFAULT_CFG_PATH)
@@ -27,11 +27,35 @@ What do we do in this file?
   a fresh session from the session maker factory
     - This is what gets injected into endpoint code using FastAPI's dep injections
 """
+import asyncio
 from contextlib import asynccontextmanager
+from functools import lru_cache
+import json
+import os
+import random
+import time
 from typing import Any, Dict, AsyncGenerator, List, Tuple, Optional
-from datetime import datetime
-from sqlalchemy import text, select, func, or_
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    Column,
+    MetaData,
+    Table,
+    and_,
+    delete,
+    func,
+    or_,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.engine import Result
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.orm import aliased
 from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
     AsyncEngine,
     AsyncSession,
     async_sessionmaker,
@@ -39,11 +63,102 @@ from sqlalchemy.ext.asyncio import (
 )
 
 from audit.config import config
-from audit.models import PresignedUrl, Login
+from audit.models import (
+    ArchivedPartition,
+    AuditLog,
+    ExportJob,
+    PresignedUrl,
+    Login,
+    PostgresQueueMessage,
+    QuarantinedMessage,
+    get_resource_path_prefixes,
+)
+from audit.metrics import (
+    DB_CONNECTION_WAIT,
+    DB_POOL_CHECKED_IN,
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_OVERFLOW,
+    DB_POOL_SIZE,
+    DB_QUERY_DURATION,
+    DB_READ_QUERIES,
+    LOGS_INGESTED,
+    QUERIES_CANCELLED,
+    QUERIES_REJECTED,
+    QUERIES_TOO_EXPENSIVE,
+)
+from audit.utils.dedup import remember_inserted, was_recently_inserted
+from audit.utils.timing import timed
 from audit import logger
 
 engine = None
 async_sessionmaker_instance = None
+# optional read replica, used for audit log queries
+read_engine = None
+read_async_sessionmaker_instance = None
+# (time of the last check, replication lag in seconds or None if unknown)
+replica_lag = (0, None)
+# audit log queries have their own connection pool on the primary, so that
+# they cannot hold the connections needed to ingest audit logs
+query_engine = None
+query_async_sessionmaker_instance = None
+# limits the number of queries running at the same time to the size of the
+# query connection pool
+query_slots = None
+# export jobs have their own connection pools (on the primary, and on the read
+# replica if there is one), so that they never wait for the connections or the
+# admission slots of the audit log queries
+export_engine = None
+export_async_sessionmaker_instance = None
+export_read_engine = None
+export_read_async_sessionmaker_instance = None
+
+
+# Postgres error code when a statement is cancelled because of
+# `statement_timeout`
+QUERY_CANCELED = "57014"
+# Postgres error code when a lock cannot be acquired within `lock_timeout`
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class QueryRejectedError(Exception):
+    """
+    Raised when a query cannot run because too many queries are already
+    running.
+    """
+
+
+class QueryTooExpensiveError(ValueError):
+    """
+    Raised when a query is estimated to be too expensive to run, or was
+    cancelled because it ran for too long. The client should narrow the
+    query down.
+    """
+
+
+def get_pool_sizes(prefix: str = "DB_POOL") -> Tuple[int, int]:
+    """
+    Get the min and max size of one of this process' DB connection pools,
+    from the `<prefix>_MIN_SIZE` and `<prefix>_MAX_SIZE` settings.
+
+    These settings are the sizes for the whole service instance: when running
+    several workers (`AUDIT_WORKERS` environment variable, set by the gunicorn
+    configuration), they are divided across the workers so that the number of
+    connections to the database does not grow with the number of workers.
+    """
+    workers = max(1, int(os.environ.get("AUDIT_WORKERS") or 1))
+    min_size = config.get(f"{prefix}_MIN_SIZE", 15)
+    max_size = config[f"{prefix}_MAX_SIZE"]
+    if workers > 1:
+        if max_size < workers:
+            logger.warning(
+                f"{prefix}_MAX_SIZE ({max_size}) is lower than the number of workers ({workers}): each worker can open 1 DB connection"
+            )
+        max_size = max(1, max_size // workers)
+        min_size = min(max_size, max(1, min_size // workers))
+        logger.info(
+            f"{prefix} size for each of the {workers} workers: min {min_size}, max {max_size}"
+        )
+    return min_size, max_size
 
 
 async def initiate_db() -> None:
@@ -51,11 +166,16 @@ async def initiate_db() -> None:
     Initialize the database enigne.
     """
     global engine, async_sessionmaker_instance
+    global read_engine, read_async_sessionmaker_instance, replica_lag
+    global query_engine, query_async_sessionmaker_instance, query_slots
+    global export_engine, export_async_sessionmaker_instance
+    global export_read_engine, export_read_async_sessionmaker_instance
     logger.info(f"DB_URL: {config['DB_URL']}")
+    pool_min_size, pool_max_size = get_pool_sizes()
     engine = create_async_engine(
         url=config["DB_URL"],
-        pool_size=config.get("DB_POOL_MIN_SIZE", 15),
-        max_overflow=config["DB_POOL_MAX_SIZE"] - config["DB_POOL_MIN_SIZE"],
+        pool_size=pool_min_size,
+        max_overflow=pool_max_size - pool_min_size,
         echo=config["DB_ECHO"],
         connect_args={"ssl": config["DB_SSL"]} if config["DB_SSL"] else {},
         pool_pre_ping=True,
@@ -66,6 +186,85 @@ async def initiate_db() -> None:
         bind=engine, expire_on_commit=False
     )
 
+    # queries run on the read replica if there is one, and on the primary
+    # otherwise. Either way, they use a separate pool
+    query_pool_min_size, query_pool_max_size = get_pool_sizes("DB_QUERY_POOL")
+    query_engine = create_async_engine(
+        url=config["DB_URL"],
+        pool_size=query_pool_min_size,
+        max_overflow=query_pool_max_size - query_pool_min_size,
+        echo=config["DB_ECHO"],
+        connect_args={"ssl": config["DB_SSL"]} if config["DB_SSL"] else {},
+        pool_pre_ping=True,
+    )
+    query_async_sessionmaker_instance = async_sessionmaker(
+        bind=query_engine, expire_on_commit=False
+    )
+    query_slots = asyncio.Semaphore(query_pool_max_size)
+
+    read_engine = read_async_sessionmaker_instance = None
+    replica_lag = (0, None)
+    if config["DB_READ_URL"]:
+        logger.info(f"DB_READ_URL: {config['DB_READ_URL']}")
+        read_engine = create_async_engine(
+            url=config["DB_READ_URL"],
+            pool_size=query_pool_min_size,
+            max_overflow=query_pool_max_size - query_pool_min_size,
+            echo=config["DB_ECHO"],
+            connect_args={"ssl": config["DB_SSL"]} if config["DB_SSL"] else {},
+            pool_pre_ping=True,
+        )
+        read_async_sessionmaker_instance = async_sessionmaker(
+            bind=read_engine, expire_on_commit=False
+        )
+
+    # each running export job uses one connection at a time. Export jobs only
+    # run in one of the workers (see `audit.app`), so the pool size is not
+    # divided across workers, and the pools of the other workers stay empty
+    export_engine = create_async_engine(
+        url=config["DB_URL"],
+        pool_size=config["EXPORT_WORKERS"],
+        max_overflow=0,
+        echo=config["DB_ECHO"],
+        connect_args={"ssl": config["DB_SSL"]} if config["DB_SSL"] else {},
+        pool_pre_ping=True,
+    )
+    export_async_sessionmaker_instance = async_sessionmaker(
+        bind=export_engine, expire_on_commit=False
+    )
+    export_read_engine = export_read_async_sessionmaker_instance = None
+    if config["DB_READ_URL"]:
+        export_read_engine = create_async_engine(
+            url=config["DB_READ_URL"],
+            pool_size=config["EXPORT_WORKERS"],
+            max_overflow=0,
+            echo=config["DB_ECHO"],
+            connect_args={"ssl": config["DB_SSL"]} if config["DB_SSL"] else {},
+            pool_pre_ping=True,
+        )
+        export_read_async_sessionmaker_instance = async_sessionmaker(
+            bind=export_read_engine, expire_on_commit=False
+        )
+
+    # the read replica pools are not reported when there is no read replica
+    pools = {
+        "ingest": engine,
+        "query": query_engine,
+        "read": read_engine,
+        "export": export_engine,
+        "export_read": export_read_engine,
+    }
+    for pool, pool_engine in pools.items():
+        for gauge, method in (
+            (DB_POOL_SIZE, "size"),
+            (DB_POOL_CHECKED_OUT, "checkedout"),
+            (DB_POOL_CHECKED_IN, "checkedin"),
+            (DB_POOL_OVERFLOW, "overflow"),
+        ):
+            gauge.set_function(
+                getattr(pool_engine.pool, method) if pool_engine else None, pool=pool
+            )
+
 
 def get_db_engine_and_sessionmaker() -> tuple[AsyncEngine, async_sessionmaker]:
     """
@@ -77,6 +276,162 @@ def get_db_engine_and_sessionmaker() -> tuple[AsyncEngine, async_sessionmaker]:
     return engine, async_sessionmaker_instance
 
 
+async def get_replica_lag() -> Optional[float]:
+    """
+    Get the replication lag of the read replica, in seconds, or None if it
+    is unknown. The lag is checked at most every `DB_READ_LAG_CHECK_SECONDS`.
+
+    The lag is the time since the last transaction replayed by the replica,
+    so it grows when there is no write on the primary: the replica is then
+    considered late, and queries use the primary.
+    """
+    global replica_lag
+    checked_at, lag = replica_lag
+    if time.time() - checked_at < config["DB_READ_LAG_CHECK_SECONDS"]:
+        return lag
+
+    lag = None
+    try:
+        async with read_engine.connect() as connection:
+            result = await connection.execute(
+                text(
+                    """
+                    SELECT CASE WHEN pg_is_in_recovery()
+                        THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                        ELSE 0
+                    END
+                    """
+                )
+            )
+            lag = result.scalar()
+            lag = float(lag) if lag is not None else None
+    except Exception as e:
+        logger.error(f"Unable to get the replication lag of the read replica: {e}")
+    replica_lag = (time.time(), lag)
+    return lag
+
+
+async def use_read_replica(stop_date: Optional[datetime]) -> bool:
+    """
+    Whether a query on logs older than `stop_date` (None: up to now) can use
+    the read replica. The replica is used if its replication lag is at most
+    `DB_READ_MAX_LAG_SECONDS`, or if the queried time window is entirely
+    older than the lag.
+    """
+    if read_async_sessionmaker_instance is None:
+        return False
+    lag = await get_replica_lag()
+    if lag is None:
+        return False
+    if lag <= config["DB_READ_MAX_LAG_SECONDS"]:
+        return True
+    return stop_date is not None and stop_date <= datetime.now() - timedelta(
+        seconds=lag
+    )
+
+
+@asynccontextmanager
+async def try_advisory_lock(
+    lock_id: int, key: int
+) -> AsyncGenerator[Optional[AsyncConnection], None]:
+    """
+    Try to acquire the session-level Postgres advisory lock `(lock_id, key)`
+    without waiting for it.
+
+    Yields the connection holding the lock, or None if the lock is already held
+    by another session. The lock is held for as long as the connection is alive
+    and is released when exiting the context. If the connection is lost, the
+    lock is released by Postgres and can be acquired by another session.
+    """
+    engine, _ = get_db_engine_and_sessionmaker()
+    async with engine.connect() as connection:
+        result = await connection.execute(
+            text("SELECT pg_try_advisory_lock(:lock_id, :key)"),
+            {"lock_id": lock_id, "key": key},
+        )
+        acquired = result.scalar()
+        # session-level advisory locks survive the end of the transaction
+        await connection.commit()
+        if not acquired:
+            yield None
+            return
+
+        try:
+            yield connection
+        finally:
+            try:
+                await connection.execute(
+                    text("SELECT pg_advisory_unlock(:lock_id, :key)"),
+                    {"lock_id": lock_id, "key": key},
+                )
+                await connection.commit()
+            except Exception as e:
+                # make sure a connection that may still hold the lock is not
+                # returned to the pool
+                logger.warning(f"Unable to release advisory lock: {e}")
+                await connection.invalidate()
+
+
+class Explain(Executable, ClauseElement):
+    """
+    `EXPLAIN (ANALYZE, BUFFERS)` of a statement: the statement is actually
+    run, with the same bound parameters. With `analyze=False`, only the
+    planner's estimates are returned, as JSON (`EXPLAIN (FORMAT JSON)`).
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement, analyze: bool = True):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    options = "ANALYZE, BUFFERS" if element.analyze else "FORMAT JSON"
+    return f"EXPLAIN ({options}) " + compiler.process(element.statement, **kwargs)
+
+
+# plan nodes whose input has as many rows as the query reads, or more: limits,
+# sorts and aggregations
+PLAN_NODES_ABOVE_SCAN = {
+    "Limit",
+    "Sort",
+    "Incremental Sort",
+    "Aggregate",
+    "Group",
+    "Unique",
+    "Gather",
+    "Gather Merge",
+}
+
+
+def _get_scanned_rows(plan: dict) -> int:
+    """
+    Get the planner's estimate of the number of rows a query reads, from its
+    `EXPLAIN (FORMAT JSON)` plan: the rows the query returns are limited or
+    aggregated, so the estimate of the node below the limits, sorts and
+    aggregations is used.
+
+    Below a `Gather` node, the estimates are per parallel worker, so they are
+    multiplied by the planner's parallel divisor (see `get_parallel_divisor`
+    in Postgres' `costsize.c`).
+    """
+    parallel_divisor = 1
+    while plan["Node Type"] in PLAN_NODES_ABOVE_SCAN:
+        if plan["Node Type"] in ("Gather", "Gather Merge"):
+            workers = plan.get("Workers Planned", 0)
+            # the leader also reads rows, less and less with more workers
+            parallel_divisor = workers + max(0, 1 - 0.3 * workers)
+        # the node's input, not its sub-queries
+        plan = next(
+            child
+            for child in plan["Plans"]
+            if child.get("Parent Relationship", "Outer") == "Outer"
+        )
+    return round(plan["Plan Rows"] * parallel_divisor)
+
+
 class DataAccessLayer:
     """
     Defines an abstract interface to manipulate the database. Instances are given a session to
@@ -85,6 +440,12 @@ class DataAccessLayer:
 
     def __init__(self, db_session: AsyncSession):
         self.db_session = db_session
+        # (category, dedup_key) of the audit logs created in this session
+        self.dedup_keys = []
+        # categories of the audit logs created in this session, and where
+        # they come from ("api" or "queue"), for metrics
+        self.created_logs = []
+        self.source = "api"
 
     async def test_connection(self) -> None:
         """
@@ -92,34 +453,147 @@ class DataAccessLayer:
         """
         await self.db_session.execute(text("SELECT 1;"))
 
+    async def set_statement_timeout(self, timeout: Optional[float]) -> None:
+        """
+        Cancel the statements of this transaction that run for longer than
+        `timeout` seconds. None or 0: no timeout.
+        """
+        if not timeout:
+            return
+        await self.db_session.execute(
+            text("SELECT set_config('statement_timeout', :timeout, true)"),
+            {"timeout": f"{int(timeout * 1000)}ms"},
+        )
+
+    async def set_lock_timeout(self, timeout: Optional[float]) -> None:
+        """
+        Make the statements of this transaction fail if they wait for a lock
+        for longer than `timeout` seconds. None or 0: no timeout.
+        """
+        if not timeout:
+            return
+        await self.db_session.execute(
+            text("SELECT set_config('lock_timeout', :timeout, true)"),
+            {"timeout": f"{int(timeout * 1000)}ms"},
+        )
+
+    async def _check_query_cost(self, query, name: str) -> None:
+        """
+        Raise QueryTooExpensiveError if the planner estimates that the query
+        would match more than `QUERY_MAX_ESTIMATED_ROWS` rows or cost more
+        than `QUERY_MAX_ESTIMATED_COST`. The query is not run.
+
+        The `LIMIT` of paginated queries is not taken into account: the
+        logs are not indexed by timestamp, so all the matching rows are read
+        and sorted to get the first page anyway. Likewise, for `groupby`
+        queries, the estimate is the number of rows read, not the number of
+        groups.
+        """
+        max_rows = config["QUERY_MAX_ESTIMATED_ROWS"]
+        max_cost = config["QUERY_MAX_ESTIMATED_COST"]
+        if max_rows is None and max_cost is None:
+            return
+
+        with timed("db-explain"):
+            result = await self.db_session.execute(Explain(query, analyze=False))
+            plan = result.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]["Plan"]
+        rows, cost = _get_scanned_rows(plan), plan["Total Cost"]
+        if (max_rows is not None and rows > max_rows) or (
+            max_cost is not None and cost > max_cost
+        ):
+            QUERIES_TOO_EXPENSIVE.inc(reason="estimate")
+            logger.warning(
+                f"Rejecting query '{name}': estimated {rows} rows, cost {cost}"
+            )
+            raise QueryTooExpensiveError(
+                f"This query is estimated to be too expensive ({rows} rows, cost {cost}). Please narrow it down with a shorter time range ('start' and 'stop') or more filters"
+            )
+
+    async def _execute_query(self, query, name: str, check_cost=False) -> Result:
+        """
+        Execute a query, and log it if it is slower than
+        `DB_SLOW_QUERY_THRESHOLD_SECONDS`. The query plan of a sample
+        (`DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE`) of the slow queries is also
+        logged.
+
+        Raises QueryTooExpensiveError if the query was cancelled because of
+        the statement timeout, or if `check_cost` is True and the query is
+        estimated to be too expensive.
+
+        Args:
+            query: the query to execute
+            name (str): what the query is for, used in logs and metrics
+            check_cost (bool): whether to check the query's estimated cost
+                before running it
+        """
+        if check_cost:
+            await self._check_query_cost(query, name)
+
+        start = time.perf_counter()
+        try:
+            with timed(f"db-{name}"):
+                result = await self.db_session.execute(query)
+        except DBAPIError as e:
+            if getattr(e.orig, "sqlstate", None) != QUERY_CANCELED:
+                raise
+            QUERIES_TOO_EXPENSIVE.inc(reason="timeout")
+            logger.warning(
+                f"Query '{name}' was cancelled after {round(time.perf_counter() - start, 3)}s: {e}"
+            )
+            raise QueryTooExpensiveError(
+                "This query took too long. Please narrow it down with a shorter time range ('start' and 'stop') or more filters"
+            )
+        duration = time.perf_counter() - start
+        DB_QUERY_DURATION.observe(duration, query=name)
+
+        threshold = config["DB_SLOW_QUERY_THRESHOLD_SECONDS"]
+        if threshold is None or duration < threshold:
+            return result
+
+        compiled = query.compile(dialect=self.db_session.bind.dialect)
+        logger.warning(
+            f"Slow query '{name}' took {round(duration, 3)}s: {compiled} -- parameters: {compiled.params}"
+        )
+        if random.random() < config["DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE"]:
+            # run the query again to get the plan, in a savepoint so that an
+            # error does not abort the transaction
+            try:
+                async with self.db_session.begin_nested():
+                    plan = await self.db_session.execute(Explain(query))
+                    plan = "\n".join(row[0] for row in plan)
+                logger.warning(f"Query plan of slow query '{name}':\n{plan}")
+            except Exception as e:
+                logger.error(f"Unable to get the plan of slow query '{name}': {e}")
+        return result
+
     def _apply_query_filters(
-        self, model, query, query_params, start_date=None, stop_date=None
+        self,
+        model,
+        query,
+        query_params,
+        start_date=None,
+        stop_date=None,
+        resource_path_prefixes=None,
     ):
         """
         Apply filters to a SQLAlchemy query based on the provided parameters.
         Raises ValueError for invalid field values.
-        """
-
-        def _cast_field_value(model, field, value):
-            field_type = getattr(model, field).type.python_type
-            if field_type == datetime:
-                try:
-                    return datetime.fromtimestamp(int(value))
-                except ValueError as e:
-                    raise ValueError(
-                        f"Unable to convert value '{value}' to datetime for field '{field}': {e}"
-                    )
-            try:
-                return field_type(value)
-            except ValueError as e:
-                raise ValueError(
-                    f"Value '{value}' is not valid for field '{field}': {e}"
-                )
 
+        If `resource_path_prefixes` is provided, only the logs with at least
+        one resource path that is one of these paths, or a child of one of
+        these paths, are returned.
+        """
         if start_date:
             query = query.where(model.timestamp >= start_date)
         if stop_date:
             query = query.where(model.timestamp < stop_date)
+        if resource_path_prefixes is not None:
+            query = query.where(
+                model.resource_path_prefixes.overlap(list(resource_path_prefixes))
+            )
 
         for field, values in query_params.items():
             column = getattr(model, field)
@@ -129,13 +603,19 @@ class DataAccessLayer:
             if hasattr(column.type, "item_type"):  # ARRAY
                 query = query.where(column.overlap(values))
             else:
-                typed_values = [_cast_field_value(model, field, v) for v in values]
+                typed_values = [cast_field_value(model, field, v) for v in values]
                 query = query.where(or_(*(column == v for v in typed_values)))
 
         return query
 
     async def query_logs(
-        self, model, start_date, stop_date, query_params, count
+        self,
+        model,
+        start_date,
+        stop_date,
+        query_params,
+        count,
+        resource_path_prefixes=None,
     ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
         """
         Query logs from the database with pagination support.
@@ -145,14 +625,20 @@ class DataAccessLayer:
         # Build initial query with filters
         base_query = select(model)
         base_query = self._apply_query_filters(
-            model, base_query, query_params, start_date, stop_date
+            model,
+            base_query,
+            query_params,
+            start_date,
+            stop_date,
+            resource_path_prefixes,
         )
         base_query = base_query.order_by(model.timestamp)
         if not count:
             base_query = base_query.limit(config["QUERY_PAGE_SIZE"])
 
-        result = await self.db_session.execute(base_query)
-        logs = result.scalars().all()
+        result = await self._execute_query(base_query, "page", check_cost=True)
+        with timed("orm"):
+            logs = result.scalars().all()
 
         if not logs or count:
             # `count` queries are not paginated: no next timestamp
@@ -166,13 +652,19 @@ class DataAccessLayer:
         # Get extra logs with the same timestamp as the last one
         extra_query = select(model)
         extra_query = self._apply_query_filters(
-            model, extra_query, query_params, start_date, stop_date
+            model,
+            extra_query,
+            query_params,
+            start_date,
+            stop_date,
+            resource_path_prefixes,
         )
         extra_query = extra_query.where(model.timestamp == last_timestamp).order_by(
             model.timestamp
         )
-        extra_result = await self.db_session.execute(extra_query)
-        extra_logs = extra_result.scalars().all()
+        extra_result = await self._execute_query(extra_query, "last_timestamp")
+        with timed("orm"):
+            extra_logs = extra_result.scalars().all()
 
         if len(extra_logs) > 1:
             logs = [log for log in logs if log.timestamp != last_timestamp]
@@ -181,23 +673,36 @@ class DataAccessLayer:
         # Get the next timestamp
         next_query = select(model)
         next_query = self._apply_query_filters(
-            model, next_query, query_params, start_date, stop_date
+            model,
+            next_query,
+            query_params,
+            start_date,
+            stop_date,
+            resource_path_prefixes,
         )
         next_query = next_query.where(model.timestamp > last_timestamp).order_by(
             model.timestamp
         )
-        next_result = await self.db_session.execute(next_query)
-        next_log = next_result.scalars().first()
+        next_result = await self._execute_query(next_query, "next_timestamp")
+        with timed("orm"):
+            next_log = next_result.scalars().first()
 
         next_timestamp = (
             int(datetime.timestamp(next_log.timestamp)) if next_log else None
         )
 
-        logs = [log.to_dict() for log in logs]
+        with timed("orm"):
+            logs = [log.to_dict() for log in logs]
         return logs, next_timestamp
 
     async def query_logs_with_grouping(
-        self, model, start_date, stop_date, query_params, groupby
+        self,
+        model,
+        start_date,
+        stop_date,
+        query_params,
+        groupby,
+        resource_path_prefixes=None,
     ) -> List[Dict[str, Any]]:
         """
         Query logs from the database with grouping support.
@@ -209,31 +714,484 @@ class DataAccessLayer:
         for field in groupby:
             query = query.group_by(getattr(model, field))
         query = self._apply_query_filters(
-            model, query, query_params, start_date, stop_date
+            model, query, query_params, start_date, stop_date, resource_path_prefixes
         )
-        result = await self.db_session.execute(query)
-        logs = result.all()
-        return [dict(row._mapping) for row in logs]
+        result = await self._execute_query(query, "groupby", check_cost=True)
+        with timed("orm"):
+            logs = [dict(row._mapping) for row in result.all()]
+        return logs
+
+    def _is_duplicate(self, category: str, data: Dict[str, Any]) -> bool:
+        """
+        Check whether an audit log with the same `dedup_key` was recently
+        inserted. Duplicates that are not caught here are dropped by the
+        database's unique index on `dedup_key`.
+        """
+        dedup_key = data.get("dedup_key")
+        if not dedup_key:
+            return False
+        if was_recently_inserted(category, dedup_key):
+            logger.info(f"Dropping duplicate `{category}` audit log '{dedup_key}'")
+            return True
+        self.dedup_keys.append((category, dedup_key))
+        return False
 
     async def create_presigned_url_log(self, data: Dict[str, Any]) -> None:
         """
         Create a new `presigned_url` audit log.
         """
+        if self._is_duplicate("presigned_url", data):
+            return
         result = await self.db_session.execute(
             text("SELECT nextval('global_presigned_url_id_seq')")
         )
         data["id"] = result.scalar()
+        data["resource_path_prefixes"] = get_resource_path_prefixes(
+            data.get("resource_paths")
+        )
         self.db_session.add(PresignedUrl(**data))
+        self.created_logs.append("presigned_url")
 
     async def create_login_log(self, data: Dict[str, Any]) -> None:
         """
         Create a new `login` audit log.
         """
+        if self._is_duplicate("login", data):
+            return
         result = await self.db_session.execute(
             text("SELECT nextval('global_login_id_seq')")
         )
         data["id"] = result.scalar()
         self.db_session.add(Login(**data))
+        self.created_logs.append("login")
+
+    async def create_quarantined_message(self, data: Dict[str, Any]) -> None:
+        """
+        Store a queue message that could not be processed.
+        """
+        self.db_session.add(QuarantinedMessage(**data))
+
+    async def get_quarantined_messages(
+        self, ids: Optional[List[int]] = None
+    ) -> List[QuarantinedMessage]:
+        """
+        Get the quarantined queue messages, oldest first. If `ids` is
+        provided, only get the messages with these IDs.
+        """
+        query = select(QuarantinedMessage).order_by(QuarantinedMessage.id)
+        if ids:
+            query = query.where(QuarantinedMessage.id.in_(ids))
+        result = await self.db_session.execute(query)
+        return result.scalars().all()
+
+    async def update_quarantined_message_error(self, id: int, error: str) -> None:
+        await self.db_session.execute(
+            update(QuarantinedMessage)
+            .where(QuarantinedMessage.id == id)
+            .values(error=error)
+        )
+
+    async def delete_quarantined_message(self, id: int) -> None:
+        await self.db_session.execute(
+            delete(QuarantinedMessage).where(QuarantinedMessage.id == id)
+        )
+
+    async def send_queue_message(self, body: str) -> int:
+        """
+        Add a message to the Postgres queue and return its ID.
+        """
+        message = PostgresQueueMessage(body=body)
+        self.db_session.add(message)
+        await self.db_session.flush()
+        return message.id
+
+    async def receive_queue_messages(
+        self, max_messages: int, visibility_timeout: float
+    ) -> List[PostgresQueueMessage]:
+        """
+        Receive the oldest visible messages of the Postgres queue, and hide
+        them from other consumers for `visibility_timeout` seconds. Messages
+        that other consumers are receiving at the same time are skipped.
+        """
+        ids = (
+            select(PostgresQueueMessage.id)
+            .where(PostgresQueueMessage.visible_at <= func.now())
+            .order_by(PostgresQueueMessage.id)
+            .limit(max_messages)
+            .with_for_update(skip_locked=True)
+        )
+        result = await self.db_session.execute(
+            update(PostgresQueueMessage)
+            .where(PostgresQueueMessage.id.in_(ids))
+            .values(
+                receive_count=PostgresQueueMessage.receive_count + 1,
+                visible_at=func.now() + timedelta(seconds=visibility_timeout),
+            )
+            .returning(PostgresQueueMessage)
+            .execution_options(synchronize_session=False)
+        )
+        return sorted(result.scalars().all(), key=lambda message: message.id)
+
+    async def update_queue_message_visibility(
+        self, id: int, receive_count: int, visibility_timeout: float
+    ) -> bool:
+        """
+        Hide a message of the Postgres queue for `visibility_timeout` more
+        seconds, unless it was received again since its `receive_count`th
+        delivery.
+
+        Returns:
+            bool: whether the message was updated
+        """
+        result = await self.db_session.execute(
+            update(PostgresQueueMessage)
+            .where(
+                PostgresQueueMessage.id == id,
+                PostgresQueueMessage.receive_count == receive_count,
+            )
+            .values(visible_at=func.now() + timedelta(seconds=visibility_timeout))
+        )
+        return result.rowcount > 0
+
+    async def delete_queue_message(self, id: int, receive_count: int) -> None:
+        """
+        Delete a message of the Postgres queue, unless it was received again
+        since its `receive_count`th delivery.
+        """
+        await self.db_session.execute(
+            delete(PostgresQueueMessage).where(
+                PostgresQueueMessage.id == id,
+                PostgresQueueMessage.receive_count == receive_count,
+            )
+        )
+
+    async def create_export_job(self, data: Dict[str, Any]) -> ExportJob:
+        job = ExportJob(status="pending", **data)
+        self.db_session.add(job)
+        await self.db_session.flush()
+        await self.db_session.refresh(job)
+        return job
+
+    async def get_export_job(self, id: str) -> Optional[ExportJob]:
+        return await self.db_session.get(ExportJob, id)
+
+    async def claim_export_job(self, lease_seconds: float) -> Optional[ExportJob]:
+        """
+        Claim the oldest export job that is pending, or running but without
+        progress for `lease_seconds` (the worker running it probably stopped).
+        Jobs that other workers are claiming at the same time are skipped.
+        """
+        query = (
+            select(ExportJob)
+            .where(
+                or_(
+                    ExportJob.status == "pending",
+                    and_(
+                        ExportJob.status == "running",
+                        ExportJob.updated_at
+                        < func.now() - timedelta(seconds=lease_seconds),
+                    ),
+                )
+            )
+            .order_by(ExportJob.created_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        result = await self.db_session.execute(query)
+        job = result.scalars().first()
+        if job:
+            job.status = "running"
+            job.attempts += 1
+            job.updated_at = func.now()
+            await self.db_session.flush()
+            await self.db_session.refresh(job)
+        return job
+
+    async def update_export_job(
+        self, id: str, attempt: Optional[int] = None, **values
+    ) -> bool:
+        """
+        Update an export job. If `attempt` is provided, the job is only
+        updated if it was not claimed again since that attempt started: a
+        worker whose lease expired must stop.
+
+        Returns:
+            bool: whether the job was updated
+        """
+        query = (
+            update(ExportJob)
+            .where(ExportJob.id == id)
+            .values(updated_at=func.now(), **values)
+        )
+        if attempt is not None:
+            query = query.where(ExportJob.attempts == attempt)
+        result = await self.db_session.execute(query)
+        return result.rowcount > 0
+
+    async def get_partitions(self, model) -> List[str]:
+        """
+        Get the names of the monthly partitions of the model's table
+        (`<table>_YYYY_MM`, see the `create_partition_and_insert` trigger),
+        oldest first.
+        """
+        result = await self.db_session.execute(
+            text(
+                """
+                SELECT c.relname
+                FROM pg_inherits
+                JOIN pg_class c ON c.oid = inhrelid
+                JOIN pg_class p ON p.oid = inhparent
+                WHERE p.relname = :parent
+                """
+            ),
+            {"parent": model.__tablename__},
+        )
+        return sorted(row[0] for row in result)
+
+    async def get_partition_row_estimates(
+        self, partitions: List[str]
+    ) -> Dict[str, int]:
+        """
+        Get the planner's estimate of the number of rows of each partition,
+        as of the last VACUUM or ANALYZE. Unlike a count, it does not scan
+        the partitions.
+        """
+        result = await self.db_session.execute(
+            text(
+                """
+                SELECT relname, reltuples FROM pg_class
+                WHERE relname = ANY(:partitions)
+                """
+            ),
+            {"partitions": partitions},
+        )
+        # `reltuples` is -1 for tables that were never analyzed
+        return {row[0]: max(int(row[1]), 0) for row in result}
+
+    async def get_partition_blocks(self, partition: str) -> int:
+        """
+        Get the current number of blocks (pages) of a partition.
+        """
+        result = await self.db_session.execute(
+            text(
+                """
+                SELECT pg_relation_size(oid) / CAST(current_setting('block_size') AS int)
+                FROM pg_class WHERE relname = :partition
+                """
+            ),
+            {"partition": partition},
+        )
+        return result.scalar() or 0
+
+    async def backfill_resource_path_prefixes(
+        self, partition: str, start_block: int, stop_block: int
+    ) -> int:
+        """
+        Set the `resource_path_prefixes` of the logs of a `presigned_url`
+        partition that are stored in blocks [`start_block`, `stop_block`) and
+        do not have them yet, in the same way as `get_resource_path_prefixes`:
+        "/A/B" => ["/A", "/A/B"].
+
+        The logs are looked up by the TIDs (block, item) of all the tuples the
+        blocks can hold: `ctid = ANY(...)` is a TID Scan that only reads these
+        blocks, on all Postgres versions. Partitions have no index on
+        `timestamp` or `id`, and `ctid` range conditions only avoid reading
+        the whole partition since Postgres 14.
+
+        Returns:
+            int: the number of updated logs
+        """
+        result = await self.db_session.execute(
+            text(
+                f"""
+                UPDATE "{partition}" SET resource_path_prefixes = ARRAY(
+                    SELECT DISTINCT array_to_string((string_to_array(path, '/'))[1:i], '/')
+                    FROM unnest(resource_paths) AS path,
+                         generate_series(2, array_length(string_to_array(path, '/'), 1)) AS i
+                    ORDER BY 1
+                )
+                WHERE ctid = ANY(ARRAY(
+                    SELECT format('(%s,%s)', block, item)::tid
+                    FROM generate_series(CAST(:start_block AS bigint), CAST(:stop_block AS bigint) - 1) AS block,
+                         -- the maximum number of tuples per block
+                         generate_series(1, (CAST(current_setting('block_size') AS int) - 24) / 28) AS item
+                ))
+                AND resource_paths IS NOT NULL AND resource_path_prefixes IS NULL
+                """
+            ),
+            {"start_block": start_block, "stop_block": stop_block},
+        )
+        return result.rowcount
+
+    async def drop_partition(self, partition: str) -> None:
+        await self.db_session.execute(text(f'DROP TABLE "{partition}"'))
+
+    async def detach_partition(self, model, partition: str) -> str:
+        """
+        Remove a partition from the model's table, so that its logs are no
+        longer queried, and rename it and its indexes `<name>_detached`. If
+        logs are inserted for the same month later, the partition trigger
+        can create a new partition without name conflicts.
+
+        Returns:
+            str: the new name of the partition
+        """
+        detached = f"{partition}_detached"
+        await self.db_session.execute(
+            text(f'ALTER TABLE "{partition}" NO INHERIT "{model.__tablename__}"')
+        )
+        result = await self.db_session.execute(
+            text(
+                """
+                SELECT indexname FROM pg_indexes
+                WHERE schemaname = current_schema() AND tablename = :partition
+                """
+            ),
+            {"partition": partition},
+        )
+        indexes = [row[0] for row in result]
+        await self.db_session.execute(
+            text(f'ALTER TABLE "{partition}" RENAME TO "{detached}"')
+        )
+        for index in indexes:
+            await self.db_session.execute(
+                text(f'ALTER INDEX "{index}" RENAME TO "{index}_detached"')
+            )
+        return detached
+
+    async def count_partition_logs(self, partition: str, lock=False) -> int:
+        """
+        Count the logs of a partition. With `lock`, logs can no longer be
+        inserted into the partition until the end of the transaction.
+        """
+        if lock:
+            await self.db_session.execute(
+                text(f'LOCK TABLE "{partition}" IN SHARE MODE')
+            )
+        result = await self.db_session.execute(
+            text(f'SELECT count(*) FROM "{partition}"')
+        )
+        return result.scalar()
+
+    async def create_archived_partition(
+        self, data: Dict[str, Any]
+    ) -> ArchivedPartition:
+        archived_partition = ArchivedPartition(**data)
+        self.db_session.add(archived_partition)
+        await self.db_session.flush()
+        await self.db_session.refresh(archived_partition)
+        return archived_partition
+
+    async def get_archived_partitions(
+        self,
+        category: str,
+        start_date: Optional[datetime] = None,
+        stop_date: Optional[datetime] = None,
+    ) -> List[ArchivedPartition]:
+        """
+        Get the archived partitions of a category that may contain logs
+        between `start_date` and `stop_date`, oldest first.
+        """
+        query = select(ArchivedPartition).where(ArchivedPartition.category == category)
+        if start_date:
+            query = query.where(ArchivedPartition.month_end > start_date)
+        if stop_date:
+            query = query.where(ArchivedPartition.month_start < stop_date)
+        query = query.order_by(ArchivedPartition.month_start, ArchivedPartition.id)
+        result = await self.db_session.execute(query)
+        return result.scalars().all()
+
+    async def stream_partition_logs(
+        self,
+        model,
+        partition: str,
+        start_date,
+        stop_date,
+        query_params,
+        resource_path_prefixes=None,
+        after: Optional[Tuple[datetime, int]] = None,
+        chunk_size: int = 10000,
+    ) -> AsyncGenerator[List[AuditLog], None]:
+        """
+        Get the logs of one partition that match the filters, ordered by
+        timestamp and ID, in chunks of `chunk_size` logs. The partition is
+        queried directly: the parent table has no constraint that would let
+        Postgres skip the other partitions.
+
+        Args:
+            after (tuple): (timestamp, ID) of the last log that was already
+                processed, to resume an interrupted export
+        """
+        entity = _partition_entity(model, partition)
+        query = self._apply_query_filters(
+            entity,
+            select(entity),
+            query_params,
+            start_date,
+            stop_date,
+            resource_path_prefixes,
+        )
+        if after:
+            query = query.where(tuple_(entity.timestamp, entity.id) > tuple_(*after))
+        query = query.order_by(entity.timestamp, entity.id).execution_options(
+            yield_per=chunk_size
+        )
+        result = await self.db_session.stream(query)
+        async for chunk in result.scalars().partitions():
+            yield chunk
+
+
+def cast_field_value(model, field: str, value: str) -> Any:
+    """
+    Convert a query string filter value to the type of the field. Raises
+    ValueError for invalid values.
+    """
+    field_type = getattr(model, field).type.python_type
+    if field_type == datetime:
+        try:
+            return datetime.fromtimestamp(int(value))
+        except ValueError as e:
+            raise ValueError(
+                f"Unable to convert value '{value}' to datetime for field '{field}': {e}"
+            )
+    try:
+        return field_type(value)
+    except ValueError as e:
+        raise ValueError(f"Value '{value}' is not valid for field '{field}': {e}")
+
+
+def get_partition_month(partition: str) -> Optional[datetime]:
+    """
+    "presigned_url_2020_01" => 2020-01-01. Returns None if the name does not
+    end with a month.
+    """
+    try:
+        return datetime.strptime("_".join(partition.rsplit("_", 2)[-2:]), "%Y_%m")
+    except ValueError:
+        return None
+
+
+def get_next_month(month: datetime) -> datetime:
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+@lru_cache(maxsize=None)
+def _partition_entity(model, partition: str):
+    """
+    Get an entity to query one of the partitions of the model's table
+    directly, that returns instances of the model.
+    """
+    table = Table(
+        partition,
+        MetaData(),
+        *(
+            Column(column.name, column.type, primary_key=column.primary_key)
+            for column in model.__table__.columns
+        ),
+    )
+    return aliased(model, table, adapt_on_names=True)
 
 
 async def get_data_access_layer() -> AsyncGenerator[DataAccessLayer, Any]:
@@ -245,4 +1203,122 @@ async def get_data_access_layer() -> AsyncGenerator[DataAccessLayer, Any]:
     """
     async with async_sessionmaker_instance() as session:
         async with session.begin():
-            yield DataAccessLayer(session)
+            with DB_CONNECTION_WAIT.time():
+                await session.connection()
+            data_access_layer = DataAccessLayer(session)
+            yield data_access_layer
+        # the transaction was committed
+        for category, dedup_key in data_access_layer.dedup_keys:
+            remember_inserted(category, dedup_key)
+        for category in data_access_layer.created_logs:
+            LOGS_INGESTED.inc(category=category, source=data_access_layer.source)
+
+
+@asynccontextmanager
+async def query_slot() -> AsyncGenerator[None, None]:
+    """
+    Hold one of the `DB_QUERY_POOL_MAX_SIZE` slots that limit the number of
+    queries running at the same time, for example while reading the archive
+    files of a query (see `audit.archive`).
+
+    Raises QueryRejectedError if all the slots are in use for more than
+    `QUERY_ADMISSION_TIMEOUT_SECONDS`.
+    """
+    if query_slots.locked():
+        try:
+            await asyncio.wait_for(
+                query_slots.acquire(), config["QUERY_ADMISSION_TIMEOUT_SECONDS"]
+            )
+        except asyncio.TimeoutError:
+            QUERIES_REJECTED.inc()
+            raise QueryRejectedError("Too many queries are running")
+    else:
+        await query_slots.acquire()
+
+    try:
+        yield
+    finally:
+        query_slots.release()
+
+
+@asynccontextmanager
+async def query_data_access_layer(
+    stop_date: Optional[datetime] = None,
+    category: Optional[str] = None,
+    statement_timeout: Optional[float] = None,
+) -> AsyncGenerator[DataAccessLayer, None]:
+    """
+    Get an instance of the Data Access Layer to query audit logs older than
+    `stop_date` (None: up to now). It uses the read replica (`DB_READ_URL`)
+    when it is configured and up to date enough, and the primary otherwise.
+    The statements are cancelled after `statement_timeout` seconds if it is
+    provided, and after the `category`'s `QUERY_STATEMENT_TIMEOUT_SECONDS`
+    otherwise.
+
+    Raises QueryRejectedError if all the query connections are in use for
+    more than `QUERY_ADMISSION_TIMEOUT_SECONDS`.
+
+    If the task is cancelled, for example because the client disconnected,
+    the running statement is cancelled on the database server.
+    """
+    async with query_slot():
+        if await use_read_replica(stop_date):
+            DB_READ_QUERIES.inc(target="replica")
+            sessionmaker = read_async_sessionmaker_instance
+        else:
+            DB_READ_QUERIES.inc(target="primary")
+            sessionmaker = query_async_sessionmaker_instance
+        async with sessionmaker() as session:
+            async with session.begin():
+                with DB_CONNECTION_WAIT.time():
+                    connection = await session.connection()
+                data_access_layer = DataAccessLayer(session)
+                if statement_timeout is None:
+                    statement_timeout = config[
+                        "QUERY_STATEMENT_TIMEOUT_SECONDS_PER_CATEGORY"
+                    ].get(category, config["QUERY_STATEMENT_TIMEOUT_SECONDS"])
+                await data_access_layer.set_statement_timeout(statement_timeout)
+                try:
+                    yield data_access_layer
+                except asyncio.CancelledError:
+                    # the client disconnected (see `ClientDisconnectMiddleware`).
+                    # asyncpg asks the server to cancel the running statement
+                    # when the task waiting for it is cancelled. The
+                    # connection, whose state is unknown, is closed instead of
+                    # waiting for the cancellation before returning it to the
+                    # pool
+                    QUERIES_CANCELLED.inc()
+                    logger.info("Query cancelled: the client disconnected")
+                    await connection.invalidate()
+                    raise
+
+
+@asynccontextmanager
+async def export_data_access_layer(
+    stop_date: Optional[datetime] = None,
+    statement_timeout: Optional[float] = None,
+) -> AsyncGenerator[DataAccessLayer, None]:
+    """
+    Get an instance of the Data Access Layer for export jobs to read audit
+    logs older than `stop_date` (None: up to now). Like
+    `query_data_access_layer`, it uses the read replica when it is up to date
+    enough, but with the export connection pools: export jobs are never
+    rejected, and do not reduce the number of queries that can run. The
+    statements are cancelled after `statement_timeout` seconds if it is
+    provided, and after `EXPORT_STATEMENT_TIMEOUT_SECONDS` otherwise.
+    """
+    if await use_read_replica(stop_date):
+        DB_READ_QUERIES.inc(target="replica")
+        sessionmaker = export_read_async_sessionmaker_instance
+    else:
+        DB_READ_QUERIES.inc(target="primary")
+        sessionmaker = export_async_sessionmaker_instance
+    async with sessionmaker() as session:
+        async with session.begin():
+            with DB_CONNECTION_WAIT.time():
+                await session.connection()
+            data_access_layer = DataAccessLayer(session)
+            if statement_timeout is None:
+                statement_timeout = config["EXPORT_STATEMENT_TIMEOUT_SECONDS"]
+            await data_access_layer.set_statement_timeout(statement_timeout)
+            yield data_access_layer
@@ -0,0 +1,382 @@
+"""
+Export jobs write all the audit logs matching a query to a file, for exports
+that are too large to be returned by a single HTTP request (see
+`audit.routes.export`).
+
+Jobs are stored in the `export_job` table. Each replica runs `EXPORT_WORKERS`
+workers, which claim pending jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so
+that each job is run by a single worker whatever the number of workers and
+replicas. A running job's lease is renewed every `EXPORT_JOB_LEASE_SECONDS` /
+3 seconds; if the worker running it stops, another worker claims it once the
+lease expires.
+
+Jobs process one monthly partition at a time, in chunks of `EXPORT_CHUNK_SIZE`
+logs. After each chunk, the position of the last exported log and the size of
+the file are saved, so that an interrupted job resumes where it stopped.
+Parquet files cannot be appended to once interrupted, so Parquet jobs start
+over instead. Completed files stay in `EXPORT_DIRECTORY`, or are uploaded to
+the `EXPORT_S3` bucket if one is configured.
+"""
+import asyncio
+import os
+import traceback
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import func
+
+from . import logger
+from .config import config
+from .db import (
+    export_data_access_layer,
+    get_data_access_layer,
+    get_next_month,
+    get_partition_month,
+)
+from .metrics import EXPORT_JOBS, LOGS_EXPORTED
+from .models import CATEGORY_TO_MODEL_CLASS, AuditLog, ExportJob
+from .utils.columnar import ArrowEncoder, pyarrow
+from .utils.responses import encode_json
+from .utils.s3 import get_s3_client, split_s3_url, upload_file
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when an export job was claimed by another worker, because this
+    worker did not renew its lease in time.
+    """
+
+
+class ExportWriter(ABC):
+    """
+    Write the logs of an export job to a file, one chunk at a time.
+    `resumable` writers can append to a file that was truncated after any
+    chunk.
+    """
+
+    extension = None
+    media_type = None
+    resumable = True
+
+    def __init__(self, f, model, parameters: dict):
+        self.f = f
+        # same as the audit log query responses
+        self.exclude = set(model.INTERNAL_COLUMNS)
+        if not config["QUERY_USERNAMES"]:
+            self.exclude.add("username")
+
+    def start(self) -> None:
+        """
+        Called before writing the first chunk to an empty file.
+        """
+
+    @abstractmethod
+    def write(self, logs: List[AuditLog]) -> None:
+        """
+        Write a chunk of logs.
+        """
+
+    def finish(self) -> None:
+        """
+        Called after writing the last chunk.
+        """
+
+
+class NdjsonExportWriter(ExportWriter):
+    """
+    One JSON document per log.
+    """
+
+    extension = "ndjson"
+    media_type = "application/x-ndjson"
+
+    def __init__(self, f, model, parameters: dict):
+        super().__init__(f, model, parameters)
+        self.timestamp_format = parameters["timestamp_format"]
+
+    def write(self, logs: List[AuditLog]) -> None:
+        for log in logs:
+            content = log.to_dict()
+            for column in self.exclude:
+                content.pop(column, None)
+            self.f.write(encode_json(content, self.timestamp_format) + b"\n")
+
+
+class ArrowExportWriter(ExportWriter):
+    """
+    Arrow IPC stream: the schema, then one record batch per chunk. The
+    messages are written directly, instead of with
+    `pyarrow.ipc.RecordBatchStreamWriter`, so that an interrupted file can be
+    appended to without writing the schema again.
+    """
+
+    extension = "arrows"
+    media_type = "application/vnd.apache.arrow.stream"
+
+    # end-of-stream marker of the Arrow IPC format
+    END_OF_STREAM = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+    def __init__(self, f, model, parameters: dict):
+        super().__init__(f, model, parameters)
+        self.encoder = ArrowEncoder(model, self.exclude)
+
+    def start(self) -> None:
+        self.f.write(self.encoder.schema.serialize())
+
+    def write(self, logs: List[AuditLog]) -> None:
+        self.f.write(self.encoder.encode(logs).serialize())
+
+    def finish(self) -> None:
+        self.f.write(self.END_OF_STREAM)
+
+
+class ParquetExportWriter(ExportWriter):
+    """
+    Parquet file, with one row group per chunk so that memory usage does not
+    depend on the size of the export. The file metadata is only written at
+    the end, so an interrupted file cannot be appended to.
+    """
+
+    extension = "parquet"
+    media_type = "application/vnd.apache.parquet"
+    resumable = False
+
+    def __init__(self, f, model, parameters: dict):
+        super().__init__(f, model, parameters)
+        self.encoder = ArrowEncoder(model, self.exclude)
+        self.writer = None
+
+    def start(self) -> None:
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.f,
+            self.encoder.schema,
+            compression=config["EXPORT_PARQUET_COMPRESSION"] or "none",
+        )
+
+    def write(self, logs: List[AuditLog]) -> None:
+        self.writer.write_batch(self.encoder.encode(logs))
+
+    def finish(self) -> None:
+        self.writer.close()
+
+
+EXPORT_FORMATS = {
+    "ndjson": NdjsonExportWriter,
+    "parquet": ParquetExportWriter,
+    "arrow": ArrowExportWriter,
+}
+
+
+def get_export_format(job: ExportJob) -> str:
+    # jobs created before formats were added are NDJSON exports
+    return job.parameters.get("format", "ndjson")
+
+
+def get_export_file_path(job: ExportJob) -> str:
+    extension = EXPORT_FORMATS[get_export_format(job)].extension
+    return os.path.join(config["EXPORT_DIRECTORY"], f"{job.id}.{extension}")
+
+
+def get_download_url(job: ExportJob) -> Optional[str]:
+    """
+    Get a presigned URL to download the file of a completed export job, if it
+    was uploaded to S3. Returns None if the file is stored locally.
+    """
+    if not job.file_path.startswith("s3://"):
+        return None
+    bucket, key = split_s3_url(job.file_path)
+    return get_s3_client(config["EXPORT_S3"]).generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": bucket,
+            "Key": key,
+            "ResponseContentDisposition": f'attachment; filename="{os.path.basename(key)}"',
+        },
+        ExpiresIn=config["EXPORT_DOWNLOAD_URL_EXPIRES_SECONDS"],
+    )
+
+
+def _store_export_file(path: str) -> str:
+    """
+    Upload the file of a completed export job to the `EXPORT_S3` bucket, if
+    one is configured. Returns the location of the file.
+    """
+    if not config["EXPORT_S3"].get("bucket"):
+        return path
+    return upload_file(path, config["EXPORT_S3"])
+
+
+def _write_chunk(writer: ExportWriter, logs: List[AuditLog]) -> int:
+    """
+    Write logs to the file, and make sure they are on disk before the
+    progress is saved. Returns the size of the file.
+    """
+    writer.write(logs)
+    writer.f.flush()
+    os.fsync(writer.f.fileno())
+    return writer.f.tell()
+
+
+async def _keep_lease(job: ExportJob) -> None:
+    """
+    Until cancelled, renew the lease of the job while it runs.
+    """
+    while True:
+        await asyncio.sleep(config["EXPORT_JOB_LEASE_SECONDS"] / 3)
+        async for data_access_layer in get_data_access_layer():
+            if not await data_access_layer.update_export_job(job.id, job.attempts):
+                logger.warning(f"Lost the lease of export job {job.id}")
+                return
+
+
+async def run_export_job(job: ExportJob) -> None:
+    """
+    Export the logs of a job claimed by this worker to a file, starting after
+    the last exported log if the job was interrupted. Raises LeaseLostError
+    if another worker claimed the job in the meantime.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[job.category]
+    parameters = job.parameters
+    query_params = {
+        field: set(values) for field, values in parameters["filters"].items()
+    }
+    export_format = get_export_format(job)
+    writer_class = EXPORT_FORMATS[export_format]
+    path = get_export_file_path(job)
+    os.makedirs(config["EXPORT_DIRECTORY"], exist_ok=True)
+
+    after = (job.cursor_timestamp, job.cursor_id) if job.cursor_timestamp else None
+    file_size, exported_count = job.file_size, job.exported_count
+    if file_size and (not os.path.exists(path) or os.path.getsize(path) < file_size):
+        logger.warning(
+            f"The file of export job {job.id} is missing or incomplete, restarting from the beginning"
+        )
+        after, file_size, exported_count = None, 0, 0
+    elif file_size and not writer_class.resumable:
+        logger.info(
+            f"{export_format} files cannot be resumed, restarting export job {job.id} from the beginning"
+        )
+        after, file_size, exported_count = None, 0, 0
+
+    async with export_data_access_layer(job.stop_timestamp) as data_access_layer:
+        partitions = await data_access_layer.get_partitions(model)
+
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        # remove what was written after the last saved progress
+        f.truncate(file_size)
+        f.seek(file_size)
+        writer = writer_class(f, model, parameters)
+        if not file_size:
+            await asyncio.to_thread(writer.start)
+        for partition in partitions:
+            month = get_partition_month(partition)
+            if month is None or month >= job.stop_timestamp:
+                continue
+            next_month = get_next_month(month)
+            if job.start_timestamp and next_month <= job.start_timestamp:
+                continue
+            if after and next_month <= after[0]:
+                continue
+
+            # one transaction per partition, so that long exports do not hold
+            # a snapshot for too long
+            async with export_data_access_layer(
+                job.stop_timestamp
+            ) as data_access_layer:
+                async for logs in data_access_layer.stream_partition_logs(
+                    model,
+                    partition,
+                    job.start_timestamp,
+                    job.stop_timestamp,
+                    query_params,
+                    parameters["resource_path_prefixes"],
+                    after=after,
+                    chunk_size=config["EXPORT_CHUNK_SIZE"],
+                ):
+                    after = (logs[-1].timestamp, logs[-1].id)
+                    file_size = await asyncio.to_thread(_write_chunk, writer, logs)
+                    exported_count += len(logs)
+                    LOGS_EXPORTED.inc(len(logs), category=job.category)
+                    async for progress_data_access_layer in get_data_access_layer():
+                        updated = await progress_data_access_layer.update_export_job(
+                            job.id,
+                            job.attempts,
+                            cursor_timestamp=after[0],
+                            cursor_id=after[1],
+                            file_size=file_size,
+                            exported_count=exported_count,
+                        )
+                    if not updated:
+                        raise LeaseLostError(f"Lost the lease of export job {job.id}")
+        await asyncio.to_thread(writer.finish)
+
+    file_path = await asyncio.to_thread(_store_export_file, path)
+    async for data_access_layer in get_data_access_layer():
+        updated = await data_access_layer.update_export_job(
+            job.id,
+            job.attempts,
+            status="completed",
+            file_path=file_path,
+            error=None,
+            completed_at=func.now(),
+        )
+    if not updated:
+        raise LeaseLostError(f"Lost the lease of export job {job.id}")
+    EXPORT_JOBS.inc(status="completed")
+    logger.info(f"Completed export job {job.id}: {exported_count} audit logs")
+
+
+async def run_next_export_job() -> bool:
+    """
+    Claim an export job and run it. Jobs that fail are retried up to
+    `EXPORT_MAX_ATTEMPTS` times, starting from where they stopped.
+
+    Returns:
+        bool: whether there was a job to run
+    """
+    async for data_access_layer in get_data_access_layer():
+        job = await data_access_layer.claim_export_job(
+            config["EXPORT_JOB_LEASE_SECONDS"]
+        )
+    if job is None:
+        return False
+
+    logger.info(f"Running export job {job.id} (attempt {job.attempts})")
+    lease = asyncio.create_task(_keep_lease(job))
+    try:
+        await run_export_job(job)
+    except LeaseLostError as e:
+        logger.warning(str(e))
+    except Exception as e:
+        logger.error(f"Error running export job {job.id}: {e}")
+        traceback.print_exc()
+        failed = job.attempts >= config["EXPORT_MAX_ATTEMPTS"]
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.update_export_job(
+                job.id,
+                job.attempts,
+                status="failed" if failed else "pending",
+                error=str(e),
+            )
+        if failed:
+            EXPORT_JOBS.inc(status="failed")
+    finally:
+        lease.cancel()
+    return True
+
+
+async def export_jobs_loop() -> None:
+    """
+    Run export jobs, forever. When there is no job to run, check again every
+    `EXPORT_POLL_SECONDS`.
+    """
+    while True:
+        try:
+            ran = await run_next_export_job()
+        except Exception as e:
+            logger.error(f"Error claiming export job: {e}")
+            traceback.print_exc()
+            ran = False
+        if not ran:
+            await asyncio.sleep(config["EXPORT_POLL_SECONDS"])
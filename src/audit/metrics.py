@@ -0,0 +1,310 @@
+"""
+Metrics about the service's activity, recorded with `prometheus_client`.
+
+Each metric can have labels: values are tracked separately for each
+combination of label values. All the metrics are exposed by the `/metrics`
+endpoint in the Prometheus text format.
+
+When `PROMETHEUS_MULTIPROC_DIR` is set (the gunicorn configuration sets it),
+each process writes its metrics to files in that directory, and `/metrics`
+returns the metrics of all the worker processes combined, whichever worker
+handles the scrape.
+"""
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import prometheus_client
+from prometheus_client import CollectorRegistry, multiprocess
+from prometheus_client.context_managers import Timer
+
+# all the metrics defined in the service
+REGISTRY = prometheus_client.REGISTRY
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# in multiprocess mode, how often each process updates the gauges whose value
+# is the result of a function
+GAUGE_REFRESH_SECONDS = 5
+
+# `*_created` series are not available in multiprocess mode: do not expose
+# them at all, so that `/metrics` is the same with one or several processes
+prometheus_client.disable_created_metrics()
+
+# gauges whose value can be the result of a function
+GAUGES: List["Gauge"] = []
+
+
+def is_multiprocess() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+class Metric:
+    metric_class = None
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Tuple[str, ...] = (),
+        registry: CollectorRegistry = REGISTRY,
+        **kwargs,
+    ):
+        self.name = name
+        self.labels = tuple(labels)
+        self.registry = registry
+        self.metric = self.metric_class(
+            name, description, labelnames=self.labels, registry=registry, **kwargs
+        )
+
+    def _label_values(self, labels: dict) -> tuple:
+        assert set(labels) == set(
+            self.labels
+        ), f"Metric '{self.name}' expects labels {self.labels}, got {list(labels)}"
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _child(self, labels: dict):
+        label_values = self._label_values(labels)
+        return self.metric.labels(*label_values) if self.labels else self.metric
+
+    def _get_sample(self, sample_name: str, labels: dict) -> float:
+        """
+        Get the value of one of the metric's samples in this process.
+        """
+        label_values = self._label_values(labels)
+        value = self.registry.get_sample_value(
+            sample_name, dict(zip(self.labels, label_values))
+        )
+        return value or 0
+
+
+class Counter(Metric):
+    """
+    A value that can only go up, such as a number of processed messages.
+    """
+
+    metric_class = prometheus_client.Counter
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._child(labels).inc(amount)
+
+    def get(self, **labels) -> float:
+        name = self.name if self.name.endswith("_total") else f"{self.name}_total"
+        return self._get_sample(name, labels)
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. Instead of a value, a function can be
+    set: the value is the result of calling it when the metrics are
+    collected, and every `GAUGE_REFRESH_SECONDS` in multiprocess mode (see
+    `refresh_gauges_loop`). The values of all the live processes are added up.
+    """
+
+    metric_class = prometheus_client.Gauge
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Tuple[str, ...] = (),
+        registry: CollectorRegistry = REGISTRY,
+    ):
+        super().__init__(
+            name, description, labels, registry, multiprocess_mode="livesum"
+        )
+        # functions returning the value, by label values
+        self.functions: Dict[tuple, Callable[[], float]] = {}
+        GAUGES.append(self)
+
+    def set(self, value: float, **labels) -> None:
+        self._child(labels).set(value)
+
+    def set_function(self, function: Optional[Callable[[], float]], **labels) -> None:
+        """
+        Set the function returning the value. If `function` is None, the
+        value for these labels is removed.
+        """
+        label_values = self._label_values(labels)
+        if function is None:
+            if self.functions.pop(label_values, None) and self.labels:
+                self.metric.remove(*label_values)
+        else:
+            self.functions[label_values] = function
+            self._child(labels).set(function())
+
+    def refresh(self) -> None:
+        """
+        Set the value of the gauge to the result of its functions.
+        """
+        for label_values, function in list(self.functions.items()):
+            self._child(dict(zip(self.labels, label_values))).set(function())
+
+    def get(self, **labels) -> float:
+        function = self.functions.get(self._label_values(labels))
+        if function:
+            return function()
+        return self._get_sample(self.name, labels)
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values, such as request durations, in
+    buckets of values lower than or equal to each of the `buckets` bounds.
+    """
+
+    metric_class = prometheus_client.Histogram
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+        registry: CollectorRegistry = REGISTRY,
+    ):
+        super().__init__(name, description, labels, registry, buckets=buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        self._child(labels).observe(value)
+
+    def time(self, **labels) -> Timer:
+        """
+        Observe the duration of the code run in this context, in seconds.
+        """
+        return self._child(labels).time()
+
+    def get_count(self, **labels) -> int:
+        return int(self._get_sample(f"{self.name}_count", labels))
+
+    def get_sum(self, **labels) -> float:
+        return self._get_sample(f"{self.name}_sum", labels)
+
+
+def refresh_gauges() -> None:
+    for gauge in GAUGES:
+        gauge.refresh()
+
+
+async def refresh_gauges_loop() -> None:
+    """
+    In multiprocess mode, the metrics are collected from the files written by
+    each process, so each process must keep its gauges up to date.
+    """
+    while True:
+        refresh_gauges()
+        await asyncio.sleep(GAUGE_REFRESH_SECONDS)
+
+
+def generate_latest() -> str:
+    """
+    Get the current values of all the metrics, in the Prometheus text format.
+    In multiprocess mode, the values of all the processes are combined.
+    """
+    refresh_gauges()
+    registry = REGISTRY
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry).decode()
+
+
+REQUEST_DURATION = Histogram(
+    "audit_request_duration_seconds",
+    "Time spent handling HTTP requests, by route and log category",
+    labels=("method", "route", "category", "status_code"),
+)
+LOGS_INGESTED = Counter(
+    "audit_logs_ingested_total",
+    "Number of audit logs inserted in the database, by category and source (api or queue)",
+    labels=("category", "source"),
+)
+QUEUE_OPERATION_DURATION = Histogram(
+    "audit_queue_operation_duration_seconds",
+    "Time spent receiving a batch of messages, processing a message, or deleting a message",
+    labels=("operation",),
+)
+QUEUE_VISIBILITY_EXTENSIONS = Counter(
+    "audit_queue_visibility_extensions_total",
+    "Number of in-flight queue messages whose visibility timeout was extended",
+)
+QUEUE_VISIBILITY_EXTENSION_FAILURES = Counter(
+    "audit_queue_visibility_extension_failures_total",
+    "Number of in-flight queue messages whose visibility timeout could not be extended",
+)
+QUEUE_MESSAGES_QUARANTINED = Counter(
+    "audit_queue_messages_quarantined_total",
+    "Number of queue messages moved to quarantine after failing to be processed",
+)
+AUTHZ_CACHE_REQUESTS = Counter(
+    "audit_authz_cache_requests_total",
+    "Number of authorization checks, by whether they were served by the cache",
+    labels=("result",),
+)
+DB_POOL_SIZE = Gauge(
+    "audit_db_pool_size",
+    "Number of connections the DB pool keeps open (`DB_POOL_MIN_SIZE` or `DB_QUERY_POOL_MIN_SIZE`), by pool (ingest, query or read)",
+    labels=("pool",),
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "audit_db_pool_checked_out",
+    "Number of DB connections currently in use, by pool",
+    labels=("pool",),
+)
+DB_POOL_CHECKED_IN = Gauge(
+    "audit_db_pool_checked_in",
+    "Number of open DB connections currently available in the pool, by pool",
+    labels=("pool",),
+)
+DB_POOL_OVERFLOW = Gauge(
+    "audit_db_pool_overflow",
+    "Number of DB connections open above the pool's min size (negative when the pool is not full yet), by pool",
+    labels=("pool",),
+)
+DB_QUERY_DURATION = Histogram(
+    "audit_db_query_duration_seconds",
+    "Time spent running audit log queries, by query",
+    labels=("query",),
+)
+DB_READ_QUERIES = Counter(
+    "audit_db_read_queries_total",
+    "Number of audit log queries, by database (primary or replica)",
+    labels=("target",),
+)
+QUERIES_REJECTED = Counter(
+    "audit_queries_rejected_total",
+    "Number of audit log queries rejected because too many queries were running",
+)
+QUERIES_TOO_EXPENSIVE = Counter(
+    "audit_queries_too_expensive_total",
+    "Number of audit log queries rejected because of their estimated cost (estimate) or cancelled because of the statement timeout (timeout)",
+    labels=("reason",),
+)
+QUERIES_CANCELLED = Counter(
+    "audit_queries_cancelled_total",
+    "Number of audit log queries cancelled because the client disconnected",
+)
+QUERIES_COALESCED = Counter(
+    "audit_queries_coalesced_total",
+    "Number of audit log queries that reused the result of an identical query that was already running",
+)
+EXPORT_JOBS = Counter(
+    "audit_export_jobs_total",
+    "Number of export jobs that completed or failed",
+    labels=("status",),
+)
+LOGS_EXPORTED = Counter(
+    "audit_logs_exported_total",
+    "Number of audit logs written to export files, by category",
+    labels=("category",),
+)
+PARTITIONS_REMOVED = Counter(
+    "audit_partitions_removed_total",
+    "Number of monthly partitions removed by the retention policy, by category and action",
+    labels=("category", "action"),
+)
+DB_CONNECTION_WAIT = Histogram(
+    "audit_db_connection_wait_seconds",
+    "Time spent waiting for a DB connection from the pool",
+)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 import sqlalchemy
-from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import declarative_base
 from typing import Optional
@@ -13,17 +13,25 @@ Base = declarative_base()
 
 class AuditLog(Base):
     __abstract__ = True  # Prevents table creation
+    # columns used internally, that are not returned by the API
+    INTERNAL_COLUMNS = {"dedup_key"}
+
     request_url = Column(String, nullable=False)
     status_code = Column(Integer, nullable=False)
     timestamp = Column(DateTime, nullable=False, default=sqlalchemy.func.now())
     username = Column(String, nullable=False)
     sub = Column(Integer, nullable=True)  # can be null for public data
     additional_data = Column(JSONB(), nullable=True)
+    # used to drop duplicate audit logs, see `utils/dedup.py`. Unique in
+    # each partition.
+    dedup_key = Column(String, nullable=True)
 
     # Since declarative_base() has no default to_dict() method,
     def to_dict(self):
         return {
-            column.name: getattr(self, column.name) for column in self.__table__.columns
+            column.name: getattr(self, column.name)
+            for column in self.__table__.columns
+            if column.name not in self.INTERNAL_COLUMNS
         }
 
 
@@ -36,12 +44,17 @@ class PresignedUrl(AuditLog):
     """
 
     __tablename__ = "presigned_url"
+    INTERNAL_COLUMNS = AuditLog.INTERNAL_COLUMNS | {"resource_path_prefixes"}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     guid = Column(String, nullable=False)
     resource_paths = Column(ARRAY(String), nullable=True)
     action = Column(String, nullable=False)
     protocol = Column(String, nullable=True)
+    # all the prefixes of `resource_paths` (see `get_resource_path_prefixes`),
+    # indexed so that users can be restricted to the logs of the resources
+    # they have access to
+    resource_path_prefixes = Column(ARRAY(String), nullable=True)
 
 
 class Login(AuditLog):
@@ -55,6 +68,133 @@ class Login(AuditLog):
     ip = Column(String, nullable=True)
 
 
+class QuarantinedMessage(Base):
+    """
+    Queue messages that could not be processed after several attempts. They
+    are deleted from the queue so they do not block it, and can be replayed
+    once the issue is fixed.
+    """
+
+    __tablename__ = "quarantined_message"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(String, nullable=True)
+    body = Column(Text, nullable=False)
+    sent_timestamp = Column(DateTime, nullable=True)
+    receive_count = Column(Integer, nullable=False)
+    error = Column(Text, nullable=True)
+    quarantined_at = Column(
+        DateTime, nullable=False, server_default=sqlalchemy.func.now()
+    )
+
+    def to_dict(self):
+        return {
+            column.name: getattr(self, column.name) for column in self.__table__.columns
+        }
+
+
+class PostgresQueueMessage(Base):
+    """
+    Messages of the Postgres queue (see `audit.queues.postgres`). Audit logs
+    are sent to it by inserting rows.
+    """
+
+    __tablename__ = "queue_message"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    body = Column(Text, nullable=False)
+    sent_at = Column(DateTime, nullable=False, server_default=sqlalchemy.func.now())
+    # the message is hidden from consumers until then
+    visible_at = Column(DateTime, nullable=False, server_default=sqlalchemy.func.now())
+    receive_count = Column(Integer, nullable=False, server_default="0")
+
+
+class ExportJob(Base):
+    """
+    Export of the audit logs matching a query to a file, run in the
+    background by the export workers (see `audit.export`).
+    """
+
+    __tablename__ = "export_job"
+
+    id = Column(String, primary_key=True)
+    # `sub` of the user who requested the export
+    requested_by = Column(String, nullable=False)
+    category = Column(String, nullable=False)
+    # filters, authorized resource path prefixes and output format
+    parameters = Column(JSONB(), nullable=False)
+    start_timestamp = Column(DateTime, nullable=True)
+    stop_timestamp = Column(DateTime, nullable=False)
+    # pending, running, completed or failed
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    # progress: the logs up to (`cursor_timestamp`, `cursor_id`) have been
+    # written to the first `file_size` bytes of the file
+    cursor_timestamp = Column(DateTime, nullable=True)
+    cursor_id = Column(Integer, nullable=True)
+    exported_count = Column(BigInteger, nullable=False, server_default="0")
+    file_size = Column(BigInteger, nullable=False, server_default="0")
+    file_path = Column(String, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=sqlalchemy.func.now())
+    updated_at = Column(DateTime, nullable=False, server_default=sqlalchemy.func.now())
+    completed_at = Column(DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "category": self.category,
+            "status": self.status,
+            "exported_count": self.exported_count,
+            "error": self.error,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at,
+        }
+
+
+class ArchivedPartition(Base):
+    """
+    Monthly partition of audit logs that was archived to a Parquet file and
+    dropped from the database (see `audit.archive`). A month can be archived
+    more than once, if logs were inserted for it after it was archived.
+    """
+
+    __tablename__ = "archived_partition"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    category = Column(String, nullable=False)
+    partition = Column(String, nullable=False)
+    # the logs of the partition are between `month_start` (inclusive) and
+    # `month_end` (exclusive)
+    month_start = Column(DateTime, nullable=False)
+    month_end = Column(DateTime, nullable=False)
+    file_path = Column(String, nullable=False)
+    row_count = Column(BigInteger, nullable=False)
+    file_size = Column(BigInteger, nullable=False)
+    archived_at = Column(DateTime, nullable=False, server_default=sqlalchemy.func.now())
+
+    def to_dict(self):
+        return {
+            column.name: getattr(self, column.name) for column in self.__table__.columns
+        }
+
+
+def get_resource_path_prefixes(resource_paths: Optional[list]) -> Optional[list]:
+    """
+    Return all the prefixes of the provided resource paths. For example,
+    ["/programs/A/projects/B"] returns:
+    ["/programs", "/programs/A", "/programs/A/projects", "/programs/A/projects/B"]
+    """
+    if resource_paths is None:
+        return None
+    prefixes = set()
+    for resource_path in resource_paths:
+        parts = resource_path.split("/")
+        for i in range(2, len(parts) + 1):
+            prefixes.add("/".join(parts[:i]))
+    return sorted(prefixes)
+
+
 # Pydantic input models for API endpoints
 class CreateLogInput(BaseModel):
     request_url: str
@@ -1,18 +1,33 @@
 import asyncio
-import boto3
 import json
 import traceback
+from datetime import datetime
+from sqlalchemy import text
 
 from . import logger
 from .config import config
 from .models import CATEGORY_TO_MODEL_CLASS
+from .utils.dedup import message_dedup_key
 from .utils.validate_utils import validate_presigned_url_log, validate_login_log
-from .db import get_data_access_layer
+from .db import get_data_access_layer, try_advisory_lock
+from .queues import get_queue_backend
+from .metrics import (
+    QUEUE_MESSAGES_QUARANTINED,
+    QUEUE_OPERATION_DURATION,
+    QUEUE_VISIBILITY_EXTENSIONS,
+    QUEUE_VISIBILITY_EXTENSION_FAILURES,
+)
+
+
+# arbitrary number identifying the queue consumer advisory locks. The
+# consumer slot number is used as the second half of the lock key.
+QUEUE_CONSUMER_LOCK_ID = 1096107073
 
 
 async def process_log(
     data,
     timestamp,
+    dedup_key=None,
 ):
     # check log category
     category = data.pop("category")
@@ -24,7 +39,11 @@ async def process_log(
     if not data.get("timestamp"):
         data["timestamp"] = timestamp
 
+    if dedup_key:
+        data["dedup_key"] = dedup_key
+
     async for data_access_layer in get_data_access_layer():
+        data_access_layer.source = "queue"
         # validate log
         if category == "presigned_url":
             validate_presigned_url_log(data)
@@ -34,82 +53,231 @@ async def process_log(
             await data_access_layer.create_login_log(data)
 
 
-async def pull_from_queue(sqs):
+async def extend_visibility(queue, in_flight):
+    """
+    Until cancelled, periodically extend the visibility timeout of the
+    messages that are still being processed, so they are not delivered again
+    to another consumer before we are done with them.
+
+    Args:
+        queue (QueueBackend): the queue the messages were received from
+        in_flight (dict): receipt handle to message, for the messages being
+            processed
+    """
+    interval = config["QUEUE_VISIBILITY_HEARTBEAT_SECONDS"]
+    visibility_timeout = config["QUEUE_VISIBILITY_TIMEOUT_SECONDS"]
+    while True:
+        await asyncio.sleep(interval)
+        if not in_flight:
+            continue
+        messages = list(in_flight.values())
+        try:
+            n_failures = await queue.extend_visibility(messages, visibility_timeout)
+        except Exception as e:
+            QUEUE_VISIBILITY_EXTENSION_FAILURES.inc(len(messages))
+            logger.error(f"Error extending the visibility of queue messages: {e}")
+            continue
+        QUEUE_VISIBILITY_EXTENSIONS.inc(len(messages) - n_failures)
+        if n_failures:
+            QUEUE_VISIBILITY_EXTENSION_FAILURES.inc(n_failures)
+            logger.warning(
+                f"Unable to extend the visibility of {n_failures} queue messages"
+            )
+        logger.debug(
+            f"Extended the visibility of {len(messages) - n_failures} queue messages by {visibility_timeout} seconds"
+        )
+
+
+async def handle_message(message):
+    """
+    Process a queue message.
+
+    Returns True if the message can be deleted from the queue: it was either
+    processed successfully, or it failed to be processed too many times
+    (`QUEUE_MAX_RECEIVE_COUNT`) and was moved to the quarantine table.
+    """
+    try:
+        data = json.loads(message.body)
+        await process_log(
+            data, message.sent_timestamp, dedup_key=message_dedup_key(message.id)
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error processing audit log: {e}")
+        traceback.print_exc()
+        error = e
+
+    max_receive_count = config["QUEUE_MAX_RECEIVE_COUNT"]
+    if not max_receive_count or message.receive_count < max_receive_count:
+        return False
+
+    try:
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.create_quarantined_message(
+                {
+                    "message_id": message.id,
+                    "body": message.body,
+                    "sent_timestamp": (
+                        datetime.fromtimestamp(message.sent_timestamp)
+                        if message.sent_timestamp
+                        else None
+                    ),
+                    "receive_count": message.receive_count,
+                    "error": str(error),
+                }
+            )
+    except Exception as e:
+        logger.error(f"Error quarantining queue message: {e}")
+        traceback.print_exc()
+        return False
+    QUEUE_MESSAGES_QUARANTINED.inc()
+    logger.warning(
+        f"Moved queue message {message.id} to quarantine after {message.receive_count} failed attempts"
+    )
+    return True
+
+
+async def pull_from_queue(queue):
+    """
+    Receive a batch of messages from the queue and process them.
+
+    Args:
+        queue (QueueBackend): the queue to pull from
+
+    Returns:
+        bool: whether the consumer should sleep before pulling again
+    """
     failed = False
     messages = []
     try:
-        response = sqs.receive_message(
-            QueueUrl=config["QUEUE_CONFIG"]["aws_sqs_config"]["sqs_url"],
-            MaxNumberOfMessages=10,  # 10 is the max allowed by AWS
-            AttributeNames=["SentTimestamp"],
-        )
-        messages = response.get("Messages", [])
+        with QUEUE_OPERATION_DURATION.time(operation="receive"):
+            messages = await queue.receive(max_messages=10)
     except Exception as e:
         failed = True
         logger.error(f"Error pulling from queue: {e}")
         traceback.print_exc()
 
-    for message in messages:
-        data = json.loads(message["Body"])
-        receipt_handle = message["ReceiptHandle"]
-        # when the message was sent to the queue
-        sent_timestamp = message["Attributes"]["SentTimestamp"]
-        timestamp = int(int(sent_timestamp) / 1000)  # ms to s
-        try:
-            await process_log(data, timestamp)
-        except Exception as e:
-            failed = True
-            logger.error(f"Error processing audit log: {e}")
-            traceback.print_exc()
-        else:
-            # delete message from queue once successfully processed
+    # extend the visibility of the messages while the batch is processed
+    in_flight = {message.receipt_handle: message for message in messages}
+    heartbeat = None
+    if in_flight and config["QUEUE_VISIBILITY_HEARTBEAT_SECONDS"]:
+        heartbeat = asyncio.create_task(extend_visibility(queue, in_flight))
+
+    n_handled = 0
+    try:
+        for message in messages:
             try:
-                sqs.delete_message(
-                    QueueUrl=config["QUEUE_CONFIG"]["aws_sqs_config"]["sqs_url"],
-                    ReceiptHandle=receipt_handle,
-                )
-            except Exception as e:
-                failed = True
-                logger.error(f"Error deleting message from queue: {e}")
-                traceback.print_exc()
+                with QUEUE_OPERATION_DURATION.time(operation="process"):
+                    handled = await handle_message(message)
+                if not handled:
+                    continue
+                n_handled += 1
+                # delete message from queue once successfully processed
+                # or quarantined
+                try:
+                    with QUEUE_OPERATION_DURATION.time(operation="delete"):
+                        await queue.delete(message)
+                except Exception as e:
+                    failed = True
+                    logger.error(f"Error deleting message from queue: {e}")
+                    traceback.print_exc()
+            finally:
+                in_flight.pop(message.receipt_handle, None)
+    finally:
+        if heartbeat:
+            heartbeat.cancel()
 
-    # if the queue is empty, or we failed to process a message: sleep
-    should_sleep = not messages or failed
+    # if the queue is empty, or we failed to process all the messages (for
+    # example if the DB is down): sleep. One bad message does not stop us
+    # from processing the rest of the queue.
+    should_sleep = not messages or failed or not n_handled
     return should_sleep
 
 
 async def pull_from_queue_loop():
     """
-    Note that `pull_from_queue_loop` and `pull_from_queue` only handle
-    AWS SQS right now.
+    Pull audit logs from the queue configured in `QUEUE_CONFIG`, forever.
     """
     logger.info("Starting to pull from queue...")
-    aws_sqs_config = config["QUEUE_CONFIG"]["aws_sqs_config"]
-    # we know the cred is in AWS_CREDENTIALS (see `AuditServiceConfig.validate`)
-    aws_creds = (
-        config["AWS_CREDENTIALS"][aws_sqs_config["aws_cred"]]
-        if "aws_cred" in aws_sqs_config and aws_sqs_config["aws_cred"]
-        else {}
-    )
-    if (
-        not aws_creds
-        and "aws_access_key_id" in aws_sqs_config
-        and "aws_secret_access_key" in aws_sqs_config
-    ):
-        # for backwards compatibility
-        aws_creds = {
-            "aws_access_key_id": aws_sqs_config["aws_access_key_id"],
-            "aws_secret_access_key": aws_sqs_config["aws_secret_access_key"],
-        }
-    sqs = boto3.client(
-        "sqs",
-        region_name=aws_sqs_config["region"],
-        aws_access_key_id=aws_creds.get("aws_access_key_id"),
-        aws_secret_access_key=aws_creds.get("aws_secret_access_key"),
-    )
+    queue = get_queue_backend()
+    if config["QUEUE_CONSUMER_COORDINATION"]:
+        await consume_queue_when_elected(queue)
+    else:
+        await consume_queue(queue)
+
+
+async def consume_queue(queue):
     sleep_time = config["PULL_FREQUENCY_SECONDS"]
     while True:
-        should_sleep = await pull_from_queue(sqs)
+        should_sleep = await pull_from_queue(queue)
         if should_sleep:
             logger.info(f"Sleeping for {sleep_time} seconds...")
             await asyncio.sleep(sleep_time)
+
+
+async def consume_queue_when_elected(queue):
+    """
+    Only consume the queue while holding one of the `QUEUE_MAX_CONSUMERS`
+    consumer slots, so that the number of consumers does not grow with the
+    number of workers and replicas. Slots are Postgres advisory locks: if the
+    worker holding a slot dies, its DB connection is closed, the lock is
+    released, and a waiting worker takes over the slot on its next attempt.
+    """
+    max_consumers = config["QUEUE_MAX_CONSUMERS"]
+    retry_time = config["QUEUE_CONSUMER_LOCK_RETRY_SECONDS"]
+    while True:
+        try:
+            for slot in range(max_consumers):
+                async with try_advisory_lock(
+                    QUEUE_CONSUMER_LOCK_ID, slot
+                ) as connection:
+                    if connection is None:
+                        continue
+                    logger.info(
+                        f"Acquired queue consumer slot {slot} (max {max_consumers} consumers)"
+                    )
+                    try:
+                        await consume_queue_while_connected(
+                            queue, connection, retry_time
+                        )
+                    finally:
+                        logger.warning(f"Released queue consumer slot {slot}")
+                break
+            else:
+                logger.debug(
+                    f"No available queue consumer slot, retrying in {retry_time} seconds..."
+                )
+        except Exception as e:
+            logger.error(f"Error consuming the queue: {e}")
+            traceback.print_exc()
+        await asyncio.sleep(retry_time)
+
+
+async def consume_queue_while_connected(queue, connection, check_interval):
+    """
+    Consume the queue until the connection holding the consumer lock is lost.
+    """
+
+    async def watch_connection():
+        while True:
+            await asyncio.sleep(check_interval)
+            try:
+                await connection.execute(text("SELECT 1"))
+                await connection.commit()
+            except Exception as e:
+                logger.error(f"Lost the connection holding the consumer lock: {e}")
+                return
+
+    consumer = asyncio.create_task(consume_queue(queue))
+    watcher = asyncio.create_task(watch_connection())
+    try:
+        await asyncio.wait([consumer, watcher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (consumer, watcher):
+            task.cancel()
+        # wait for the consumer to stop before the lock is released
+        consumer_result, _ = await asyncio.gather(
+            consumer, watcher, return_exceptions=True
+        )
+    if isinstance(consumer_result, Exception):
+        raise consumer_result
@@ -0,0 +1,102 @@
+"""
+Queue messages that fail to be processed `QUEUE_MAX_RECEIVE_COUNT` times are
+moved to the `quarantined_message` table. Once the cause of the failure is
+fixed (for example, support for a new log category was deployed), they can be
+processed again.
+
+Usage:
+- List quarantined messages: python -m audit.quarantine list
+- Process all quarantined messages again: python -m audit.quarantine replay
+- Process specific quarantined messages again: python -m audit.quarantine replay --id 1 --id 2
+"""
+import argparse
+import asyncio
+import json
+import traceback
+from typing import List, Optional, Tuple
+
+from . import logger
+from .db import get_data_access_layer, initiate_db
+from .pull_from_queue import process_log
+from .utils.dedup import message_dedup_key
+
+
+async def list_quarantined_messages() -> List[dict]:
+    async for data_access_layer in get_data_access_layer():
+        messages = await data_access_layer.get_quarantined_messages()
+    return [message.to_dict() for message in messages]
+
+
+async def replay_quarantined_messages(
+    ids: Optional[List[int]] = None,
+) -> Tuple[int, int]:
+    """
+    Process quarantined queue messages again. Messages that are processed
+    successfully are removed from the quarantine table. Messages that fail
+    again stay in the table, and their error is updated.
+
+    Args:
+        ids (list): IDs of the messages to replay. Default: all messages
+
+    Returns:
+        (int, int): number of messages replayed successfully, number of
+        messages that failed again
+    """
+    async for data_access_layer in get_data_access_layer():
+        messages = await data_access_layer.get_quarantined_messages(ids)
+
+    n_success = n_failure = 0
+    for message in messages:
+        timestamp = (
+            int(message.sent_timestamp.timestamp()) if message.sent_timestamp else None
+        )
+        try:
+            await process_log(
+                json.loads(message.body),
+                timestamp,
+                dedup_key=message_dedup_key(message.message_id),
+            )
+        except Exception as e:
+            n_failure += 1
+            logger.error(f"Error replaying quarantined message {message.id}: {e}")
+            traceback.print_exc()
+            async for data_access_layer in get_data_access_layer():
+                await data_access_layer.update_quarantined_message_error(
+                    message.id, str(e)
+                )
+            continue
+
+        n_success += 1
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.delete_quarantined_message(message.id)
+
+    logger.info(
+        f"Replayed {n_success} quarantined messages successfully, {n_failure} failed again"
+    )
+    return n_success, n_failure
+
+
+async def main(args) -> None:
+    await initiate_db()
+    if args.action == "list":
+        for message in await list_quarantined_messages():
+            print(json.dumps(message, default=str))
+    elif args.action == "replay":
+        await replay_quarantined_messages(args.id)
+
+
+if __name__ == "__main__":
+    # load the configuration
+    from . import app
+
+    parser = argparse.ArgumentParser(
+        description="Manage queue messages that failed to be processed"
+    )
+    parser.add_argument("action", choices=["list", "replay"])
+    parser.add_argument(
+        "--id",
+        type=int,
+        action="append",
+        help="ID of a quarantined message to replay (default: all)",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,32 @@
+"""
+Queues the service can pull audit logs from. The queue type is configured
+with `QUEUE_CONFIG.type`.
+
+To add a new type of queue, implement the `QueueBackend` interface and add it
+to `QUEUE_TYPES`.
+"""
+from .base import QueueBackend, QueueMessage
+from .aws_sqs import AwsSqsQueue
+from .local import LocalQueue
+from .postgres import PostgresQueue
+from ..config import config
+
+
+# `LocalQueue` is not listed: it is only used directly by tests and benchmarks
+QUEUE_TYPES = {
+    "aws_sqs": AwsSqsQueue,
+    "postgres": PostgresQueue,
+}
+
+queue_backend = None
+
+
+def get_queue_backend() -> QueueBackend:
+    """
+    Get the queue configured in `QUEUE_CONFIG.type`. The same instance is
+    returned on every call.
+    """
+    global queue_backend
+    if queue_backend is None:
+        queue_backend = QUEUE_TYPES[config["QUEUE_CONFIG"]["type"]]()
+    return queue_backend
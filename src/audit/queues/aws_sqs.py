@@ -0,0 +1,93 @@
+import boto3
+from typing import List
+
+from .base import QueueBackend, QueueMessage
+from ..config import config
+
+
+class AwsSqsQueue(QueueBackend):
+    """
+    Pull audit logs from an AWS SQS queue (`QUEUE_CONFIG.type` == "aws_sqs").
+    """
+
+    def __init__(self, sqs=None):
+        """
+        Args:
+            sqs: boto3 SQS client. Default: a client built from the
+                `QUEUE_CONFIG.aws_sqs_config` configuration
+        """
+        aws_sqs_config = config["QUEUE_CONFIG"]["aws_sqs_config"]
+        self.url = aws_sqs_config["sqs_url"]
+        self.sqs = sqs or self._create_client(aws_sqs_config)
+
+    @staticmethod
+    def _create_client(aws_sqs_config):
+        # we know the cred is in AWS_CREDENTIALS (see `AuditServiceConfig.validate`)
+        aws_creds = (
+            config["AWS_CREDENTIALS"][aws_sqs_config["aws_cred"]]
+            if "aws_cred" in aws_sqs_config and aws_sqs_config["aws_cred"]
+            else {}
+        )
+        if (
+            not aws_creds
+            and "aws_access_key_id" in aws_sqs_config
+            and "aws_secret_access_key" in aws_sqs_config
+        ):
+            # for backwards compatibility
+            aws_creds = {
+                "aws_access_key_id": aws_sqs_config["aws_access_key_id"],
+                "aws_secret_access_key": aws_sqs_config["aws_secret_access_key"],
+            }
+        return boto3.client(
+            "sqs",
+            region_name=aws_sqs_config["region"],
+            aws_access_key_id=aws_creds.get("aws_access_key_id"),
+            aws_secret_access_key=aws_creds.get("aws_secret_access_key"),
+        )
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        response = self.sqs.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, 10),  # 10 is the max allowed by AWS
+            AttributeNames=["SentTimestamp", "ApproximateReceiveCount"],
+        )
+        messages = []
+        for message in response.get("Messages", []):
+            attributes = message.get("Attributes", {})
+            sent_timestamp = attributes.get("SentTimestamp")
+            messages.append(
+                QueueMessage(
+                    id=message.get("MessageId"),
+                    body=message["Body"],
+                    receipt_handle=message["ReceiptHandle"],
+                    sent_timestamp=(
+                        int(int(sent_timestamp) / 1000)  # ms to s
+                        if sent_timestamp
+                        else None
+                    ),
+                    receive_count=int(attributes.get("ApproximateReceiveCount", 1)),
+                )
+            )
+        return messages
+
+    async def delete(self, message: QueueMessage) -> None:
+        self.sqs.delete_message(
+            QueueUrl=self.url,
+            ReceiptHandle=message.receipt_handle,
+        )
+
+    async def extend_visibility(
+        self, messages: List[QueueMessage], visibility_timeout: int
+    ) -> int:
+        response = self.sqs.change_message_visibility_batch(
+            QueueUrl=self.url,
+            Entries=[
+                {
+                    "Id": str(i),
+                    "ReceiptHandle": message.receipt_handle,
+                    "VisibilityTimeout": visibility_timeout,
+                }
+                for i, message in enumerate(messages)
+            ],
+        )
+        return len(response.get("Failed", []))
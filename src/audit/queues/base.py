@@ -0,0 +1,50 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import List, Optional
+
+
+@dataclass
+class QueueMessage:
+    """
+    A message received from a queue, independently of the queue type.
+    """
+
+    id: Optional[str]
+    body: str
+    # opaque value used to delete the message or extend its visibility
+    receipt_handle: str
+    # when the message was sent to the queue, in seconds
+    sent_timestamp: Optional[int]
+    # how many times the message was received, including this time
+    receive_count: int = 1
+
+
+class QueueBackend(ABC):
+    """
+    Interface to pull audit logs from a queue. Received messages are hidden
+    from other consumers until their visibility timeout expires; messages that
+    are not deleted before then are delivered again.
+    """
+
+    @abstractmethod
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        """
+        Receive up to `max_messages` messages. Returns an empty list if the
+        queue is empty.
+        """
+
+    @abstractmethod
+    async def delete(self, message: QueueMessage) -> None:
+        """
+        Delete a message that was processed, so it is not delivered again.
+        """
+
+    @abstractmethod
+    async def extend_visibility(
+        self, messages: List[QueueMessage], visibility_timeout: int
+    ) -> int:
+        """
+        Hide in-flight messages from other consumers for `visibility_timeout`
+        more seconds. Returns the number of messages whose visibility could
+        not be extended.
+        """
@@ -0,0 +1,98 @@
+import json
+import time
+import uuid
+from collections import deque
+from typing import List, Union
+
+from .base import QueueBackend, QueueMessage
+from ..config import config
+
+
+class LocalQueue(QueueBackend):
+    """
+    In-memory queue living in the current process. It behaves like an SQS
+    queue (visibility timeout, redelivery of messages that are not deleted,
+    receive count) but messages can only be sent to it from the same process,
+    using `send()`.
+
+    This allows running the log ingestion pipeline in tests and benchmarks,
+    without AWS access. It cannot be used by the service to pull audit logs
+    (`PULL_FROM_QUEUE`). Messages are lost when the process stops.
+    """
+
+    def __init__(self, visibility_timeout: int = None):
+        self.visibility_timeout = (
+            visibility_timeout or config["QUEUE_VISIBILITY_TIMEOUT_SECONDS"]
+        )
+        self._messages = deque()
+        # receipt handle -> (message, time at which the message is visible again)
+        self._in_flight = {}
+
+    def send(self, body: Union[dict, str]) -> str:
+        """
+        Add a message to the queue and return its ID.
+        """
+        message = QueueMessage(
+            id=str(uuid.uuid4()),
+            body=body if isinstance(body, str) else json.dumps(body),
+            receipt_handle="",
+            sent_timestamp=int(time.time()),
+            receive_count=0,
+        )
+        self._messages.append(message)
+        return message.id
+
+    def __len__(self) -> int:
+        """
+        Number of messages in the queue, including in-flight messages.
+        """
+        return len(self._messages) + len(self._in_flight)
+
+    def _requeue_expired(self) -> None:
+        now = time.monotonic()
+        for receipt_handle, (message, visible_at) in list(self._in_flight.items()):
+            if visible_at <= now:
+                del self._in_flight[receipt_handle]
+                self._messages.append(message)
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        self._requeue_expired()
+        messages = []
+        while self._messages and len(messages) < max_messages:
+            message = self._messages.popleft()
+            message.receive_count += 1
+            # a new receipt handle for each delivery, like SQS
+            message.receipt_handle = str(uuid.uuid4())
+            self._in_flight[message.receipt_handle] = (
+                message,
+                time.monotonic() + self.visibility_timeout,
+            )
+            messages.append(
+                QueueMessage(
+                    id=message.id,
+                    body=message.body,
+                    receipt_handle=message.receipt_handle,
+                    sent_timestamp=message.sent_timestamp,
+                    receive_count=message.receive_count,
+                )
+            )
+        return messages
+
+    async def delete(self, message: QueueMessage) -> None:
+        self._in_flight.pop(message.receipt_handle, None)
+
+    async def extend_visibility(
+        self, messages: List[QueueMessage], visibility_timeout: int
+    ) -> int:
+        n_failures = 0
+        for message in messages:
+            if message.receipt_handle not in self._in_flight:
+                # the message was delivered again with a new receipt handle
+                n_failures += 1
+                continue
+            in_flight_message, _ = self._in_flight[message.receipt_handle]
+            self._in_flight[message.receipt_handle] = (
+                in_flight_message,
+                time.monotonic() + visibility_timeout,
+            )
+        return n_failures
@@ -0,0 +1,83 @@
+import json
+from datetime import datetime
+from typing import List, Union
+
+from .base import QueueBackend, QueueMessage
+from ..config import config
+from ..db import get_data_access_layer
+
+
+class PostgresQueue(QueueBackend):
+    """
+    Pull audit logs from the `queue_message` table of the audit database
+    (`QUEUE_CONFIG.type` == "postgres"), to run the log ingestion pipeline
+    without AWS access, for example on a laptop or a CI box. It behaves like
+    an SQS queue (visibility timeout, redelivery of messages that are not
+    deleted, receive count). Consumers receive messages with
+    `SELECT ... FOR UPDATE SKIP LOCKED`, so several consumers can pull from it
+    at the same time.
+
+    Any process that can connect to the database can send audit logs, by
+    inserting the JSON messages:
+
+        INSERT INTO queue_message (body) VALUES ('{"category": "login", ...}');
+
+    or by calling `send()`.
+    """
+
+    def __init__(self, visibility_timeout: int = None):
+        self.visibility_timeout = (
+            visibility_timeout or config["QUEUE_VISIBILITY_TIMEOUT_SECONDS"]
+        )
+
+    @staticmethod
+    def _parse_receipt_handle(receipt_handle: str):
+        # a new receipt handle for each delivery, like SQS
+        id, receive_count = receipt_handle.split(":")
+        return int(id), int(receive_count)
+
+    async def send(self, body: Union[dict, str]) -> str:
+        """
+        Add a message to the queue and return its ID.
+        """
+        async for data_access_layer in get_data_access_layer():
+            id = await data_access_layer.send_queue_message(
+                body if isinstance(body, str) else json.dumps(body)
+            )
+        return str(id)
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        async for data_access_layer in get_data_access_layer():
+            rows = await data_access_layer.receive_queue_messages(
+                max_messages, self.visibility_timeout
+            )
+        return [
+            QueueMessage(
+                id=str(row.id),
+                body=row.body,
+                receipt_handle=f"{row.id}:{row.receive_count}",
+                sent_timestamp=int(datetime.timestamp(row.sent_at)),
+                receive_count=row.receive_count,
+            )
+            for row in rows
+        ]
+
+    async def delete(self, message: QueueMessage) -> None:
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.delete_queue_message(
+                *self._parse_receipt_handle(message.receipt_handle)
+            )
+
+    async def extend_visibility(
+        self, messages: List[QueueMessage], visibility_timeout: int
+    ) -> int:
+        n_failures = 0
+        async for data_access_layer in get_data_access_layer():
+            for message in messages:
+                if not await data_access_layer.update_queue_message_visibility(
+                    *self._parse_receipt_handle(message.receipt_handle),
+                    visibility_timeout,
+                ):
+                    # the message was delivered again with a new receipt handle
+                    n_failures += 1
+        return n_failures
@@ -0,0 +1,198 @@
+"""
+Audit logs are removed once they are older than the retention period of their
+category (`RETENTION_POLICY`), one monthly partition at a time. Removing a
+partition only changes the catalog, so it takes the same time whatever the
+number of logs, unlike a `DELETE`, which scans the rows, writes each of them
+to the WAL and leaves them for VACUUM to clean up.
+
+A partition is removed once all its logs are older than the retention period:
+with a 12 months retention, the logs of January 2024 are removed in February
+2025. Partitions are dropped, detached or archived. Detached partitions are no
+longer queried, but are kept as `<partition>_detached` tables until they are
+backed up and dropped manually. Archived partitions are written to Parquet
+files that audit log queries still read (see `audit.archive`).
+
+Removing a partition waits for the queries reading it to end. So that queries
+and ingestion do not queue up behind it in the meantime, it gives up after
+`RETENTION_LOCK_TIMEOUT_SECONDS`, and is tried again on the next run.
+
+Usage:
+- Show the partitions that would be removed: python -m audit.retention --dry-run
+- Apply the retention policy: python -m audit.retention
+
+The service also applies the retention policy every
+`RETENTION_INTERVAL_SECONDS`, on one worker at a time (only logging what it
+would do if `RETENTION_DRY_RUN` is enabled).
+"""
+import argparse
+import asyncio
+import json
+import traceback
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy.exc import DBAPIError
+
+from . import logger
+from .archive import PartitionChangedError, archive_partition
+from .config import config
+from .db import (
+    LOCK_NOT_AVAILABLE,
+    get_data_access_layer,
+    get_partition_month,
+    initiate_db,
+    try_advisory_lock,
+)
+from .metrics import PARTITIONS_REMOVED
+from .models import CATEGORY_TO_MODEL_CLASS
+
+
+# arbitrary number identifying the retention advisory lock
+RETENTION_LOCK_ID = 1096107074
+
+
+def get_retention_cutoff(months: int, now: Optional[datetime] = None) -> datetime:
+    """
+    Get the first day of the oldest month to keep: the partitions of the
+    previous months only contain logs older than `months` months.
+    """
+    now = now or datetime.now()
+    month_index = now.year * 12 + now.month - 1 - months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+async def get_expired_partitions() -> List[dict]:
+    """
+    Get the partitions that the retention policy would remove, oldest first.
+    """
+    expired = []
+    for category, policy in config["RETENTION_POLICY"].items():
+        if category not in CATEGORY_TO_MODEL_CLASS:
+            raise Exception(
+                f"Config 'RETENTION_POLICY': unknown log category '{category}'"
+            )
+        model = CATEGORY_TO_MODEL_CLASS[category]
+        cutoff = get_retention_cutoff(policy["months"])
+        async for data_access_layer in get_data_access_layer():
+            partitions = []
+            for partition in await data_access_layer.get_partitions(model):
+                month = get_partition_month(partition)
+                if month is not None and month < cutoff:
+                    partitions.append(partition)
+            estimates = await data_access_layer.get_partition_row_estimates(partitions)
+        expired.extend(
+            {
+                "category": category,
+                "partition": partition,
+                "action": policy["action"],
+                "estimated_rows": estimates.get(partition, 0),
+            }
+            for partition in partitions
+        )
+    return expired
+
+
+async def remove_partition(category: str, partition: str, action: str) -> bool:
+    """
+    Drop, detach or archive a partition. Returns False if the partition was
+    being read or written to for longer than `RETENTION_LOCK_TIMEOUT_SECONDS`,
+    or if logs were inserted into it while it was being archived.
+    """
+    model = CATEGORY_TO_MODEL_CLASS[category]
+    try:
+        if action == "archive":
+            await archive_partition(category, partition)
+        else:
+            async for data_access_layer in get_data_access_layer():
+                await data_access_layer.set_lock_timeout(
+                    config["RETENTION_LOCK_TIMEOUT_SECONDS"]
+                )
+                if action == "drop":
+                    await data_access_layer.drop_partition(partition)
+                elif action == "detach":
+                    detached = await data_access_layer.detach_partition(
+                        model, partition
+                    )
+                    logger.info(f"Partition {partition} was renamed {detached}")
+                else:
+                    raise Exception(f"Unknown retention action '{action}'")
+    except PartitionChangedError as e:
+        logger.warning(f"{e}, it will be archived on the next run")
+        return False
+    except DBAPIError as e:
+        if getattr(e.orig, "sqlstate", None) != LOCK_NOT_AVAILABLE:
+            raise
+        logger.warning(
+            f"Partition {partition} is in use, it will be removed on the next run"
+        )
+        return False
+    PARTITIONS_REMOVED.inc(category=category, action=action)
+    return True
+
+
+async def apply_retention_policy(dry_run: bool = False) -> List[dict]:
+    """
+    Remove the partitions that only contain logs older than the retention
+    period of their category. With `dry_run`, only log what would be done.
+
+    Returns:
+        list: the partitions that were removed (with `dry_run`: that would
+        be removed), with their category, action and estimated number of rows
+    """
+    removed = []
+    for expired in await get_expired_partitions():
+        description = (
+            f"{expired['action']} partition {expired['partition']} "
+            f"(~{expired['estimated_rows']} audit logs)"
+        )
+        if dry_run:
+            logger.info(f"Dry run: would {description}")
+            removed.append(expired)
+            continue
+        logger.info(f"Retention policy: {description}")
+        try:
+            if await remove_partition(
+                expired["category"], expired["partition"], expired["action"]
+            ):
+                removed.append(expired)
+        except Exception as e:
+            logger.error(f"Unable to {description}: {e}")
+            traceback.print_exc()
+    return removed
+
+
+async def retention_loop() -> None:
+    """
+    Apply the retention policy every `RETENTION_INTERVAL_SECONDS`, forever.
+    Workers that find another worker applying it skip their turn.
+    """
+    while True:
+        try:
+            async with try_advisory_lock(RETENTION_LOCK_ID, 0) as connection:
+                if connection is not None:
+                    await apply_retention_policy(dry_run=config["RETENTION_DRY_RUN"])
+        except Exception as e:
+            logger.error(f"Error applying the retention policy: {e}")
+            traceback.print_exc()
+        await asyncio.sleep(config["RETENTION_INTERVAL_SECONDS"])
+
+
+async def main(args) -> None:
+    await initiate_db()
+    for partition in await apply_retention_policy(dry_run=args.dry_run):
+        print(json.dumps(partition))
+
+
+if __name__ == "__main__":
+    # load the configuration
+    from . import app
+
+    parser = argparse.ArgumentParser(
+        description="Remove the audit log partitions older than the retention policy"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only show the partitions that would be removed",
+    )
+    asyncio.run(main(parser.parse_args()))
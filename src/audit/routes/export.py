@@ -0,0 +1,190 @@
+import os
+import uuid
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query
+from starlette.requests import Request
+from starlette.responses import FileResponse, RedirectResponse
+from starlette.status import (
+    HTTP_200_OK,
+    HTTP_202_ACCEPTED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+)
+
+from .. import logger
+from ..auth import Auth
+from ..db import DataAccessLayer, get_data_access_layer
+from ..export import EXPORT_FORMATS, get_download_url, get_export_format
+from ..models import CATEGORY_TO_MODEL_CLASS, ExportJob
+from ..utils.responses import TIMESTAMP_FORMATS
+from .query import SPECIAL_QUERY_PARAMS, get_authorized_scope, parse_query_params
+
+
+router = APIRouter()
+
+
+async def _get_own_export_job(
+    job_id: str, auth: Auth, data_access_layer: DataAccessLayer
+) -> ExportJob:
+    """
+    Get an export job requested by the current user. Jobs requested by other
+    users are reported as not found.
+    """
+    token_claims = await auth.get_token_claims()
+    job = await data_access_layer.get_export_job(job_id)
+    if not job or job.requested_by != str(token_claims["sub"]):
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Export job '{job_id}' not found")
+    return job
+
+
+@router.post("/export/{category}", status_code=HTTP_202_ACCEPTED)
+async def create_export_job(
+    request: Request,
+    category: str,
+    start: int = Query(None, description="Start timestamp"),
+    stop: int = Query(None, description="Stop timestamp"),
+    file_format: str = Query(
+        "ndjson",
+        alias="format",
+        description="Format of the file: 'ndjson' (one JSON document per log), 'parquet' or 'arrow' (Arrow IPC stream)",
+    ),
+    timestamp_format: str = Query(
+        "iso",
+        description="Format of the exported timestamps in 'ndjson' files: 'iso' (ISO 8601) or 'epoch' (Unix timestamp)",
+    ),
+    auth=Depends(Auth),
+    data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
+) -> dict:
+    """
+    Export all the logs the current user has access to see and that match the
+    query to a file, in the background. Accepts the same filters as
+    `GET /log/{category}`, except `groupby` and `count`. Exports are not
+    time-boxed. If `stop` is not provided, the logs created until now are
+    exported.
+
+    Returns the export job, whose status can be checked with
+    `GET /export/{job_id}`. Once the job is completed, the file can be
+    downloaded with `GET /export/{job_id}/download`.
+
+    Files are in one of the following formats:
+    - `ndjson` (default): one JSON document per log.
+    - `parquet`: Parquet file, for dataframe tools such as pandas or Spark.
+    - `arrow`: Arrow IPC stream.
+
+    In the columnar formats (`parquet` and `arrow`), array fields such as
+    `resource_paths` are list columns and `additional_data` is a JSON
+    string.
+    """
+    if category not in CATEGORY_TO_MODEL_CLASS:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"Category '{category}' is not one of {list(CATEGORY_TO_MODEL_CLASS.keys())}",
+        )
+    model = CATEGORY_TO_MODEL_CLASS[category]
+    resource_path_prefixes = await get_authorized_scope(auth, category)
+    token_claims = await auth.get_token_claims()
+
+    if file_format not in EXPORT_FORMATS:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"'format' must be one of {list(EXPORT_FORMATS)}",
+        )
+    if timestamp_format not in TIMESTAMP_FORMATS:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"'timestamp_format' must be one of {list(TIMESTAMP_FORMATS)}",
+        )
+    try:
+        start_date = datetime.fromtimestamp(start) if start else None
+        stop_date = datetime.fromtimestamp(stop) if stop else datetime.now()
+    except (OverflowError, OSError, ValueError):
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"Unable to convert timestamps '{start}' and/or '{stop}' to datetimes",
+        )
+    if start_date and start_date >= stop_date:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"The start timestamp '{start}' ({start_date}) should be before the stop timestamp '{stop}' ({stop_date})",
+        )
+
+    query_params, groupby, count = parse_query_params(
+        request, model, category, SPECIAL_QUERY_PARAMS | {"format"}
+    )
+    if groupby or count:
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            "'groupby' and 'count' are not supported by exports",
+        )
+
+    job = await data_access_layer.create_export_job(
+        {
+            "id": str(uuid.uuid4()),
+            "requested_by": str(token_claims["sub"]),
+            "category": category,
+            "parameters": {
+                "filters": {
+                    field: sorted(values) for field, values in query_params.items()
+                },
+                "resource_path_prefixes": resource_path_prefixes,
+                "format": file_format,
+                "timestamp_format": timestamp_format,
+            },
+            "start_timestamp": start_date,
+            "stop_timestamp": stop_date,
+        }
+    )
+    logger.info(f"Created export job {job.id} for category {category}")
+    return job.to_dict()
+
+
+@router.get("/export/{job_id}", status_code=HTTP_200_OK)
+async def get_export_job(
+    job_id: str,
+    auth=Depends(Auth),
+    data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
+) -> dict:
+    """
+    Get the status of an export job requested by the current user: one of
+    "pending", "running", "completed" or "failed". "exported_count" is the
+    number of logs exported so far.
+    """
+    job = await _get_own_export_job(job_id, auth, data_access_layer)
+    return job.to_dict()
+
+
+@router.get("/export/{job_id}/download", status_code=HTTP_200_OK)
+async def download_export(
+    job_id: str,
+    auth=Depends(Auth),
+    data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
+):
+    """
+    Download the file of a completed export job requested by the current
+    user. If the file was uploaded to S3, redirects to a presigned URL.
+    """
+    job = await _get_own_export_job(job_id, auth, data_access_layer)
+    if job.status != "completed":
+        raise HTTPException(
+            HTTP_409_CONFLICT,
+            f"Export job '{job_id}' is {job.status}, not completed",
+        )
+
+    download_url = get_download_url(job)
+    if download_url:
+        return RedirectResponse(download_url)
+    if not os.path.exists(job.file_path):
+        logger.error(f"The file of export job {job_id} does not exist")
+        raise HTTPException(HTTP_404_NOT_FOUND, "Export file not found")
+    writer_class = EXPORT_FORMATS[get_export_format(job)]
+    return FileResponse(
+        job.file_path,
+        media_type=writer_class.media_type,
+        filename=f"{job.category}-{job_id}.{writer_class.extension}",
+    )
+
+
+def init_app(app: FastAPI):
+    app.include_router(router, tags=["Export"])
@@ -1,5 +1,5 @@
 from datetime import datetime
-from fastapi import APIRouter, BackgroundTasks, Depends, FastAPI, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, FastAPI, Header, HTTPException
 from starlette.status import (
     HTTP_201_CREATED,
     HTTP_400_BAD_REQUEST,
@@ -7,6 +7,7 @@ from starlette.status import (
 
 from .. import logger
 from ..auth import Auth
+from ..utils.dedup import request_dedup_key
 from ..utils.validate_utils import (
     validate_login_log,
     validate_presigned_url_log,
@@ -23,6 +24,7 @@ router = APIRouter()
 @router.post("/log/presigned_url", status_code=HTTP_201_CREATED)
 async def create_presigned_url_log(
     body: CreatePresignedUrlLogInput,
+    idempotency_key: str = Header(None, alias="Idempotency-Key"),
     auth=Depends(Auth),
     data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
 ) -> None:
@@ -38,8 +40,12 @@ async def create_presigned_url_log(
     The response is returned _before_ inserting the new audit log in the
     database, so that POSTing audit logs does not impact the performance of
     the caller and audit-service failures are not visible to users.
+
+    If deduplication is enabled, requests retried with the same
+    `Idempotency-Key` header only create one audit log.
     """
     data = body.model_dump()
+    data["dedup_key"] = request_dedup_key(idempotency_key)
     validate_presigned_url_log(data)
     try:
         await data_access_layer.create_presigned_url_log(data)
@@ -53,6 +59,7 @@ async def create_presigned_url_log(
 @router.post("/log/login", status_code=HTTP_201_CREATED)
 async def create_login_log(
     body: CreateLoginLogInput,
+    idempotency_key: str = Header(None, alias="Idempotency-Key"),
     auth=Depends(Auth),
     data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
 ) -> None:
@@ -68,8 +75,12 @@ async def create_login_log(
     The response is returned _before_ inserting the new audit log in the
     database, so that POSTing audit logs does not impact the performance of
     the caller and audit-service failures are not visible to users.
+
+    If deduplication is enabled, requests retried with the same
+    `Idempotency-Key` header only create one audit log.
     """
     data = body.model_dump()
+    data["dedup_key"] = request_dedup_key(idempotency_key)
     validate_login_log(data)
     try:
         await data_access_layer.create_login_log(data)
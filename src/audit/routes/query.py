@@ -1,31 +1,126 @@
 from collections import defaultdict
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query
 from starlette.requests import Request
 from starlette.status import (
     HTTP_200_OK,
     HTTP_400_BAD_REQUEST,
+    HTTP_403_FORBIDDEN,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
 
 from .. import logger
+from ..archive import count_archived_logs, merge_archived_groups, merge_archived_logs
 from ..auth import Auth
 from ..config import config
 from ..models import CATEGORY_TO_MODEL_CLASS
-from ..db import DataAccessLayer, get_data_access_layer
+from ..db import QueryRejectedError, query_data_access_layer
+from ..metrics import QUERIES_COALESCED
+from ..utils.coalesce import SingleFlight
+from ..utils.responses import TIMESTAMP_FORMATS, LogsJSONResponse
+from ..utils.timing import timed
 from ..utils.validate_utils import validate_and_normalize_times
 
 
 router = APIRouter()
 
+# query parameters that are not filters on the audit log fields, and are
+# handled separately from `groupby`
+SPECIAL_QUERY_PARAMS = {"start", "stop", "count", "timestamp_format"}
 
-@router.get("/log/{category}", status_code=HTTP_200_OK)
+# running queries, shared by identical concurrent requests
+query_flights = SingleFlight(QUERIES_COALESCED)
+
+
+async def get_authorized_scope(auth: Auth, category: str) -> Optional[List[str]]:
+    """
+    Check that the user can read audit logs of this category. Returns None if
+    the user can read all of them, or the prefixes of the resource paths of
+    the logs the user can read.
+    """
+    resource_path = f"/services/audit/{category}"
+    resource_path_prefixes = None
+    if category == "presigned_url":
+        # users who do not have access to all the `presigned_url` logs can
+        # query the logs of the resources they have `audit` `read` access on,
+        # for example `/programs/A/projects/B`. Resources under `/services`
+        # are not data resources.
+        if not await auth.authorize("read", [resource_path], throw=False):
+            resource_path_prefixes = [
+                path.rstrip("/")
+                for path in await auth.get_authorized_resource_paths("read")
+                if not path.startswith("/services")
+            ]
+            if not resource_path_prefixes:
+                raise HTTPException(HTTP_403_FORBIDDEN, "Permission denied")
+    else:
+        await auth.authorize("read", [resource_path])
+
+    return resource_path_prefixes
+
+
+def parse_query_params(
+    request: Request,
+    model,
+    category: str,
+    special_params: Set[str] = SPECIAL_QUERY_PARAMS,
+) -> Tuple[Dict[str, Set[str]], Set[str], bool]:
+    """
+    Parse the filters, `groupby` and `count` query parameters. The
+    `special_params` are not filters and are ignored.
+
+    Returns:
+        (dict, set, bool): values of each field to filter on, fields to
+        group by, and whether to only count the logs
+    """
+    query_params = defaultdict(set)
+    groupby = set()
+    count = False
+    for key, value in request.query_params.multi_items():
+        if key == "count":
+            count = True
+
+        if key in special_params:
+            continue
+
+        if key == "groupby":
+            groupby.add(value)
+            field = value
+        else:
+            query_params[key].add(value)
+            field = key
+
+        try:
+            getattr(model, field)
+        except AttributeError as e:
+            raise HTTPException(
+                HTTP_400_BAD_REQUEST,
+                f"'{field}' is not allowed on category '{category}'",
+            )
+
+    if not config["QUERY_USERNAMES"] and (
+        "username" in query_params or "username" in groupby
+    ):
+        raise HTTPException(
+            HTTP_400_BAD_REQUEST,
+            f"Querying by username is not allowed",
+        )
+
+    return query_params, groupby, count
+
+
+@router.get("/log/{category}", status_code=HTTP_200_OK, response_class=LogsJSONResponse)
 async def query_logs(
     request: Request,
     category: str,
     start: int = Query(None, description="Start timestamp"),
     stop: int = Query(None, description="Stop timestamp"),
+    timestamp_format: str = Query(
+        "iso",
+        description="Format of the returned timestamps: 'iso' (ISO 8601) or 'epoch' (Unix timestamp)",
+    ),
     auth=Depends(Auth),
-    data_access_layer: DataAccessLayer = Depends(get_data_access_layer),
 ) -> dict:
     """
     Queries the logs the current user has access to see. Returned data:
@@ -43,12 +138,17 @@ async def query_logs(
     most recent), so that new entries are at the end and there is no risk of
     skipping entries when getting the next page.
 
+    The entries of months that were archived by the retention policy are
+    also returned, unless the service is configured not to query archives.
+
     Filters can be added as query strings. Accepted filters include all fields
     for the queried category, as well as the following special filters:
     - "groupby" to get counts
     - "count" to get the number of rows instead of a list
     - "start" to specify a starting timestamp (inclusive). Default: none
     - "stop" to specify an end timestamp (exclusive). Default: none
+    - "timestamp_format" to get the timestamps as ISO 8601 strings ("iso")
+      or Unix timestamps ("epoch"). Default: "iso"
 
     If queries are time-boxed (depends on the configuration),
     ("stop" - "start") must be lower than the configured maximum.
@@ -100,71 +200,121 @@ async def query_logs(
         )
     model = CATEGORY_TO_MODEL_CLASS[category]
 
-    # TODO if the category is `presigned_url`, we could implement more granular authz using the audit logs' `resource_paths`.
-    resource_path = f"/services/audit/{category}"
-    await auth.authorize("read", [resource_path])
-
-    try:
-        start, start_date, stop, stop_date = validate_and_normalize_times(start, stop)
-    except ValueError as e:
-        raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
-
-    query_params = defaultdict(set)
-    groupby = set()
-    count = False
-    for key, value in request.query_params.multi_items():
-        if key == "count":
-            count = True
-
-        if key in {"start", "stop", "count"}:
-            continue
-
-        if key == "groupby":
-            groupby.add(value)
-            field = value
-        else:
-            query_params[key].add(value)
-            field = key
+    resource_path_prefixes = await get_authorized_scope(auth, category)
 
+    with timed("validation"):
         try:
-            getattr(model, field)
-        except AttributeError as e:
+            start, start_date, stop, stop_date = validate_and_normalize_times(
+                start, stop
+            )
+        except ValueError as e:
+            raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+        if timestamp_format not in TIMESTAMP_FORMATS:
             raise HTTPException(
                 HTTP_400_BAD_REQUEST,
-                f"'{field}' is not allowed on category '{category}'",
+                f"'timestamp_format' must be one of {list(TIMESTAMP_FORMATS)}",
             )
 
-    if not config["QUERY_USERNAMES"] and (
-        "username" in query_params or "username" in groupby
-    ):
-        raise HTTPException(
-            HTTP_400_BAD_REQUEST,
-            f"Querying by username is not allowed",
-        )
+        query_params, groupby, count = parse_query_params(request, model, category)
+
+    # stop querying the database if the client disconnects, for example when
+    # a dashboard request is abandoned (see `ClientDisconnectMiddleware`)
+    add_close_watcher = request.scope.get("add_close_watcher")
+    if add_close_watcher:
+        add_close_watcher()
+
+    async def run_query():
+        # queries use the read replica when there is one
+        async with query_data_access_layer(stop_date, category) as data_access_layer:
+            archived_partitions = []
+            if config["QUERY_ARCHIVES"]:
+                archived_partitions = await data_access_layer.get_archived_partitions(
+                    category, start_date, stop_date
+                )
+            if groupby:
+                logs = await data_access_layer.query_logs_with_grouping(
+                    model,
+                    start_date,
+                    stop_date,
+                    query_params,
+                    groupby,
+                    resource_path_prefixes,
+                )
+                next_timestamp = None
+            else:
+                logs, next_timestamp = await data_access_layer.query_logs(
+                    model,
+                    start_date,
+                    stop_date,
+                    query_params,
+                    count,
+                    resource_path_prefixes,
+                )
+
+        # the archive files are read once the database connection is released
+        archive_filters = (start_date, stop_date, query_params, resource_path_prefixes)
+        if archived_partitions and groupby:
+            logs = await merge_archived_groups(
+                archived_partitions, *archive_filters, groupby, logs
+            )
+        elif archived_partitions and count:
+            archived_count = await count_archived_logs(
+                archived_partitions, *archive_filters
+            )
+            return len(logs) + archived_count, None
+        elif archived_partitions:
+            logs, next_timestamp = await merge_archived_logs(
+                archived_partitions, *archive_filters, logs, next_timestamp
+            )
+        return (len(logs) if count else logs), next_timestamp
 
     try:
-        if groupby:
-            logs = await data_access_layer.query_logs_with_grouping(
-                model, start_date, stop_date, query_params, groupby
+        if config["QUERY_COALESCING"]:
+            # identical concurrent queries, from users who are authorized to
+            # see the same logs, share the same DB queries
+            key = (
+                category,
+                start_date,
+                stop_date,
+                frozenset((k, frozenset(v)) for k, v in query_params.items()),
+                frozenset(groupby),
+                count,
+                (
+                    frozenset(resource_path_prefixes)
+                    if resource_path_prefixes is not None
+                    else None
+                ),
             )
-            next_timestamp = None
+            data, next_timestamp = await query_flights.do(key, run_query)
         else:
-            logs, next_timestamp = await data_access_layer.query_logs(
-                model, start_date, stop_date, query_params, count
-            )
+            data, next_timestamp = await run_query()
     except ValueError as e:
+        # invalid filters, or QueryTooExpensiveError
         raise HTTPException(HTTP_400_BAD_REQUEST, str(e))
+    except QueryRejectedError as e:
+        raise HTTPException(
+            HTTP_503_SERVICE_UNAVAILABLE,
+            str(e),
+            headers={"Retry-After": str(config["QUERY_RETRY_AFTER_SECONDS"])},
+        )
 
-    if not config["QUERY_USERNAMES"]:
-        # TODO: excluding usernames from the query might be more efficient
-        for log in logs:
+    if not config["QUERY_USERNAMES"] and not count:
+        # TODO: excluding usernames from the query might be more efficient.
+        # NOTE: `data` may be shared with other requests (see
+        # `QUERY_COALESCING`), so this must remain idempotent
+        for log in data:
             if "username" in log:
                 del log["username"]
 
-    return {
-        "nextTimeStamp": next_timestamp,
-        "data": len(logs) if count else logs,
-    }
+    # return the response directly to skip FastAPI's generic encoding
+    with timed("serialization"):
+        return LogsJSONResponse(
+            {
+                "nextTimeStamp": next_timestamp,
+                "data": data,
+            },
+            timestamp_format=timestamp_format,
+        )
 
 
 def init_app(app: FastAPI):
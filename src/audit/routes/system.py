@@ -2,9 +2,11 @@ import json, hashlib
 from pydantic import BaseModel
 from typing import Type
 from fastapi import APIRouter, FastAPI, Request, Depends
+from fastapi.responses import PlainTextResponse
 from typing import Union, get_args, get_origin
 
 from ..db import DataAccessLayer, get_data_access_layer
+from ..metrics import generate_latest
 
 from ..models import CreateLoginLogInput, CreatePresignedUrlLogInput
 
@@ -105,5 +107,17 @@ async def get_status(
     return dict(status="OK")
 
 
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    """
+    GET the metrics of the service in the Prometheus text format: request
+    latencies, ingested audit logs, queue operation timings and DB pool usage.
+    With several workers, the metrics of all the workers are combined.
+    """
+    return PlainTextResponse(
+        generate_latest(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 def init_app(app: FastAPI) -> None:
     app.include_router(router, tags=["System"])
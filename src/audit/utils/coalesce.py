@@ -0,0 +1,47 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from ..metrics import Counter
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls: while a call for a key is running,
+    callers with the same key wait for its result instead of making the same
+    call again. Results are not kept after the call is done.
+
+    The call runs in its own task, so that it is not cancelled when only some
+    of the callers are cancelled. It is cancelled when all of them are.
+    """
+
+    def __init__(self, metric: Optional[Counter] = None):
+        # number of callers who reused a running call
+        self.metric = metric
+        # (task, number of callers waiting for it), by key
+        self._calls: Dict[Hashable, list] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call:
+            call[1] += 1
+            if self.metric:
+                self.metric.inc()
+        else:
+            task = asyncio.get_running_loop().create_task(function())
+            call = self._calls[key] = [task, 1]
+            task.add_done_callback(lambda _: self._forget(key, call))
+
+        task = call[0]
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            call[1] -= 1
+            if call[1] == 0 and not task.done():
+                # new callers must not wait for the cancelled call
+                self._forget(key, call)
+                task.cancel()
+            raise
+
+    def _forget(self, key: Hashable, call: list) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,68 @@
+"""
+Columnar (Apache Arrow) encoding of audit logs, for exports loaded into
+dataframe tools such as pandas or Spark, and for archived partitions (see
+`audit.archive`).
+
+Logs are converted to Arrow record batches one column at a time, straight
+from the ORM objects, without building a dict per log. Array columns such as
+`resource_paths` become list columns. JSON columns such as `additional_data`
+are encoded as JSON strings, since their content differs from log to log.
+"""
+import json
+from typing import Collection, List
+
+import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
+import pyarrow.fs
+import pyarrow.parquet
+from sqlalchemy import JSON, BigInteger, Column, DateTime, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from ..models import AuditLog
+
+
+def _get_arrow_type(column_type) -> "pyarrow.DataType":
+    if isinstance(column_type, ARRAY):
+        return pyarrow.list_(_get_arrow_type(column_type.item_type))
+    # BigInteger is an Integer too
+    if isinstance(column_type, BigInteger):
+        return pyarrow.int64()
+    if isinstance(column_type, Integer):
+        return pyarrow.int32()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp("us")
+    # strings, and JSON encoded as strings
+    return pyarrow.string()
+
+
+class ArrowEncoder:
+    """
+    Convert audit logs of one category to Arrow record batches, that all
+    have the same schema.
+    """
+
+    def __init__(self, model, exclude: Collection[str] = ()):
+        self.columns: List[Column] = [
+            column for column in model.__table__.columns if column.name not in exclude
+        ]
+        self.schema = pyarrow.schema(
+            [
+                pyarrow.field(
+                    column.name, _get_arrow_type(column.type), nullable=column.nullable
+                )
+                for column in self.columns
+            ]
+        )
+
+    def encode(self, logs: List[AuditLog]) -> "pyarrow.RecordBatch":
+        arrays = []
+        for column, field in zip(self.columns, self.schema):
+            values = [getattr(log, column.name) for log in logs]
+            if isinstance(column.type, JSON):
+                values = [
+                    None if value is None else json.dumps(value, separators=(",", ":"))
+                    for value in values
+                ]
+            arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
@@ -0,0 +1,121 @@
+"""
+Negotiated compression of responses (`Accept-Encoding` header).
+
+Query pages and exports are large and repetitive JSON documents. They are
+compressed with zstd when the client accepts it, and with gzip otherwise.
+Streamed responses are compressed chunk by chunk, so they are not buffered in
+memory. Other responses are small, and are not compressed.
+"""
+import re
+from typing import Dict
+
+import zstandard
+from starlette.datastructures import Headers
+from starlette.middleware import gzip
+from starlette.middleware.gzip import IdentityResponder
+
+from ..config import config
+
+
+# audit log queries, and export job status and downloads
+COMPRESSED_PATHS = re.compile(r"^/(log|export)/")
+
+# content types that are already compressed, such as Parquet export files
+# (see `audit.export`)
+EXCLUDED_CONTENT_TYPES = (
+    "application/vnd.apache.parquet",
+    "application/gzip",
+    "application/zstd",
+)
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """
+    Parse an `Accept-Encoding` header: "gzip, zstd;q=0.5" => {"gzip": 1.0,
+    "zstd": 0.5}. Invalid quality values are ignored.
+    """
+    encodings = {}
+    for part in header.split(","):
+        coding, *params = [value.strip() for value in part.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        encodings[coding.lower()] = quality
+    return encodings
+
+
+class ExcludeContentTypesMixin:
+    """
+    Send responses of `EXCLUDED_CONTENT_TYPES` as they are.
+    """
+
+    async def send_with_compression(self, message) -> None:
+        await super().send_with_compression(message)
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if content_type.startswith(EXCLUDED_CONTENT_TYPES):
+                self.content_type_is_excluded = True
+
+
+class ZstdResponder(ExcludeContentTypesMixin, IdentityResponder):
+    content_encoding = "zstd"
+
+    def __init__(self, app, minimum_size: int, level: int = 3) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = self.compressor.compress(body)
+        if more_body:
+            # send what was compressed so far, so that streamed responses
+            # are not held back
+            return compressed + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return compressed + self.compressor.flush()
+
+
+class GZipResponder(ExcludeContentTypesMixin, gzip.GZipResponder):
+    pass
+
+
+class CompressionMiddleware:
+    """
+    Compress the query and export responses larger than
+    `COMPRESSION_MINIMUM_SIZE` bytes, with the best encoding accepted by the
+    client.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        minimum_size = config["COMPRESSION_MINIMUM_SIZE"]
+        if (
+            scope["type"] != "http"
+            or minimum_size is None
+            or scope["method"] != "GET"
+            or not COMPRESSED_PATHS.match(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        accepted = parse_accept_encoding(
+            Headers(scope=scope).get("Accept-Encoding", "")
+        )
+        if accepted.get("zstd", 0) > 0:
+            responder = ZstdResponder(
+                self.app, minimum_size, level=config["COMPRESSION_ZSTD_LEVEL"]
+            )
+        elif accepted.get("gzip", 0) > 0:
+            responder = GZipResponder(
+                self.app, minimum_size, compresslevel=config["COMPRESSION_GZIP_LEVEL"]
+            )
+        else:
+            responder = IdentityResponder(self.app, minimum_size)
+        await responder(scope, receive, send)
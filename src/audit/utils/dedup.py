@@ -0,0 +1,59 @@
+"""
+Deduplication of audit logs that are received more than once: queue
+messages delivered more than once, or API requests retried by the client.
+
+Each audit log to deduplicate is given a `dedup_key`. Keys of the audit logs
+inserted recently are kept in memory so that most duplicates are dropped
+without a database round trip. Duplicates that are not in memory (for example,
+inserted by another worker) are dropped by the database, which has a unique
+index on `dedup_key` in each monthly partition.
+"""
+from typing import Optional
+
+from ..config import config
+from .cache import LRUCache
+
+
+recent_dedup_keys = None
+
+
+def _get_recent_dedup_keys() -> LRUCache:
+    global recent_dedup_keys
+    if recent_dedup_keys is None:
+        recent_dedup_keys = LRUCache(config["DEDUP_CACHE_SIZE"])
+    return recent_dedup_keys
+
+
+def message_dedup_key(message_id: Optional[str]) -> Optional[str]:
+    """
+    Dedup key of the audit log sent in a queue message.
+    """
+    if not config["DEDUPLICATION"] or not message_id:
+        return None
+    return f"message:{message_id}"
+
+
+def request_dedup_key(idempotency_key: Optional[str]) -> Optional[str]:
+    """
+    Dedup key of the audit log sent in an API request, based on the
+    `Idempotency-Key` header.
+    """
+    if not config["DEDUPLICATION"] or not idempotency_key:
+        return None
+    return f"request:{idempotency_key}"
+
+
+def was_recently_inserted(category: str, dedup_key: str) -> bool:
+    return (category, dedup_key) in _get_recent_dedup_keys()
+
+
+def remember_inserted(category: str, dedup_key: str) -> None:
+    """
+    Should only be called once the audit log was committed to the database.
+    """
+    _get_recent_dedup_keys().set((category, dedup_key), True)
+
+
+def clear_recent_dedup_keys() -> None:
+    if recent_dedup_keys is not None:
+        recent_dedup_keys.clear()
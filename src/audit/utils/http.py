@@ -0,0 +1,26 @@
+import httpx
+
+from ..config import config
+
+
+def get_http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        config["HTTP_CLIENT_TIMEOUT_SECONDS"],
+        connect=config["HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS"],
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Create an HTTP client whose connections are kept open and reused between
+    requests, configured with the `HTTP_CLIENT_*` settings. The client must be
+    created and closed in the event loop it is used in.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config["HTTP_CLIENT_MAX_CONNECTIONS"],
+            max_keepalive_connections=config["HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=config["HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS"],
+        ),
+        timeout=get_http_timeout(),
+    )
@@ -0,0 +1,56 @@
+"""
+Fast JSON encoding of audit log query results.
+
+FastAPI's default response path converts the returned content with
+`jsonable_encoder`, which walks every value of every row in Python, before
+encoding it with `json`. Audit log pages can hold thousands of rows, so
+`LogsJSONResponse` encodes them directly with `orjson` instead.
+"""
+from datetime import datetime
+from typing import Any
+
+import orjson
+from starlette.responses import JSONResponse
+
+
+TIMESTAMP_FORMATS = ("iso", "epoch")
+
+
+def encode_json(content: Any, timestamp_format: str = "iso") -> bytes:
+    """
+    Encode audit log query results to JSON. Timestamps are encoded as ISO
+    8601 strings (`timestamp_format="iso"`, same as the default FastAPI
+    encoding), or as Unix timestamps (`timestamp_format="epoch"`), like the
+    `start`, `stop` and `nextTimeStamp` query parameters and fields.
+    """
+    assert (
+        timestamp_format in TIMESTAMP_FORMATS
+    ), f"Unknown timestamp format '{timestamp_format}'"
+
+    def default(value: Any) -> Any:
+        # only called for datetimes with the "epoch" format: `orjson` encodes
+        # them as ISO 8601 strings otherwise
+        if isinstance(value, datetime):
+            return int(datetime.timestamp(value))
+        raise TypeError(
+            f"Object of type {type(value).__name__} is not JSON serializable"
+        )
+
+    option = orjson.OPT_PASSTHROUGH_DATETIME if timestamp_format == "epoch" else 0
+    return orjson.dumps(content, default=default, option=option)
+
+
+class LogsJSONResponse(JSONResponse):
+    """
+    JSON response for audit log query results, encoded with `encode_json`.
+    """
+
+    def __init__(self, content: Any, timestamp_format: str = "iso", **kwargs):
+        assert (
+            timestamp_format in TIMESTAMP_FORMATS
+        ), f"Unknown timestamp format '{timestamp_format}'"
+        self.timestamp_format = timestamp_format
+        super().__init__(content, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        return encode_json(content, self.timestamp_format)
@@ -0,0 +1,48 @@
+"""
+Storage of export and archive files in S3. The `EXPORT_S3` and `ARCHIVE_S3`
+settings have the same fields: `bucket`, `region`, `aws_cred` (optional, a key
+in `AWS_CREDENTIALS`) and `prefix`.
+"""
+import os
+from typing import Tuple
+
+import boto3
+
+from ..config import config
+
+
+def get_aws_creds(s3_config: dict) -> dict:
+    # we know the cred is in AWS_CREDENTIALS (see `AuditServiceConfig.validate`)
+    if s3_config.get("aws_cred"):
+        return config["AWS_CREDENTIALS"][s3_config["aws_cred"]]
+    return {}
+
+
+def get_s3_client(s3_config: dict):
+    aws_creds = get_aws_creds(s3_config)
+    return boto3.client(
+        "s3",
+        region_name=s3_config.get("region"),
+        aws_access_key_id=aws_creds.get("aws_access_key_id"),
+        aws_secret_access_key=aws_creds.get("aws_secret_access_key"),
+    )
+
+
+def split_s3_url(url: str) -> Tuple[str, str]:
+    """
+    "s3://bucket/path/to/key" => ("bucket", "path/to/key")
+    """
+    bucket, key = url[len("s3://") :].split("/", 1)
+    return bucket, key
+
+
+def upload_file(path: str, s3_config: dict) -> str:
+    """
+    Upload a local file to `<prefix><file name>` in the bucket, and remove
+    the local file. Returns the S3 URL of the file.
+    """
+    bucket = s3_config["bucket"]
+    key = (s3_config.get("prefix") or "") + os.path.basename(path)
+    get_s3_client(s3_config).upload_file(path, bucket, key)
+    os.remove(path)
+    return f"s3://{bucket}/{key}"
@@ -0,0 +1,79 @@
+"""
+Per-request timing of the phases of request handling (authorization, DB
+queries...), reported in the `Server-Timing` response header when
+`SERVER_TIMING` is enabled. See `audit.app.ServerTimingMiddleware`.
+
+The collector is stored in a context variable, so it is available anywhere
+in the code handling the request without passing it around. Outside of a
+request, or when the header is disabled, `timed` does nothing.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        # time spent in each phase, in seconds. Phases that run more than
+        # once in a request are added up
+        self.durations: Dict[str, float] = {}
+        # when the last timed phase ended
+        self.last_end = self.start
+
+    def add(self, name: str, duration: float) -> None:
+        self.durations[name] = self.durations.get(name, 0) + duration
+        self.last_end = time.perf_counter()
+
+    def header_value(self) -> str:
+        """
+        `Server-Timing` header value: the timed phases, the time between the
+        end of the last phase and now (for example, response serialization
+        when it is not timed by the route) and the total time, in
+        milliseconds.
+        """
+        now = time.perf_counter()
+        durations = {
+            **self.durations,
+            "response": now - self.last_end if self.durations else 0,
+            "total": now - self.start,
+        }
+        return ", ".join(
+            f"{name};dur={round(duration * 1000, 2)}"
+            for name, duration in durations.items()
+        )
+
+
+_timings: ContextVar[Optional[Timings]] = ContextVar("timings", default=None)
+
+
+def start_timings() -> Timings:
+    timings = Timings()
+    _timings.set(timings)
+    return timings
+
+
+def stop_timings() -> None:
+    _timings.set(None)
+
+
+def get_timings() -> Optional[Timings]:
+    return _timings.get()
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    Add the duration of the code run in this context to the current request's
+    timings, as phase `name`.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
@@ -18,6 +18,8 @@ environ["AUDIT_SERVICE_CONFIG_PATH"] = os.path.join(
 from audit.config import config
 from audit.app import app_init
 from audit.db import get_db_engine_and_sessionmaker, initiate_db
+from audit.auth import clear_auth_caches
+from audit.utils.dedup import clear_recent_dedup_keys
 
 
 @pytest.fixture(scope="session")
@@ -47,6 +49,17 @@ async def setup_test_database():
         )
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """
+    In-memory caches are not reset with the test DB, so clear them between
+    tests.
+    """
+    yield
+    clear_recent_dedup_keys()
+    clear_auth_caches()
+
+
 @pytest_asyncio.fixture(scope="function")
 async def db_session():
     """
@@ -0,0 +1,183 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from audit.config import config
+from audit.db import DataAccessLayer, get_data_access_layer
+from audit.models import PresignedUrl
+from audit.retention import apply_retention_policy
+
+
+fake_jwt = "1.2.3"
+headers = {"Authorization": f"bearer {fake_jwt}"}
+
+
+def timestamp_for_date(date_string):
+    return int(datetime.strptime(date_string, "%Y/%m/%d").timestamp())
+
+
+# 2 months to archive, and the current month
+ARCHIVE_TEST_DATA = [
+    ("userA", "guid1", "2020/01/15"),
+    ("userB", "guid2", "2020/01/16"),
+    ("userA", "guid1", "2020/02/02"),
+    ("userA", "guid2", "2020/02/03"),
+    ("userB", "guid1", None),
+]
+
+
+def submit_test_data(client):
+    for username, guid, date in ARCHIVE_TEST_DATA:
+        data = {
+            "request_url": f"/request_data/download/{guid}",
+            "status_code": 200,
+            "username": username,
+            "sub": 10,
+            "guid": guid,
+            "resource_paths": ["/my/resource/path"],
+            "action": "download",
+            "additional_data": {"size": 10},
+        }
+        if date:
+            data["timestamp"] = timestamp_for_date(date)
+        res = client.post("/log/presigned_url", json=data)
+        assert res.status_code == 201, res.text
+
+
+def archive_test_data(client, tmp_path):
+    config["ARCHIVE_DIRECTORY"] = str(tmp_path)
+    config["RETENTION_POLICY"] = {"presigned_url": {"months": 1, "action": "archive"}}
+    submit_test_data(client)
+    removed = client.portal.call(apply_retention_policy)
+    assert [partition["partition"] for partition in removed] == [
+        "presigned_url_2020_01",
+        "presigned_url_2020_02",
+    ]
+
+
+def get_archived_partitions(client):
+    async def _get_archived_partitions():
+        async for data_access_layer in get_data_access_layer():
+            archived_partitions = await data_access_layer.get_archived_partitions(
+                "presigned_url"
+            )
+        return archived_partitions
+
+    return client.portal.call(_get_archived_partitions)
+
+
+def query(client, params=""):
+    res = client.get(f"/log/presigned_url?{params}", headers=headers)
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def test_archive(client, tmp_path):
+    archive_test_data(client, tmp_path)
+
+    archived_partitions = get_archived_partitions(client)
+    assert [
+        (archived.partition, archived.month_start, archived.row_count)
+        for archived in archived_partitions
+    ] == [
+        ("presigned_url_2020_01", datetime(2020, 1, 1), 2),
+        ("presigned_url_2020_02", datetime(2020, 2, 1), 2),
+    ]
+    for archived in archived_partitions:
+        assert os.path.getsize(archived.file_path) == archived.file_size
+
+    async def get_partitions():
+        async for data_access_layer in get_data_access_layer():
+            partitions = await data_access_layer.get_partitions(PresignedUrl)
+        return partitions
+
+    assert client.portal.call(get_partitions) == [
+        f"presigned_url_{datetime.now().strftime('%Y_%m')}"
+    ]
+
+    # archived logs are returned like the logs in the database
+    logs = query(client, "timestamp_format=epoch")["data"]
+    assert [(log["username"], log["guid"]) for log in logs] == [
+        (username, guid) for username, guid, _ in ARCHIVE_TEST_DATA
+    ]
+    assert logs[0]["timestamp"] == timestamp_for_date("2020/01/15")
+    assert logs[0]["resource_paths"] == ["/my/resource/path"]
+    assert logs[0]["additional_data"] == {"size": 10}
+    assert logs[0].keys() == logs[-1].keys()
+    assert "resource_path_prefixes" not in logs[0]
+
+    # filters
+    logs = query(client, "username=userA&guid=guid2")["data"]
+    assert len(logs) == 1
+    start = timestamp_for_date("2020/01/16")
+    stop = timestamp_for_date("2020/02/03")
+    assert len(query(client, f"start={start}&stop={stop}")["data"]) == 2
+    assert len(query(client, "resource_paths=/my/resource/path")["data"]) == 5
+    assert len(query(client, "resource_paths=/other/path")["data"]) == 0
+
+    assert query(client, "count")["data"] == 5
+    assert query(client, "guid=guid1&count")["data"] == 3
+    groups = query(client, "groupby=username")["data"]
+    assert sorted(groups, key=lambda group: group["username"]) == [
+        {"username": "userA", "count": 3},
+        {"username": "userB", "count": 2},
+    ]
+    groups = query(client, "groupby=resource_paths")["data"]
+    assert groups == [{"resource_paths": ["/my/resource/path"], "count": 5}]
+    groups = query(client, "groupby=username&groupby=guid")["data"]
+    assert sorted(groups, key=lambda group: (group["username"], group["guid"])) == [
+        {"username": "userA", "guid": "guid1", "count": 2},
+        {"username": "userA", "guid": "guid2", "count": 1},
+        {"username": "userB", "guid": "guid1", "count": 1},
+        {"username": "userB", "guid": "guid2", "count": 1},
+    ]
+
+    # archives are not queried
+    config["QUERY_ARCHIVES"] = False
+    assert len(query(client)["data"]) == 1
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3])
+def test_archive_pagination(client, tmp_path, monkeypatch, page_size):
+    archive_test_data(client, tmp_path)
+    monkeypatch.setitem(config, "QUERY_PAGE_SIZE", page_size)
+
+    logs = []
+    response = query(client)
+    logs.extend(response["data"])
+    while response["nextTimeStamp"]:
+        assert len(response["data"]) == page_size
+        response = query(client, f"start={response['nextTimeStamp']}")
+        logs.extend(response["data"])
+    assert [(log["username"], log["guid"]) for log in logs] == [
+        (username, guid) for username, guid, _ in ARCHIVE_TEST_DATA
+    ]
+
+
+def test_archive_partition_changed(client, tmp_path, monkeypatch):
+    """
+    If logs are inserted into a partition while it is being archived, the
+    partition is kept, and archived on the next run.
+    """
+    config["ARCHIVE_DIRECTORY"] = str(tmp_path)
+    config["RETENTION_POLICY"] = {"presigned_url": {"months": 1, "action": "archive"}}
+    submit_test_data(client)
+
+    count_partition_logs = DataAccessLayer.count_partition_logs
+
+    async def count_with_inserted_log(self, partition, lock=False):
+        return await count_partition_logs(self, partition, lock) + 1
+
+    monkeypatch.setattr(
+        DataAccessLayer, "count_partition_logs", count_with_inserted_log
+    )
+    assert client.portal.call(apply_retention_policy) == []
+    assert get_archived_partitions(client) == []
+    assert os.listdir(tmp_path) == []
+    assert len(query(client)["data"]) == len(ARCHIVE_TEST_DATA)
+
+    monkeypatch.setattr(DataAccessLayer, "count_partition_logs", count_partition_logs)
+    assert len(client.portal.call(apply_retention_policy)) == 2
+    assert len(get_archived_partitions(client)) == 2
+    assert len(query(client)["data"]) == len(ARCHIVE_TEST_DATA)
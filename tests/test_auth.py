@@ -0,0 +1,152 @@
+import time
+import pytest
+from authutils.token import fastapi as authutils_fastapi
+from fastapi.security import HTTPAuthorizationCredentials
+import jwt
+from unittest.mock import AsyncMock, MagicMock
+
+from audit.auth import Auth
+from audit.auth.arborist import ArboristClient
+from audit.auth.keys import prefetch_public_keys, refresh_public_keys
+from audit.config import config
+
+
+@pytest.mark.asyncio
+async def test_token_claims_cache(access_token_patcher, monkeypatch):
+    """
+    Validated token claims are cached until the token expires.
+    """
+    claims = {"sub": "1", "exp": int(time.time()) + 3600}
+
+    async def get_access_token(*args, **kwargs):
+        return dict(claims)
+
+    validate = MagicMock(side_effect=get_access_token)
+    access_token_patcher.return_value = validate
+
+    def get_auth(token):
+        return Auth(
+            MagicMock(),
+            HTTPAuthorizationCredentials(scheme="bearer", credentials=token),
+        )
+
+    # the token is only validated once
+    assert await get_auth("token1").get_token_claims() == claims
+    assert await get_auth("token1").get_token_claims() == claims
+    assert validate.call_count == 1
+
+    # other tokens are validated
+    assert await get_auth("token2").get_token_claims() == claims
+    assert validate.call_count == 2
+
+    # expired tokens are not cached
+    claims["exp"] = int(time.time()) - 1
+    await get_auth("token3").get_token_claims()
+    await get_auth("token3").get_token_claims()
+    assert validate.call_count == 4
+
+    # when the cache is disabled, tokens are always validated
+    monkeypatch.setitem(config, "TOKEN_CACHE_TTL_SECONDS", 0)
+    await get_auth("token1").get_token_claims()
+    assert validate.call_count == 5
+
+
+@pytest.mark.asyncio
+async def test_refresh_public_keys(monkeypatch):
+    """
+    The public keys of the allowed issuers are refreshed. If the keys cannot
+    be fetched, the previous keys are kept.
+    """
+    monkeypatch.setattr(authutils_fastapi, "_jwt_public_keys", {})
+    monkeypatch.setitem(
+        config, "ALLOWED_ISSUERS", ["https://issuer1", "https://issuer2"]
+    )
+    old_keys = MagicMock()
+    authutils_fastapi._jwt_public_keys["https://issuer2"] = old_keys
+    authutils_fastapi._jwt_public_keys["https://issuer3"] = old_keys
+
+    def get(url):
+        response = MagicMock()
+        assert not url.startswith("https://issuer3")
+        if url.startswith("https://issuer2"):
+            response.json.side_effect = Exception("unavailable")
+            response.raise_for_status.side_effect = Exception("unavailable")
+        elif url.endswith("openid-configuration"):
+            response.json.return_value = {"jwks_uri": "https://issuer1/jwks"}
+        else:
+            assert url == "https://issuer1/jwks"
+            response.json.return_value = {"keys": [["kid1", "pem1"]]}
+        return response
+
+    client = MagicMock()
+    client.get = AsyncMock(side_effect=get)
+    await refresh_public_keys(client)
+
+    assert dict(await authutils_fastapi._jwt_public_keys["https://issuer1"]) == {
+        "kid1": "pem1"
+    }
+    assert authutils_fastapi._jwt_public_keys["https://issuer2"] is old_keys
+    assert authutils_fastapi._jwt_public_keys["https://issuer3"] is old_keys
+
+
+@pytest.mark.asyncio
+async def test_prefetch_public_keys(monkeypatch):
+    """
+    The public keys of new allowed issuers are fetched with the shared client.
+    """
+    monkeypatch.setattr(authutils_fastapi, "_jwt_public_keys", {})
+    monkeypatch.setitem(config, "ALLOWED_ISSUERS", ["https://issuer1"])
+
+    def get(url):
+        response = MagicMock()
+        if url.endswith("openid-configuration"):
+            response.json.return_value = {"jwks_uri": "https://issuer1/jwks"}
+        else:
+            response.json.return_value = {"keys": [["kid1", "pem1"]]}
+        return response
+
+    client = MagicMock()
+    client.get = AsyncMock(side_effect=get)
+    token = jwt.encode({"iss": "https://issuer1"}, "secret", algorithm="HS256")
+    await prefetch_public_keys(client, token)
+    assert dict(await authutils_fastapi._jwt_public_keys["https://issuer1"]) == {
+        "kid1": "pem1"
+    }
+    assert client.get.call_count == 2
+
+    # the keys are only fetched once
+    await prefetch_public_keys(client, token)
+    assert client.get.call_count == 2
+
+    # invalid tokens are left to `authutils`
+    await prefetch_public_keys(client, "invalid")
+    assert client.get.call_count == 2
+
+    # the keys of other issuers are not fetched
+    token = jwt.encode({"iss": "https://issuer2"}, "secret", algorithm="HS256")
+    await prefetch_public_keys(client, token)
+    assert client.get.call_count == 2
+    assert "https://issuer2" not in authutils_fastapi._jwt_public_keys
+
+
+@pytest.mark.asyncio
+async def test_arborist_client_shared_connections():
+    """
+    When the app's HTTP client is set, Arborist requests use it and do not
+    close it.
+    """
+    arborist_client = ArboristClient(arborist_base_url="http://arborist-service")
+    shared_client = MagicMock()
+    response = MagicMock()
+    response.status_code = 200
+    response.json.return_value = {"auth": True}
+    shared_client.request = AsyncMock(return_value=response)
+    shared_client.aclose = AsyncMock()
+    arborist_client.async_client = shared_client
+
+    for _ in range(2):
+        assert await arborist_client.auth_request(
+            "token", "audit", "read", ["/services/audit/login"]
+        )
+    assert shared_client.request.call_count == 2
+    shared_client.aclose.assert_not_called()
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from sqlalchemy import text
+
+from audit.backfill import backfill_resource_path_prefixes
+from audit.db import get_data_access_layer
+from audit.models import get_resource_path_prefixes
+
+
+RESOURCE_PATHS = [
+    ["/programs/A/projects/B"],
+    ["/programs/A/projects/C", "/programs/D"],
+    None,
+]
+
+
+def submit_logs(client, date):
+    for resource_paths in RESOURCE_PATHS:
+        data = {
+            "request_url": "/request_data/download/guid",
+            "status_code": 200,
+            "username": "audit-service_user",
+            "sub": 10,
+            "guid": "guid",
+            "action": "download",
+            "timestamp": int(datetime.strptime(date, "%Y/%m/%d").timestamp()),
+        }
+        # logs without resource paths do not have the key
+        if resource_paths is not None:
+            data["resource_paths"] = resource_paths
+        res = client.post("/log/presigned_url", json=data)
+        assert res.status_code == 201, res.text
+
+
+def test_backfill_resource_path_prefixes(client):
+    """
+    The logs created before the `resource_path_prefixes` column was added get
+    the same prefixes as the logs created since.
+    """
+    submit_logs(client, "2020/01/15")
+    submit_logs(client, "2020/02/15")
+
+    async def execute(query):
+        async for data_access_layer in get_data_access_layer():
+            result = await data_access_layer.db_session.execute(text(query))
+        return result.all() if result.returns_rows else None
+
+    # logs created before the migration
+    client.portal.call(
+        execute, "UPDATE presigned_url SET resource_path_prefixes = NULL"
+    )
+
+    assert client.portal.call(backfill_resource_path_prefixes, 1) == 4
+    rows = client.portal.call(
+        execute, "SELECT resource_paths, resource_path_prefixes FROM presigned_url"
+    )
+    assert len(rows) == 6
+    for resource_paths, resource_path_prefixes in rows:
+        assert resource_path_prefixes == get_resource_path_prefixes(resource_paths)
+
+    # logs that already have their prefixes are skipped
+    assert client.portal.call(backfill_resource_path_prefixes, 1) == 0
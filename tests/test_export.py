@@ -0,0 +1,343 @@
+import asyncio
+import io
+import json
+from datetime import datetime
+
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from audit.auth import clear_auth_caches
+from audit.config import config
+from audit.db import get_data_access_layer
+from audit import export as export_module
+from audit.export import run_next_export_job
+
+
+fake_jwt = "1.2.3"
+headers = {"Authorization": f"bearer {fake_jwt}"}
+
+
+def timestamp_for_date(date_string):
+    return int(datetime.strptime(date_string, "%Y/%m/%d").timestamp())
+
+
+# spread over 3 monthly partitions
+EXPORT_TEST_DATA = [
+    ("userA", "2020/01/15"),
+    ("userB", "2020/01/16"),
+    ("userA", "2020/02/02"),
+    ("userA", "2020/02/03"),
+    ("userA", "2020/03/04"),
+]
+
+
+def submit_test_data(client):
+    for username, date in EXPORT_TEST_DATA:
+        res = client.post(
+            "/log/presigned_url",
+            json={
+                "request_url": "/request_data/download/guid",
+                "status_code": 200,
+                "username": username,
+                "sub": 10,
+                "guid": "guid",
+                "resource_paths": ["/my/resource/path"],
+                "action": "download",
+                "timestamp": timestamp_for_date(date),
+            },
+        )
+        assert res.status_code == 201, res.text
+
+
+def download(client, job_id):
+    res = client.get(f"/export/{job_id}/download", headers=headers)
+    assert res.status_code == 200, res.text
+    return [json.loads(line) for line in res.content.splitlines()]
+
+
+def test_export(client, tmp_path):
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    submit_test_data(client)
+
+    res = client.post(
+        "/export/presigned_url?username=userA&timestamp_format=epoch",
+        headers=headers,
+    )
+    assert res.status_code == 202, res.text
+    job = res.json()
+    assert job["status"] == "pending"
+
+    # the file cannot be downloaded until the job is completed
+    res = client.get(f"/export/{job['id']}/download", headers=headers)
+    assert res.status_code == 409, res.text
+
+    assert client.portal.call(run_next_export_job) is True
+    # there is no other job to run
+    assert client.portal.call(run_next_export_job) is False
+
+    res = client.get(f"/export/{job['id']}", headers=headers)
+    assert res.status_code == 200, res.text
+    assert res.json()["status"] == "completed"
+    assert res.json()["exported_count"] == 4
+
+    logs = download(client, job["id"])
+    assert [log["timestamp"] for log in logs] == [
+        timestamp_for_date(date)
+        for username, date in EXPORT_TEST_DATA
+        if username == "userA"
+    ]
+    assert all(log["username"] == "userA" for log in logs)
+    assert all("resource_path_prefixes" not in log for log in logs)
+
+
+def test_export_time_range(client, tmp_path):
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    submit_test_data(client)
+
+    start = timestamp_for_date("2020/01/16")
+    stop = timestamp_for_date("2020/03/01")
+    res = client.post(
+        f"/export/presigned_url?start={start}&stop={stop}", headers=headers
+    )
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+    assert client.portal.call(run_next_export_job) is True
+
+    logs = download(client, job_id)
+    assert [log["username"] for log in logs] == ["userB", "userA", "userA"]
+
+
+def test_export_query_slots(client, tmp_path, monkeypatch):
+    """
+    Export jobs do not use the admission slots of the audit log queries, so
+    they run even when the maximum number of queries are running.
+    """
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    submit_test_data(client)
+    monkeypatch.setattr("audit.db.query_slots", asyncio.Semaphore(0))
+
+    res = client.post("/export/presigned_url", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+    assert client.portal.call(run_next_export_job) is True
+
+    res = client.get(f"/export/{job_id}", headers=headers)
+    assert res.status_code == 200, res.text
+    assert res.json()["status"] == "completed"
+    assert len(download(client, job_id)) == len(EXPORT_TEST_DATA)
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_export_columnar(client, tmp_path, file_format):
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    # several row groups or record batches
+    config["EXPORT_CHUNK_SIZE"] = 2
+    submit_test_data(client)
+
+    res = client.post(f"/export/presigned_url?format={file_format}", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+    assert client.portal.call(run_next_export_job) is True
+
+    res = client.get(f"/export/{job_id}/download", headers=headers)
+    assert res.status_code == 200, res.text
+    if file_format == "parquet":
+        table = pyarrow.parquet.read_table(io.BytesIO(res.content))
+    else:
+        table = pyarrow.ipc.open_stream(res.content).read_all()
+
+    assert table.num_rows == len(EXPORT_TEST_DATA)
+    assert "dedup_key" not in table.column_names
+    assert "resource_path_prefixes" not in table.column_names
+    assert table.schema.field("timestamp").type == pyarrow.timestamp("us")
+    assert table.schema.field("resource_paths").type == pyarrow.list_(pyarrow.string())
+    logs = table.to_pylist()
+    assert [log["username"] for log in logs] == [
+        username for username, _ in EXPORT_TEST_DATA
+    ]
+    assert logs[0]["timestamp"] == datetime(2020, 1, 15)
+    assert logs[0]["resource_paths"] == ["/my/resource/path"]
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_export_columnar_resume(client, tmp_path, monkeypatch, file_format):
+    """
+    Arrow files are resumed after the last saved chunk, and Parquet files,
+    which cannot be appended to, are exported again from the beginning.
+    """
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    config["EXPORT_CHUNK_SIZE"] = 1
+    submit_test_data(client)
+
+    res = client.post(f"/export/presigned_url?format={file_format}", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+
+    write_chunk = export_module._write_chunk
+    writes = 0
+
+    def failing_write_chunk(*args):
+        nonlocal writes
+        writes += 1
+        size = write_chunk(*args)
+        if writes == 3:
+            raise Exception("Simulated failure")
+        return size
+
+    monkeypatch.setattr(export_module, "_write_chunk", failing_write_chunk)
+    assert client.portal.call(run_next_export_job) is True
+    monkeypatch.setattr(export_module, "_write_chunk", write_chunk)
+    assert client.portal.call(run_next_export_job) is True
+
+    res = client.get(f"/export/{job_id}/download", headers=headers)
+    assert res.status_code == 200, res.text
+    if file_format == "parquet":
+        table = pyarrow.parquet.read_table(io.BytesIO(res.content))
+    else:
+        table = pyarrow.ipc.open_stream(res.content).read_all()
+    ids = table.column("id").to_pylist()
+    assert len(ids) == len(set(ids)) == len(EXPORT_TEST_DATA)
+
+
+def test_export_invalid_parameters(client):
+    res = client.post("/export/not_a_category", headers=headers)
+    assert res.status_code == 400, res.text
+
+    res = client.post("/export/presigned_url?groupby=username", headers=headers)
+    assert res.status_code == 400, res.text
+
+    res = client.post("/export/presigned_url?count", headers=headers)
+    assert res.status_code == 400, res.text
+
+    res = client.post("/export/presigned_url?format=csv", headers=headers)
+    assert res.status_code == 400, res.text
+
+    start = timestamp_for_date("2020/02/01")
+    stop = timestamp_for_date("2020/01/01")
+    res = client.post(
+        f"/export/presigned_url?start={start}&stop={stop}", headers=headers
+    )
+    assert res.status_code == 400, res.text
+
+    res = client.get("/export/not_a_job", headers=headers)
+    assert res.status_code == 404, res.text
+
+
+def test_export_other_user(client, access_token_patcher):
+    res = client.post("/export/presigned_url", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+
+    async def get_access_token(*args, **kwargs):
+        return {"sub": "2", "context": {"user": {"name": "other-user"}}}
+
+    access_token_patcher.return_value = get_access_token
+    clear_auth_caches()
+
+    # users can only see their own export jobs
+    res = client.get(f"/export/{job_id}", headers=headers)
+    assert res.status_code == 404, res.text
+    res = client.get(f"/export/{job_id}/download", headers=headers)
+    assert res.status_code == 404, res.text
+
+
+def test_export_resume(client, tmp_path, monkeypatch):
+    """
+    When a job fails, it is retried, starting after the last chunk of logs
+    whose progress was saved.
+    """
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    config["EXPORT_CHUNK_SIZE"] = 1
+    submit_test_data(client)
+
+    res = client.post("/export/presigned_url", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+
+    # fail after writing the 3rd chunk, before its progress is saved
+    write_chunk = export_module._write_chunk
+    writes = 0
+
+    def failing_write_chunk(*args):
+        nonlocal writes
+        writes += 1
+        size = write_chunk(*args)
+        if writes == 3:
+            raise Exception("Simulated failure")
+        return size
+
+    monkeypatch.setattr(export_module, "_write_chunk", failing_write_chunk)
+    assert client.portal.call(run_next_export_job) is True
+    res = client.get(f"/export/{job_id}", headers=headers)
+    assert res.json()["status"] == "pending"
+    assert res.json()["exported_count"] == 2
+    assert res.json()["error"] == "Simulated failure"
+
+    monkeypatch.setattr(export_module, "_write_chunk", write_chunk)
+    assert client.portal.call(run_next_export_job) is True
+    res = client.get(f"/export/{job_id}", headers=headers)
+    assert res.json()["status"] == "completed"
+    assert res.json()["exported_count"] == len(EXPORT_TEST_DATA)
+
+    # the log written before the failure is not exported twice
+    logs = download(client, job_id)
+    assert len(logs) == len(EXPORT_TEST_DATA)
+    assert len({log["id"] for log in logs}) == len(EXPORT_TEST_DATA)
+
+
+def test_export_failed(client, tmp_path, monkeypatch):
+    config["EXPORT_DIRECTORY"] = str(tmp_path)
+    config["EXPORT_MAX_ATTEMPTS"] = 2
+    submit_test_data(client)
+
+    res = client.post("/export/presigned_url", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+
+    def failing_write_chunk(*args):
+        raise Exception("Simulated failure")
+
+    monkeypatch.setattr(export_module, "_write_chunk", failing_write_chunk)
+    for _ in range(2):
+        assert client.portal.call(run_next_export_job) is True
+    res = client.get(f"/export/{job_id}", headers=headers)
+    assert res.json()["status"] == "failed"
+
+    # failed jobs are not retried
+    assert client.portal.call(run_next_export_job) is False
+
+
+def test_export_job_lease(client):
+    """
+    A running job can only be claimed by another worker once its lease
+    expired, and the previous worker can then no longer update it.
+    """
+    res = client.post("/export/presigned_url", headers=headers)
+    assert res.status_code == 202, res.text
+    job_id = res.json()["id"]
+
+    # let the transactions commit before returning
+    async def claim(lease_seconds):
+        async for data_access_layer in get_data_access_layer():
+            job = await data_access_layer.claim_export_job(lease_seconds)
+        return job
+
+    async def update(attempt):
+        async for data_access_layer in get_data_access_layer():
+            updated = await data_access_layer.update_export_job(
+                job_id, attempt, exported_count=1
+            )
+        return updated
+
+    job = client.portal.call(claim, 300)
+    assert job.id == job_id
+    assert job.attempts == 1
+    assert client.portal.call(claim, 300) is None
+
+    # the lease expired
+    job = client.portal.call(claim, 0)
+    assert job.id == job_id
+    assert job.attempts == 2
+    assert client.portal.call(update, 1) is False
+    assert client.portal.call(update, 2) is True
@@ -2,6 +2,7 @@ from datetime import datetime
 import time
 import pytest
 
+from audit.config import config
 
 fake_jwt = "1.2.3"
 
@@ -223,3 +224,36 @@ def test_create_login_log_with_none_values(client):
 
     res = client.post("/log/login", json=request_data)
     assert res.status_code == 201, res.text
+
+
+@pytest.mark.parametrize("idempotency_key", [None, "key1"])
+def test_create_log_deduplication(client, monkeypatch, idempotency_key):
+    """
+    When deduplication is enabled, retried requests with the same
+    `Idempotency-Key` header only create one audit log. Requests without the
+    header are not deduplicated.
+    """
+    monkeypatch.setitem(config, "DEDUPLICATION", True)
+    guid = "dg.hello/abc"
+    request_data = {
+        "request_url": f"/request_data/download/{guid}",
+        "status_code": 200,
+        "username": "audit-service_user",
+        "sub": 10,
+        "guid": guid,
+        "resource_paths": ["/my/resource/path1", "/path2"],
+        "action": "download",
+        "protocol": "s3",
+    }
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+    for _ in range(2):
+        res = client.post("/log/presigned_url", json=request_data, headers=headers)
+        assert res.status_code == 201, res.text
+
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    response_data = res.json()["data"]
+    assert len(response_data) == (1 if idempotency_key else 2)
+    assert "dedup_key" not in response_data[0]
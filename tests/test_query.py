@@ -1,6 +1,28 @@
-from datetime import datetime
-
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, MagicMock
+from sqlalchemy import func, select, text
+
+from audit.auth import clear_auth_caches
 from audit.config import config
+from audit.db import (
+    DataAccessLayer,
+    QueryTooExpensiveError,
+    initiate_db,
+    query_data_access_layer,
+    use_read_replica,
+)
+from audit.metrics import (
+    DB_READ_QUERIES,
+    QUERIES_CANCELLED,
+    QUERIES_REJECTED,
+    QUERIES_TOO_EXPENSIVE,
+)
+from audit.models import PresignedUrl
+from audit.utils.coalesce import SingleFlight
+from audit.utils.compression import parse_accept_encoding
 
 
 def timestamp_for_date(date_string, format="%Y/%m/%d"):
@@ -760,3 +782,539 @@ def test_query_authz(client, mock_arborist_requests):
         "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
     )
     assert res.status_code == 200, res.text
+
+
+def test_query_authz_cache(client, mock_arborist_requests, monkeypatch):
+    """
+    Positive authorization decisions are cached, negative ones are not.
+    """
+    # unauthorized requests are not cached
+    mock_arborist_requests(authorized=False)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 403, res.text
+
+    mock_arborist_requests()
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+
+    # the authorized decision is cached: arborist is not called again
+    mock_arborist_requests(authorized=False)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+
+    # the cache is per resource
+    res = client.get("/log/login", headers={"Authorization": f"bearer {fake_jwt}"})
+    assert res.status_code == 403, res.text
+
+    # the cache is per token
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer other_{fake_jwt}"}
+    )
+    assert res.status_code == 403, res.text
+
+    # when the cache is disabled, arborist is always called
+    monkeypatch.setitem(config, "AUTHZ_CACHE_TTL_SECONDS", 0)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 403, res.text
+
+
+def test_query_authz_resource_paths(client, mock_arborist_requests):
+    """
+    Users who do not have access to all the presigned URL logs can query the
+    logs of the resources they have access to.
+    """
+    submit_test_data(client)
+
+    # access to "/resource/path" => logs A2 and A3
+    mock_arborist_requests(
+        authorized=False,
+        urls_to_responses={
+            "http://arborist-service/auth/mapping": {
+                "POST": (
+                    {"/resource/path": [{"service": "audit", "method": "read"}]},
+                    200,
+                )
+            }
+        },
+    )
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    response_data = res.json()["data"]
+    assert sorted(log["guid"] for log in response_data) == ["guid2", "guid3"]
+
+    # the resource path must match whole path segments
+    clear_auth_caches()
+    mock_arborist_requests(
+        authorized=False,
+        urls_to_responses={
+            "http://arborist-service/auth/mapping": {
+                "POST": (
+                    {"/resource/pa": [{"service": "audit", "method": "*"}]},
+                    200,
+                )
+            }
+        },
+    )
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    assert res.json()["data"] == []
+
+    # access to other services' resources is not enough
+    clear_auth_caches()
+    mock_arborist_requests(
+        authorized=False,
+        urls_to_responses={
+            "http://arborist-service/auth/mapping": {
+                "POST": (
+                    {"/resource/path": [{"service": "fence", "method": "*"}]},
+                    200,
+                )
+            }
+        },
+    )
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 403, res.text
+
+
+def test_query_timestamp_format(client):
+    submit_test_data(client)
+
+    # default: ISO 8601
+    res = client.get(
+        "/log/presigned_url?username=userA&guid=guid1",
+        headers={"Authorization": f"bearer {fake_jwt}"},
+    )
+    assert res.status_code == 200, res.text
+    assert [log["timestamp"] for log in res.json()["data"]] == [
+        "2020-01-16T00:00:00",
+        "2020-10-31T00:00:00",
+    ]
+
+    res = client.get(
+        "/log/presigned_url?username=userA&guid=guid1&timestamp_format=epoch",
+        headers={"Authorization": f"bearer {fake_jwt}"},
+    )
+    assert res.status_code == 200, res.text
+    assert [log["timestamp"] for log in res.json()["data"]] == [
+        PRESIGNED_URL_TEST_DATA["A1_1"]["timestamp"],
+        PRESIGNED_URL_TEST_DATA["A1_2"]["timestamp"],
+    ]
+
+    res = client.get(
+        "/log/presigned_url?timestamp_format=unknown",
+        headers={"Authorization": f"bearer {fake_jwt}"},
+    )
+    assert res.status_code == 400, res.text
+
+
+def test_query_compression(client, monkeypatch):
+    submit_test_data(client)
+    monkeypatch.setitem(config, "COMPRESSION_MINIMUM_SIZE", 100)
+
+    res = client.get(
+        "/log/presigned_url",
+        headers={"Authorization": f"bearer {fake_jwt}", "Accept-Encoding": "gzip"},
+    )
+    assert res.status_code == 200, res.text
+    assert res.headers["content-encoding"] == "gzip"
+    assert len(res.json()["data"]) == len(PRESIGNED_URL_TEST_DATA)
+
+    # the client does not accept compressed responses
+    res = client.get(
+        "/log/presigned_url",
+        headers={"Authorization": f"bearer {fake_jwt}", "Accept-Encoding": "identity"},
+    )
+    assert res.status_code == 200, res.text
+    assert "content-encoding" not in res.headers
+
+    # small responses are not compressed
+    monkeypatch.setitem(config, "COMPRESSION_MINIMUM_SIZE", 100000)
+    res = client.get(
+        "/log/presigned_url",
+        headers={"Authorization": f"bearer {fake_jwt}", "Accept-Encoding": "gzip"},
+    )
+    assert res.status_code == 200, res.text
+    assert "content-encoding" not in res.headers
+
+    # zstd is preferred when the client accepts it
+    monkeypatch.setitem(config, "COMPRESSION_MINIMUM_SIZE", 100)
+    res = client.get(
+        "/log/presigned_url",
+        headers={
+            "Authorization": f"bearer {fake_jwt}",
+            "Accept-Encoding": "gzip, zstd",
+        },
+    )
+    assert res.status_code == 200, res.text
+    assert res.headers["content-encoding"] == "zstd"
+
+    # only query and export responses are compressed
+    res = client.get("/_schema", headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200, res.text
+    assert len(res.content) > 100
+    assert "content-encoding" not in res.headers
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("") == {}
+    assert parse_accept_encoding("gzip, zstd;q=0.5, br;q=x, *;q=0") == {
+        "gzip": 1.0,
+        "zstd": 0.5,
+        "br": 1.0,
+        "*": 0.0,
+    }
+
+
+def test_query_server_timing(client, monkeypatch):
+    submit_test_data(client)
+
+    # disabled by default
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    assert "Server-Timing" not in res.headers
+
+    monkeypatch.setitem(config, "SERVER_TIMING", True)
+    expected_phases = [
+        "validation",
+        "db-page",
+        "orm",
+        "db-last_timestamp",
+        "db-next_timestamp",
+        "serialization",
+        "response",
+        "total",
+    ]
+
+    # the authorization decision of the first request is cached, so Arborist
+    # is not called
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    phases = [
+        metric.split(";")[0] for metric in res.headers["Server-Timing"].split(", ")
+    ]
+    assert phases == expected_phases
+
+    monkeypatch.setitem(config, "AUTHZ_CACHE_TTL_SECONDS", 0)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    phases = [
+        metric.split(";")[0] for metric in res.headers["Server-Timing"].split(", ")
+    ]
+    assert phases == ["auth-arborist"] + expected_phases
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(db_session, monkeypatch):
+    """
+    Slow queries are logged, along with their plan when sampled.
+    """
+    mocked_logger = MagicMock()
+    monkeypatch.setattr("audit.db.logger", mocked_logger)
+    data_access_layer = DataAccessLayer(db_session)
+    query_params = {"username": ["userA"]}
+
+    # not slow
+    monkeypatch.setitem(config, "DB_SLOW_QUERY_THRESHOLD_SECONDS", 60)
+    await data_access_layer.query_logs(PresignedUrl, None, None, query_params, False)
+    mocked_logger.warning.assert_not_called()
+
+    # slow, plan not sampled
+    monkeypatch.setitem(config, "DB_SLOW_QUERY_THRESHOLD_SECONDS", 0)
+    monkeypatch.setitem(config, "DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0)
+    await data_access_layer.query_logs(PresignedUrl, None, None, query_params, False)
+    assert mocked_logger.warning.call_count == 1
+    message = mocked_logger.warning.call_args[0][0]
+    assert message.startswith("Slow query 'page'")
+    assert "userA" in message
+
+    # slow, plan sampled
+    mocked_logger.reset_mock()
+    monkeypatch.setitem(config, "DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 1)
+    await data_access_layer.query_logs(PresignedUrl, None, None, query_params, False)
+    assert mocked_logger.warning.call_count == 2
+    message = mocked_logger.warning.call_args[0][0]
+    assert message.startswith("Query plan of slow query 'page'")
+    assert "Execution Time" in message
+    mocked_logger.error.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_read_replica(monkeypatch):
+    """
+    Queries use the read replica unless it is too late for the queried time
+    window.
+    """
+    # no replica
+    await initiate_db()
+    assert not await use_read_replica(None)
+
+    # in tests, the "replica" is the primary: no lag
+    monkeypatch.setitem(config, "DB_READ_URL", config["DB_URL"])
+    await initiate_db()
+    try:
+        assert await use_read_replica(None)
+
+        monkeypatch.setitem(config, "DB_READ_MAX_LAG_SECONDS", 10)
+        monkeypatch.setattr("audit.db.get_replica_lag", AsyncMock(return_value=100))
+        assert not await use_read_replica(None)
+        assert not await use_read_replica(datetime.now())
+        assert await use_read_replica(datetime.now() - timedelta(seconds=200))
+
+        # unknown lag
+        monkeypatch.setattr("audit.db.get_replica_lag", AsyncMock(return_value=None))
+        assert not await use_read_replica(datetime.now() - timedelta(seconds=200))
+    finally:
+        monkeypatch.setitem(config, "DB_READ_URL", None)
+        await initiate_db()
+
+
+def test_query_read_replica(app, client, monkeypatch):
+    submit_test_data(client)
+    monkeypatch.setitem(config, "DB_READ_URL", config["DB_URL"])
+    n_replica_queries = DB_READ_QUERIES.get(target="replica")
+
+    # start a new client so that the app uses the replica
+    with TestClient(app=app) as replica_client:
+        res = replica_client.get(
+            "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+        )
+    assert res.status_code == 200, res.text
+    assert len(res.json()["data"]) == len(PRESIGNED_URL_TEST_DATA)
+    assert DB_READ_QUERIES.get(target="replica") == n_replica_queries + 1
+
+
+def test_query_admission(client, monkeypatch):
+    """
+    When too many queries are running, queries are rejected with a 503 error
+    and a Retry-After header, and audit logs can still be ingested.
+    """
+    monkeypatch.setattr("audit.db.query_slots", asyncio.Semaphore(0))
+    monkeypatch.setitem(config, "QUERY_ADMISSION_TIMEOUT_SECONDS", 0.01)
+    monkeypatch.setitem(config, "QUERY_RETRY_AFTER_SECONDS", 7)
+    n_rejected = QUERIES_REJECTED.get()
+
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 503, res.text
+    assert res.headers["Retry-After"] == "7"
+    assert QUERIES_REJECTED.get() == n_rejected + 1
+
+    # submit_test_data checks that the logs are created
+    submit_test_data(client)
+
+
+def test_query_cost_guard(client, monkeypatch):
+    """
+    Queries estimated to be too expensive are rejected before they run.
+    """
+    submit_test_data(client)
+    n_rejected = QUERIES_TOO_EXPENSIVE.get(reason="estimate")
+
+    monkeypatch.setitem(config, "QUERY_MAX_ESTIMATED_COST", 0)
+    for url in ["/log/presigned_url", "/log/presigned_url?groupby=username"]:
+        res = client.get(url, headers={"Authorization": f"bearer {fake_jwt}"})
+        assert res.status_code == 400, res.text
+        assert "narrow it down" in res.json()["detail"]
+    assert QUERIES_TOO_EXPENSIVE.get(reason="estimate") == n_rejected + 2
+
+    monkeypatch.setitem(config, "QUERY_MAX_ESTIMATED_COST", None)
+    monkeypatch.setitem(config, "QUERY_MAX_ESTIMATED_ROWS", 1000000)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 200, res.text
+    assert len(res.json()["data"]) == len(PRESIGNED_URL_TEST_DATA)
+
+    # the page size does not limit the estimate
+    monkeypatch.setitem(config, "QUERY_PAGE_SIZE", 1)
+    monkeypatch.setitem(config, "QUERY_MAX_ESTIMATED_ROWS", 1)
+    res = client.get(
+        "/log/presigned_url", headers={"Authorization": f"bearer {fake_jwt}"}
+    )
+    assert res.status_code == 400, res.text
+
+    # neither does the number of groups
+    res = client.get(
+        "/log/presigned_url?groupby=username",
+        headers={"Authorization": f"bearer {fake_jwt}"},
+    )
+    assert res.status_code == 400, res.text
+
+
+@pytest.mark.asyncio
+async def test_query_cost_estimate_below_aggregate(monkeypatch):
+    """
+    The estimated number of rows of `groupby` queries is the number of rows
+    read, not the number of groups, including when the rows are read by
+    parallel workers.
+    """
+    monkeypatch.setitem(config, "QUERY_MAX_ESTIMATED_ROWS", 1000)
+    scan = {"Node Type": "Append", "Parent Relationship": "Outer", "Plan Rows": 600}
+    plans = [
+        # rows are aggregated by the scan's single process
+        {
+            "Node Type": "Aggregate",
+            "Plan Rows": 2,
+            "Plans": [{**scan, "Plan Rows": 5000}],
+        },
+        # rows are aggregated by 2 workers and the leader
+        {
+            "Node Type": "Aggregate",
+            "Plan Rows": 2,
+            "Plans": [
+                {
+                    "Node Type": "Gather Merge",
+                    "Parent Relationship": "Outer",
+                    "Workers Planned": 2,
+                    "Plans": [
+                        {
+                            "Node Type": "Sort",
+                            "Parent Relationship": "Outer",
+                            "Plans": [
+                                {
+                                    "Node Type": "Aggregate",
+                                    "Parent Relationship": "Outer",
+                                    "Plan Rows": 2,
+                                    "Plans": [scan],
+                                }
+                            ],
+                        }
+                    ],
+                }
+            ],
+        },
+    ]
+    for plan in plans:
+        plan.setdefault("Total Cost", 1)
+        db_session = MagicMock()
+        db_session.execute = AsyncMock(
+            return_value=MagicMock(scalar=MagicMock(return_value=[{"Plan": plan}]))
+        )
+        data_access_layer = DataAccessLayer(db_session)
+        with pytest.raises(QueryTooExpensiveError, match="narrow it down"):
+            await data_access_layer._check_query_cost(select(PresignedUrl), "groupby")
+
+
+@pytest.mark.asyncio
+async def test_statement_timeout(monkeypatch):
+    """
+    Queries running for longer than the category's statement timeout are
+    cancelled.
+    """
+    monkeypatch.setitem(config, "QUERY_STATEMENT_TIMEOUT_SECONDS", 60)
+    monkeypatch.setitem(
+        config, "QUERY_STATEMENT_TIMEOUT_SECONDS_PER_CATEGORY", {"login": 0.1}
+    )
+    await initiate_db()
+    with pytest.raises(QueryTooExpensiveError, match="took too long"):
+        async with query_data_access_layer(category="login") as data_access_layer:
+            await data_access_layer._execute_query(select(func.pg_sleep(1)), "sleep")
+
+
+@pytest.mark.asyncio
+async def test_query_cancellation(db_session):
+    """
+    When a query is cancelled, for example because the client disconnected,
+    the statement stops running on the database server.
+    """
+    n_cancelled = QUERIES_CANCELLED.get()
+    running = asyncio.Event()
+
+    async def run_query():
+        async with query_data_access_layer() as data_access_layer:
+            running.set()
+            await data_access_layer._execute_query(select(func.pg_sleep(60)), "sleep")
+
+    task = asyncio.create_task(run_query())
+    await running.wait()
+    await asyncio.sleep(0.5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert QUERIES_CANCELLED.get() == n_cancelled + 1
+
+    # the cancel request is sent in the background
+    for _ in range(50):
+        result = await db_session.execute(
+            text(
+                "SELECT count(*) FROM pg_stat_activity WHERE state = 'active'"
+                " AND query LIKE '%pg_sleep%' AND pid != pg_backend_pid()"
+            )
+        )
+        if result.scalar() == 0:
+            break
+        await asyncio.sleep(0.1)
+    else:
+        assert False, "The statement is still running"
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    """
+    Identical concurrent calls share the same execution, which is only
+    cancelled when all the callers are cancelled.
+    """
+    calls = []
+    done = asyncio.Event()
+
+    async def function(key):
+        calls.append(key)
+        await done.wait()
+        return [key]
+
+    flights = SingleFlight()
+    tasks = [
+        asyncio.create_task(flights.do(key, lambda key=key: function(key)))
+        for key in ["a", "a", "b", "a"]
+    ]
+    await asyncio.sleep(0.1)
+    done.set()
+    results = await asyncio.gather(*tasks)
+    assert results == [["a"], ["a"], ["b"], ["a"]]
+    assert results[0] is results[1]
+    assert calls == ["a", "b"]
+
+    # one of the callers is cancelled: the call goes on
+    calls = []
+    done.clear()
+    tasks = [asyncio.create_task(flights.do("a", lambda: function("a"))) for _ in "12"]
+    await asyncio.sleep(0.1)
+    tasks[0].cancel()
+    await asyncio.sleep(0.1)
+    done.set()
+    assert await tasks[1] == ["a"]
+
+    # all the callers are cancelled: the call is cancelled, and the next
+    # identical call runs again
+    calls = []
+    done.clear()
+    task = asyncio.create_task(flights.do("a", lambda: function("a")))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    await asyncio.sleep(0.1)
+    task = asyncio.create_task(flights.do("a", lambda: function("a")))
+    await asyncio.sleep(0.1)
+    done.set()
+    assert await task == ["a"]
+    assert calls == ["a", "a"]
@@ -1,11 +1,23 @@
+import asyncio
 import json
 import time
 import pytest
 from sqlalchemy import text
 
 from audit.config import config
+from audit.db import try_advisory_lock
+from audit.metrics import QUEUE_VISIBILITY_EXTENSIONS
 from audit.models import CATEGORY_TO_MODEL_CLASS
-from audit.pull_from_queue import process_log, pull_from_queue
+from audit import pull_from_queue as pull_from_queue_module
+from audit.pull_from_queue import (
+    QUEUE_CONSUMER_LOCK_ID,
+    consume_queue_when_elected,
+    process_log,
+    pull_from_queue,
+)
+from audit.quarantine import replay_quarantined_messages
+from audit.queues import AwsSqsQueue, LocalQueue, PostgresQueue
+from audit.utils.dedup import clear_recent_dedup_keys
 from audit import logger
 
 
@@ -59,6 +71,8 @@ async def test_process_log_success(db_session):
         message_data["protocol"],
         1,  # auto-incremented id
         message_data["additional_data"],
+        None,  # dedup_key
+        ["/my", "/my/resource", "/my/resource/path1", "/path2"],
     )
 
 
@@ -117,10 +131,11 @@ async def test_process_log_failure(db_session):
 
 class TestQueue:
     """
-    This class mocks the boto3 SQS client
+    This class mocks the boto3 SQS client. Wrap it in an `AwsSqsQueue` to
+    pull from it.
     """
 
-    def __init__(self, messages=None) -> None:
+    def __init__(self, messages=None, receive_count=1) -> None:
         guid = "dg.hello/abc"
         if messages is None:
             self.messages = [
@@ -139,6 +154,9 @@ class TestQueue:
             ]
         else:
             self.messages = messages
+        self.receive_count = receive_count
+        self.visibility_changes = []
+        self.deleted = []
 
     def receive_message(self, QueueUrl, MaxNumberOfMessages, AttributeNames):
         n_messages = min(MaxNumberOfMessages, len(self.messages))
@@ -146,14 +164,22 @@ class TestQueue:
             {
                 "Body": json.dumps(message),
                 "ReceiptHandle": "123",
-                "Attributes": {"SentTimestamp": int(time.time())},
+                "MessageId": f"message-{i}",
+                "Attributes": {
+                    "SentTimestamp": int(time.time()),
+                    "ApproximateReceiveCount": str(self.receive_count),
+                },
             }
-            for message in self.messages[:n_messages]
+            for i, message in enumerate(self.messages[:n_messages])
         ]
         return {"Messages": messages}
 
     def delete_message(self, QueueUrl, ReceiptHandle):
-        pass
+        self.deleted.append(ReceiptHandle)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility_changes.append(Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
 
 
 TestQueue.__test__ = False  # prevent pytest from trying to collect it
@@ -170,7 +196,7 @@ async def test_pull_from_queue_success(monkeypatch, db_session):
     )
     monkeypatch.setitem(config, "PULL_FREQUENCY_SECONDS", 0)
 
-    should_sleep = await pull_from_queue(queue)
+    should_sleep = await pull_from_queue(AwsSqsQueue(queue))
     # `should_sleep` is True if the queue contains no messages (not the
     # case here) or if we failed to process a message (should not happen)
     assert not should_sleep, "Failed to process audit logs"
@@ -200,7 +226,7 @@ async def test_pull_from_queue_failure(monkeypatch, db_session):
         )
         monkeypatch.setitem(config, "PULL_FREQUENCY_SECONDS", 0)
 
-        should_sleep = await pull_from_queue(queue)
+        should_sleep = await pull_from_queue(AwsSqsQueue(queue))
         # `should_sleep` is True if the queue contains no messages (not the
         # case here) or if we failed to process a message (should happen)
         if not messages:
@@ -214,3 +240,278 @@ async def test_pull_from_queue_failure(monkeypatch, db_session):
         assert (
             len(data) == 0
         ), f"Nothing should have been inserted in table 'presigned_url'"
+
+
+@pytest.mark.asyncio
+async def test_queue_consumer_slots(db_session):
+    """
+    Test that a queue consumer slot can only be held by one DB session at a
+    time, and that it can be acquired again once released.
+    """
+    async with try_advisory_lock(QUEUE_CONSUMER_LOCK_ID, 0) as connection:
+        assert connection is not None, "Slot 0 should have been acquired"
+
+        async with try_advisory_lock(QUEUE_CONSUMER_LOCK_ID, 0) as other_connection:
+            assert other_connection is None, "Slot 0 is already held"
+
+        async with try_advisory_lock(QUEUE_CONSUMER_LOCK_ID, 1) as other_connection:
+            assert other_connection is not None, "Slot 1 should have been acquired"
+
+    async with try_advisory_lock(QUEUE_CONSUMER_LOCK_ID, 0) as connection:
+        assert connection is not None, "Slot 0 should have been released"
+
+
+@pytest.mark.asyncio
+async def test_consume_queue_when_elected_error(monkeypatch, db_session):
+    """
+    Test that an error while consuming the queue releases the consumer slot,
+    and that the slot is acquired again to keep consuming the queue.
+    """
+    monkeypatch.setitem(config, "QUEUE_MAX_CONSUMERS", 1)
+    monkeypatch.setitem(config, "QUEUE_CONSUMER_LOCK_RETRY_SECONDS", 0.01)
+    calls = 0
+    consumed_again = asyncio.Event()
+
+    async def mock_consume_queue(queue):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise Exception("Simulated failure")
+        consumed_again.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(pull_from_queue_module, "consume_queue", mock_consume_queue)
+    consumer = asyncio.create_task(consume_queue_when_elected(LocalQueue()))
+    try:
+        await asyncio.wait_for(consumed_again.wait(), timeout=5)
+    finally:
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_pull_from_queue_visibility_heartbeat(monkeypatch, db_session):
+    """
+    Test that `pull_from_queue` extends the visibility of in-flight messages
+    while a batch is slow to process, and stops once the batch is done.
+    """
+    queue = TestQueue()
+    monkeypatch.setitem(
+        config, "QUEUE_CONFIG", {"aws_sqs_config": {"sqs_url": "some_queue_url"}}
+    )
+    monkeypatch.setitem(config, "QUEUE_VISIBILITY_HEARTBEAT_SECONDS", 0.01)
+    monkeypatch.setitem(config, "QUEUE_VISIBILITY_TIMEOUT_SECONDS", 30)
+
+    original_process_log = pull_from_queue_module.process_log
+
+    async def slow_process_log(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        await original_process_log(*args, **kwargs)
+
+    monkeypatch.setattr(pull_from_queue_module, "process_log", slow_process_log)
+    extensions_before = QUEUE_VISIBILITY_EXTENSIONS.get()
+
+    should_sleep = await pull_from_queue(AwsSqsQueue(queue))
+    assert not should_sleep, "Failed to process audit logs"
+
+    assert queue.visibility_changes, "The visibility should have been extended"
+    for entries in queue.visibility_changes:
+        assert entries == [{"Id": "0", "ReceiptHandle": "123", "VisibilityTimeout": 30}]
+    assert QUEUE_VISIBILITY_EXTENSIONS.get() - extensions_before == len(
+        queue.visibility_changes
+    )
+
+    # the heartbeat should stop once the batch has been processed
+    n_changes = len(queue.visibility_changes)
+    await asyncio.sleep(0.05)
+    assert len(queue.visibility_changes) == n_changes
+
+
+@pytest.mark.asyncio
+async def test_pull_from_queue_quarantine(monkeypatch, db_session):
+    """
+    Test that messages that failed to be processed too many times are moved
+    to quarantine and deleted from the queue, and that they can be replayed.
+    """
+    monkeypatch.setitem(
+        config, "QUEUE_CONFIG", {"aws_sqs_config": {"sqs_url": "some_queue_url"}}
+    )
+    monkeypatch.setitem(config, "QUEUE_MAX_RECEIVE_COUNT", 3)
+    message = {
+        "category": "this_does_not_exist",
+        "request_url": f"/request_data/download/guid",
+        "status_code": 200,
+        "username": "audit-service_user",
+        "guid": "guid",
+        "action": "download",
+    }
+
+    # below the max receive count, the message is not deleted
+    queue = TestQueue(messages=[message], receive_count=2)
+    should_sleep = await pull_from_queue(AwsSqsQueue(queue))
+    assert should_sleep, "Should have failed to process audit logs"
+    assert queue.deleted == []
+    assert await get_table_results(db_session, table_name="quarantined_message") == []
+
+    # at the max receive count, the message is quarantined and deleted
+    queue = TestQueue(messages=[message], receive_count=3)
+    should_sleep = await pull_from_queue(AwsSqsQueue(queue))
+    assert not should_sleep, "A quarantined message should not make us sleep"
+    assert queue.deleted == ["123"]
+    data = await get_table_results(db_session, table_name="quarantined_message")
+    assert len(data) == 1
+    quarantined = data[0]._mapping
+    assert quarantined["message_id"] == "message-0"
+    assert json.loads(quarantined["body"]) == message
+    assert quarantined["receive_count"] == 3
+    assert "Unknown log category" in quarantined["error"]
+
+    # replaying the message fails again: it stays in quarantine
+    assert await replay_quarantined_messages() == (0, 1)
+    await db_session.commit()  # end the transaction to see the latest changes
+    data = await get_table_results(db_session, table_name="quarantined_message")
+    assert len(data) == 1
+
+    # once the message can be processed (here, we simulate a fix by processing
+    # it as a `presigned_url` log), replaying it removes it from quarantine
+    # and inserts the audit log
+    async def process_as_presigned_url(data, timestamp, dedup_key=None):
+        data["category"] = "presigned_url"
+        await process_log(data, timestamp, dedup_key=dedup_key)
+
+    monkeypatch.setattr("audit.quarantine.process_log", process_as_presigned_url)
+    assert await replay_quarantined_messages() == (1, 0)
+    await db_session.commit()
+    data = await get_table_results(db_session, table_name="quarantined_message")
+    assert data == []
+    data = await get_table_results(db_session, table_name="presigned_url")
+    assert len(data) == 1
+
+
+@pytest.mark.asyncio
+async def test_local_queue(monkeypatch, db_session):
+    """
+    Test that the `local` queue redelivers messages that are not deleted
+    before their visibility timeout, and that logs can be pulled from it.
+    """
+    queue = LocalQueue(visibility_timeout=0.05)
+    message = {
+        "category": "presigned_url",
+        "request_url": f"/request_data/download/guid",
+        "status_code": 200,
+        "username": "audit-service_user",
+        "guid": "guid",
+        "action": "download",
+    }
+    message_id = queue.send(message)
+    assert len(queue) == 1
+
+    # the message is hidden while in flight, then delivered again
+    messages = await queue.receive(max_messages=10)
+    assert [(m.id, m.receive_count) for m in messages] == [(message_id, 1)]
+    assert json.loads(messages[0].body) == message
+    assert await queue.receive(max_messages=10) == []
+    await asyncio.sleep(0.1)
+    messages = await queue.receive(max_messages=10)
+    assert [(m.id, m.receive_count) for m in messages] == [(message_id, 2)]
+
+    # extending the visibility keeps the message hidden
+    assert await queue.extend_visibility(messages, 10) == 0
+    await asyncio.sleep(0.1)
+    assert await queue.receive(max_messages=10) == []
+
+    # deleted messages are gone from the queue
+    await queue.delete(messages[0])
+    assert len(queue) == 0
+
+    # pull logs from the queue
+    queue = LocalQueue()
+    for _ in range(3):
+        queue.send(message)
+    should_sleep = await pull_from_queue(queue)
+    assert not should_sleep, "Failed to process audit logs"
+    assert len(queue) == 0
+    data = await get_table_results(db_session, table_name="presigned_url")
+    assert len(data) == 3, "3 rows should have been inserted in table 'presigned_url'"
+
+
+@pytest.mark.asyncio
+async def test_postgres_queue(monkeypatch, db_session):
+    """
+    Test that the `postgres` queue redelivers messages that are not deleted
+    before their visibility timeout, and that logs inserted into the
+    `queue_message` table from outside the service can be pulled from it.
+    """
+    queue = PostgresQueue(visibility_timeout=0.05)
+    message = {
+        "category": "presigned_url",
+        "request_url": f"/request_data/download/guid",
+        "status_code": 200,
+        "username": "audit-service_user",
+        "guid": "guid",
+        "action": "download",
+    }
+    message_id = await queue.send(message)
+
+    # the message is hidden while in flight, then delivered again
+    messages = await queue.receive(max_messages=10)
+    assert [(m.id, m.receive_count) for m in messages] == [(message_id, 1)]
+    assert json.loads(messages[0].body) == message
+    assert await queue.receive(max_messages=10) == []
+    await asyncio.sleep(0.1)
+    redelivered = await queue.receive(max_messages=10)
+    assert [(m.id, m.receive_count) for m in redelivered] == [(message_id, 2)]
+
+    # the receipt handle of the first delivery is no longer valid
+    assert await queue.extend_visibility(messages, 10) == 1
+    # extending the visibility keeps the message hidden
+    assert await queue.extend_visibility(redelivered, 10) == 0
+    await asyncio.sleep(0.1)
+    assert await queue.receive(max_messages=10) == []
+
+    # deleted messages are gone from the queue
+    await queue.delete(redelivered[0])
+    assert await get_table_results(db_session, table_name="queue_message") == []
+
+    # pull logs sent with SQL
+    for _ in range(3):
+        await db_session.execute(
+            text("INSERT INTO queue_message (body) VALUES (:body)"),
+            {"body": json.dumps(message)},
+        )
+    await db_session.commit()
+    should_sleep = await pull_from_queue(PostgresQueue())
+    assert not should_sleep, "Failed to process audit logs"
+    assert await get_table_results(db_session, table_name="queue_message") == []
+    data = await get_table_results(db_session, table_name="presigned_url")
+    assert len(data) == 3, "3 rows should have been inserted in table 'presigned_url'"
+
+
+@pytest.mark.asyncio
+async def test_pull_from_queue_deduplication(monkeypatch, db_session):
+    """
+    Test that a queue message delivered more than once only creates one
+    audit log when deduplication is enabled.
+    """
+    monkeypatch.setitem(
+        config, "QUEUE_CONFIG", {"aws_sqs_config": {"sqs_url": "some_queue_url"}}
+    )
+    monkeypatch.setitem(config, "DEDUPLICATION", True)
+
+    # the TestQueue returns the same message ID on every call
+    queue = AwsSqsQueue(TestQueue())
+    for _ in range(2):
+        should_sleep = await pull_from_queue(queue)
+        assert not should_sleep, "Failed to process audit logs"
+    data = await get_table_results(db_session, table_name="presigned_url")
+    assert len(data) == 1, "1 row should have been inserted in table 'presigned_url'"
+    assert data[0]._mapping["dedup_key"] == "message:message-0"
+
+    # duplicates that are not in the in-memory cache are dropped by the DB
+    clear_recent_dedup_keys()
+    should_sleep = await pull_from_queue(queue)
+    assert not should_sleep, "Failed to process audit logs"
+    await db_session.commit()  # end the transaction to see the latest changes
+    data = await get_table_results(db_session, table_name="presigned_url")
+    assert len(data) == 1, "1 row should have been inserted in table 'presigned_url'"
@@ -0,0 +1,134 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from audit import logger
+from audit.config import config
+from audit.db import get_data_access_layer
+from audit.models import PresignedUrl
+from audit.retention import apply_retention_policy, get_retention_cutoff
+
+
+fake_jwt = "1.2.3"
+headers = {"Authorization": f"bearer {fake_jwt}"}
+
+
+def submit_log(client, date=None):
+    data = {
+        "request_url": "/request_data/download/guid",
+        "status_code": 200,
+        "username": "audit-service_user",
+        "sub": 10,
+        "guid": "guid",
+        "resource_paths": ["/my/resource/path"],
+        "action": "download",
+    }
+    if date:
+        data["timestamp"] = int(datetime.strptime(date, "%Y/%m/%d").timestamp())
+    res = client.post("/log/presigned_url", json=data)
+    assert res.status_code == 201, res.text
+
+
+def get_partitions(client):
+    async def _get_partitions():
+        async for data_access_layer in get_data_access_layer():
+            partitions = await data_access_layer.get_partitions(PresignedUrl)
+        return partitions
+
+    return client.portal.call(_get_partitions)
+
+
+def test_get_retention_cutoff():
+    # logs of January 2024 are kept until the end of January 2025
+    assert get_retention_cutoff(12, datetime(2025, 1, 31)) == datetime(2024, 1, 1)
+    assert get_retention_cutoff(12, datetime(2025, 2, 1)) == datetime(2024, 2, 1)
+    assert get_retention_cutoff(1, datetime(2025, 1, 15)) == datetime(2024, 12, 1)
+    assert get_retention_cutoff(25, datetime(2025, 3, 15)) == datetime(2023, 2, 1)
+
+
+def test_retention_policy_validation(monkeypatch):
+    monkeypatch.setitem(
+        config, "RETENTION_POLICY", {"presigned_url": {"months": 12, "action": "drop"}}
+    )
+    config.validate(logger)
+
+    # typo in the category name
+    monkeypatch.setitem(
+        config, "RETENTION_POLICY", {"presigned_urls": {"months": 12, "action": "drop"}}
+    )
+    with pytest.raises(AssertionError, match="unknown log category 'presigned_urls'"):
+        config.validate(logger)
+
+
+def test_retention_drop(client):
+    config["RETENTION_POLICY"] = {"presigned_url": {"months": 1, "action": "drop"}}
+    submit_log(client, "2020/01/15")
+    submit_log(client, "2020/02/15")
+    submit_log(client)
+    current_partition = f"presigned_url_{datetime.now().strftime('%Y_%m')}"
+    assert get_partitions(client) == [
+        "presigned_url_2020_01",
+        "presigned_url_2020_02",
+        current_partition,
+    ]
+
+    # dry run: nothing is removed
+    removed = client.portal.call(apply_retention_policy, True)
+    assert [partition["partition"] for partition in removed] == [
+        "presigned_url_2020_01",
+        "presigned_url_2020_02",
+    ]
+    assert len(get_partitions(client)) == 3
+
+    removed = client.portal.call(apply_retention_policy)
+    assert [partition["partition"] for partition in removed] == [
+        "presigned_url_2020_01",
+        "presigned_url_2020_02",
+    ]
+    assert get_partitions(client) == [current_partition]
+    res = client.get("/log/presigned_url", headers=headers)
+    assert res.status_code == 200, res.text
+    assert len(res.json()["data"]) == 1
+
+    # nothing left to remove
+    assert client.portal.call(apply_retention_policy) == []
+
+
+def test_retention_detach(client):
+    config["RETENTION_POLICY"] = {"presigned_url": {"months": 1, "action": "detach"}}
+    submit_log(client, "2020/01/15")
+    submit_log(client)
+
+    async def drop_detached():
+        async for data_access_layer in get_data_access_layer():
+            await data_access_layer.db_session.execute(
+                text('DROP TABLE IF EXISTS "presigned_url_2020_01_detached"')
+            )
+
+    try:
+        removed = client.portal.call(apply_retention_policy)
+        assert [partition["partition"] for partition in removed] == [
+            "presigned_url_2020_01"
+        ]
+        res = client.get("/log/presigned_url", headers=headers)
+        assert res.status_code == 200, res.text
+        assert len(res.json()["data"]) == 1
+
+        # the detached partition is kept
+        async def count_detached():
+            async for data_access_layer in get_data_access_layer():
+                result = await data_access_layer.db_session.execute(
+                    text('SELECT count(*) FROM "presigned_url_2020_01_detached"')
+                )
+                count = result.scalar()
+            return count
+
+        assert client.portal.call(count_detached) == 1
+
+        # logs can still be inserted for the same month, in a new partition
+        submit_log(client, "2020/01/16")
+        assert "presigned_url_2020_01" in get_partitions(client)
+    finally:
+        # detached partitions are not dropped by the migrations
+        client.portal.call(drop_detached)
@@ -1,9 +1,14 @@
+import asyncio
 from datetime import datetime
 import pytest
-from audit.db import get_data_access_layer
+from audit.app import ClientDisconnectMiddleware
+from audit.config import config
+from audit.db import get_data_access_layer, get_pool_sizes
 from sqlalchemy import text
 from typing import Union
 from audit import logger
+from audit.metrics import LOGS_INGESTED, Histogram
+from prometheus_client import CollectorRegistry, generate_latest
 from audit.models import (
     CATEGORY_TO_MODEL_CLASS,
     CreateLoginLogInput,
@@ -51,6 +56,101 @@ def test_status_endpoint(client, db_session):
     assert res.status_code == 200
 
 
+def test_metrics_endpoint(client, monkeypatch):
+    n_ingested = LOGS_INGESTED.get(category="login", source="api")
+    res = client.post(
+        "/log/login",
+        json={
+            "request_url": "/login",
+            "status_code": 200,
+            "username": "audit-service_user",
+            "sub": 10,
+            "idp": "google",
+        },
+    )
+    assert res.status_code == 201, res.text
+    assert LOGS_INGESTED.get(category="login", source="api") == n_ingested + 1
+
+    # categories that do not exist are not used as label values
+    res = client.get("/log/not-a-category")
+    assert res.status_code == 400, res.text
+
+    res = client.get("/metrics")
+    assert res.status_code == 200, res.text
+    assert res.headers["content-type"].startswith("text/plain")
+    metrics = res.text.splitlines()
+    assert (
+        'audit_logs_ingested_total{category="login",source="api"} '
+        f"{float(n_ingested + 1)}" in metrics
+    )
+    assert any(
+        line.startswith(
+            'audit_request_duration_seconds_count{category="",method="POST",route="/log/login",status_code="201"} '
+        )
+        for line in metrics
+    )
+    assert any(
+        line.startswith(
+            'audit_request_duration_seconds_count{category="other",method="GET",route="/log/{category}",status_code="400"} '
+        )
+        for line in metrics
+    )
+    assert not any("not-a-category" in line for line in metrics)
+    assert "# TYPE audit_db_pool_checked_out gauge" in metrics
+    for pool in ("ingest", "query"):
+        assert any(
+            line.startswith(f'audit_db_pool_checked_out{{pool="{pool}"}} ')
+            for line in metrics
+        )
+
+
+def test_histogram_collect():
+    registry = CollectorRegistry()
+    histogram = Histogram(
+        "test_histogram",
+        "Test histogram",
+        labels=("op",),
+        buckets=(1, 5),
+        registry=registry,
+    )
+    for value in (0.5, 2, 3, 10):
+        histogram.observe(value, op="a")
+    assert histogram.get_count(op="a") == 4
+    assert histogram.get_sum(op="a") == 15.5
+    assert generate_latest(registry).decode().splitlines() == [
+        "# HELP test_histogram Test histogram",
+        "# TYPE test_histogram histogram",
+        'test_histogram_bucket{le="1.0",op="a"} 1.0',
+        'test_histogram_bucket{le="5.0",op="a"} 3.0',
+        'test_histogram_bucket{le="+Inf",op="a"} 4.0',
+        'test_histogram_count{op="a"} 4.0',
+        'test_histogram_sum{op="a"} 15.5',
+    ]
+
+
+def test_pool_sizes(monkeypatch):
+    """
+    The DB pool sizes are divided across workers.
+    """
+    monkeypatch.setitem(config, "DB_POOL_MIN_SIZE", 4)
+    monkeypatch.setitem(config, "DB_POOL_MAX_SIZE", 16)
+    monkeypatch.delenv("AUDIT_WORKERS", raising=False)
+    assert get_pool_sizes() == (4, 16)
+
+    monkeypatch.setenv("AUDIT_WORKERS", "4")
+    assert get_pool_sizes() == (1, 4)
+
+    monkeypatch.setenv("AUDIT_WORKERS", "32")
+    assert get_pool_sizes() == (1, 1)
+
+    # the query pool is sized separately
+    monkeypatch.setitem(config, "DB_QUERY_POOL_MIN_SIZE", 2)
+    monkeypatch.setitem(config, "DB_QUERY_POOL_MAX_SIZE", 8)
+    monkeypatch.setenv("AUDIT_WORKERS", "4")
+    assert get_pool_sizes("DB_QUERY_POOL") == (1, 2)
+    assert get_pool_sizes() == (1, 4)
+
+
 def test_version_endpoint(client):
     res = client.get("/_version")
     assert res.status_code == 200
@@ -231,3 +331,39 @@ async def test_table_partitioning(db_session, category):
 
     data = await _get_records_from_table(f"{category}_2021_01")
     assert data == [("user1", datetime(2021, 1, 5))]
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_middleware():
+    """
+    Requests that watch for disconnections are cancelled when the client
+    disconnects. Other requests run in the caller's task, without waiting for
+    disconnections.
+    """
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(asyncio.current_task())
+        if scope["path"] == "/watched":
+            scope["add_close_watcher"]()
+            await asyncio.sleep(10)
+            calls.append("not cancelled")
+
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    middleware = ClientDisconnectMiddleware(app)
+    await middleware({"type": "http", "path": "/"}, receive, send)
+    assert calls == [asyncio.current_task()]
+
+    calls = []
+    await asyncio.wait_for(
+        middleware({"type": "http", "path": "/watched"}, receive, send), 5
+    )
+    assert calls == [asyncio.current_task()]
+    # the cancellation does not leak to the caller
+    assert asyncio.current_task().cancelling() == 0